@@ -102,3 +102,83 @@ for method in dict_method_single_stmt:
     table.add_row([method, "{:.2f}x".format(speed_up_single), "{:.2f}x".format(speed_up_multi)])
 
 print(table)
+
+
+# neighborhood stencils against the per-position neighborhood cache
+
+repetition_neighborhood = 10
+
+setup_neighborhood = """
+from space import SingleGrid
+width = 100
+height = 100
+cached_grid = SingleGrid(width, height, True)
+stencil_grid = SingleGrid(width, height, True, cache_size=0)
+positions = [(x, y) for x in range(width) for y in range(height)]
+"""
+
+dict_neighborhood_stmt = {
+"cached, cold cache": "cached_grid.neighborhood_cache.clear()\nfor pos in positions: cached_grid.get_neighborhood(pos, True, radius={0})",
+"cached, warm cache": "for pos in positions: cached_grid.get_neighborhood(pos, True, radius={0})",
+"stencil, no cache": "for pos in positions: stencil_grid.get_neighborhood(pos, True, radius={0})",
+}
+
+table = PrettyTable()
+table.field_names = ["radius"] + list(dict_neighborhood_stmt)
+table.align = "l"
+
+for neighborhood_radius in (1, 3, 5):
+    warm_setup = setup_neighborhood + "for pos in positions: cached_grid.get_neighborhood(pos, True, radius={})".format(neighborhood_radius)
+    row = [neighborhood_radius]
+    for method, stmt in dict_neighborhood_stmt.items():
+        elapsed = timeit.timeit(stmt.format(neighborhood_radius), warm_setup, number=repetition_neighborhood)
+        # time per get_neighborhood call, over the 100 * 100 positions
+        row.append("{:.3f} μs".format(elapsed * 10**6 / repetition_neighborhood / 10**4))
+    table.add_row(row)
+
+print(table)
+
+
+# hexagonal grids, whose neighborhood methods take no moore argument
+
+def hex_setup(setup, grid_class, module):
+    setup = setup.replace(grid_class, "Hex" + grid_class)
+    setup = setup.replace("get_neighborhood(pos, True, include_center=True", "get_neighborhood(pos, include_center=True")
+    return setup.format(module, density, radius)
+
+setup_hex_single_python = hex_setup(main_setup_single, "SingleGrid", "mesa.space")
+setup_hex_single_cython = hex_setup(main_setup_single, "SingleGrid", "space")
+
+setup_hex_multi_python = hex_setup(main_setup_multi, "MultiGrid", "mesa.space")
+setup_hex_multi_cython = hex_setup(main_setup_multi, "MultiGrid", "space")
+
+dict_method_hex_single_stmt = {
+"__init__": "HexSingleGrid(width, height, False)",
+"get_neighborhood": "grid.get_neighborhood(pos, include_center=False, radius={})".format(radius),
+"get_neighbors": "grid.get_neighbors(pos, include_center=False, radius={})".format(radius),
+"iter_neighbors": "for x in grid.iter_neighbors(pos, include_center=False, radius={}): x".format(radius),
+"iter_neighborhood": "for x in grid.iter_neighborhood(pos, include_center=False, radius={}): x".format(radius),
+"neighbor_iter": "for x in grid.neighbor_iter(pos): x",
+"get_cell_list_contents": "grid.get_cell_list_contents(cell_list)",
+"move_to_empty": "grid.move_to_empty(agent)",
+}
+
+dict_method_hex_multi_stmt = dict_method_hex_single_stmt.copy()
+dict_method_hex_multi_stmt["__init__"] = "HexMultiGrid(width, height, False)"
+
+table = PrettyTable()
+table.field_names = ["method name", "speed-up hexsinglegrid", "speed-up hexmultigrid"]
+table.align = "l"
+
+for method in dict_method_hex_single_stmt:
+    stmt_single = dict_method_hex_single_stmt[method]
+    stmt_multi = dict_method_hex_multi_stmt[method]
+    python_time_single = timeit.timeit(stmt_single, setup_hex_single_python, number=repetition)
+    cython_time_single = timeit.timeit(stmt_single, setup_hex_single_cython, number=repetition)
+    python_time_multi = timeit.timeit(stmt_multi, setup_hex_multi_python, number=repetition)
+    cython_time_multi = timeit.timeit(stmt_multi, setup_hex_multi_cython, number=repetition)
+    speed_up_single = python_time_single / cython_time_single
+    speed_up_multi = python_time_multi / cython_time_multi
+    table.add_row([method, "{:.2f}x".format(speed_up_single), "{:.2f}x".format(speed_up_multi)])
+
+print(table)
@@ -0,0 +1,78 @@
+import timeit
+import numpy as np
+from prettytable import PrettyTable
+
+# large-radius neighborhoods and region counts on a MultiGrid, with and
+# without the tile / Fenwick count index
+
+repetition = 5
+# every query runs number times, the first runs find cold caches after the setup
+number = 5
+queries = 200
+size = 1000
+
+densities = (0.001, 0.01, 0.1)
+radii = (5, 10, 25, 50)
+
+setup_grid = """
+import numpy as np
+from space import MultiGrid
+size = {0}
+grid = MultiGrid(size, size, True)
+rng = np.random.default_rng(1)
+cells = rng.integers(0, size, (round({1} * size * size), 2))
+Agent = type("Agent", (), {{"pos": None}})
+agents = [Agent() for _ in range(len(cells))]
+grid.place_agents(agents, cells)
+if {2}:
+    grid.enable_count_index()
+positions = [tuple(pos) for pos in rng.integers(0, size, ({3}, 2)).tolist()]
+"""
+
+stmt_neighbors = "for pos in positions: grid.get_neighbors(pos, True, False, {0})"
+# the baseline counts the agents of the square, wrapped on the torus like
+# the region, with the counts view
+stmt_count_scan = "for x, y in positions: grid.counts[np.ix_(np.arange(x - {0}, x + {0} + 1) % size, np.arange(y - {0}, y + {0} + 1) % size)].sum()"
+stmt_count_index = "for x, y in positions: grid.count_agents_in_region(x - {0}, y - {0}, x + {0}, y + {0})"
+
+
+def check_counts(radius, density):
+    # both counts must agree for the speed-up to compare the same work
+    namespace = {}
+    exec(setup_grid.format(size, density, True, queries), namespace)
+    grid = namespace["grid"]
+    for x, y in namespace["positions"]:
+        window = np.ix_(np.arange(x - radius, x + radius + 1) % size, np.arange(y - radius, y + radius + 1) % size)
+        assert grid.counts[window].sum() == grid.count_agents_in_region(x - radius, y - radius, x + radius, y + radius)
+
+
+def per_query(stmt, radius, density, indexed):
+    setup = setup_grid.format(size, density, indexed, queries)
+    times = timeit.repeat(stmt.format(radius), setup, number=number, repeat=repetition)
+    return min(times) * 10**6 / (number * queries)
+
+
+table = PrettyTable()
+table.field_names = [
+    "density", "radius",
+    "get_neighbors", "get_neighbors indexed", "speed-up",
+    "count by scan", "count_agents_in_region", "speed-up ",
+]
+table.align = "l"
+
+for density in densities:
+    for radius in radii:
+        check_counts(radius, density)
+        neighbors = per_query(stmt_neighbors, radius, density, False)
+        neighbors_indexed = per_query(stmt_neighbors, radius, density, True)
+        scan = per_query(stmt_count_scan, radius, density, False)
+        region = per_query(stmt_count_index, radius, density, True)
+        table.add_row([
+            density, radius,
+            "{:.3f} μs".format(neighbors), "{:.3f} μs".format(neighbors_indexed),
+            "{:.2f}x".format(neighbors / neighbors_indexed),
+            "{:.3f} μs".format(scan), "{:.3f} μs".format(region),
+            "{:.2f}x".format(scan / region),
+        ])
+
+print(table)
@@ -0,0 +1,49 @@
+import timeit
+from prettytable import PrettyTable
+
+# batched neighborhood scans with the cell storage laid out by rows, in
+# tiles or in Morton order
+
+repetition = 5
+density = 0.1
+positions = 10**4
+
+sizes = (100, 500, 1000, 2000, 4000, 8000)
+radii = (1, 2, 5, 10)
+layouts = ("rows", "tiled", "morton")
+
+setup_layout = """
+import numpy as np
+from space import IdSingleGrid
+width = height = {0}
+grid = IdSingleGrid(width, height, True, layout="{1}")
+rng = np.random.default_rng(1)
+cells = rng.choice(width * height, round({2} * width * height), replace=False)
+# a single agent object in every occupied cell, the benchmark only reads cells
+agent = object.__new__(type("Agent", (), {{}}))
+grid.place_agents([agent] * len(cells), np.stack([cells // height, cells % height], axis=1))
+positions = rng.integers(0, width, ({3}, 2))
+"""
+
+stmt_layout = "grid.get_neighbors_batch(positions, True, radius={0})"
+
+table = PrettyTable()
+table.field_names = ["size", "radius"] + ["{} per query".format(layout) for layout in layouts] + [
+    "speed-up {}".format(layout) for layout in layouts[1:]
+]
+table.align = "l"
+
+for size in sizes:
+    for radius in radii:
+        elapsed = []
+        for layout in layouts:
+            setup = setup_layout.format(size, layout, density, positions)
+            times = timeit.repeat(stmt_layout.format(radius), setup, number=1, repeat=repetition)
+            elapsed.append(min(times) * 10**6 / positions)
+        table.add_row(
+            ["{0}x{0}".format(size), radius]
+            + ["{:.3f} μs".format(t) for t in elapsed]
+            + ["{:.2f}x".format(elapsed[0] / t) for t in elapsed[1:]]
+        )
+
+print(table)
@@ -0,0 +1,50 @@
+import os
+import timeit
+from prettytable import PrettyTable
+
+# thread scaling of the nogil batch kernels; without an OpenMP build every
+# column runs serially
+
+repetition = 5
+density = 0.3
+size = 2000
+positions = 10**5
+radius = 2
+
+threads = (1, 2, 4, 8, 16)
+
+setup_threads = """
+import numpy as np
+from space import IdSingleGrid
+grid = IdSingleGrid({0}, {0}, True)
+rng = np.random.default_rng(1)
+cells = rng.choice({0} * {0}, round({1} * {0} * {0}), replace=False)
+agent = object.__new__(type("Agent", (), {{}}))
+grid.place_agents([agent] * len(cells), np.stack([cells // {0}, cells % {0}], axis=1))
+positions = rng.integers(0, {0}, ({2}, 2))
+counts = np.empty({2}, dtype=np.dtype("l"))
+empties = np.empty(({2}, 2), dtype=np.dtype("l"))
+"""
+
+kernels = {
+    "get_neighbors_batch": "grid.get_neighbors_batch(positions, True, radius={0}, num_threads={1})",
+    "count_occupied_neighbors_batch": "grid.count_occupied_neighbors_batch(positions, True, radius={0}, out=counts, num_threads={1})",
+    "find_empty_neighbors_batch": "grid.find_empty_neighbors_batch(positions, True, radius={0}, out=empties, num_threads={1})",
+}
+
+table = PrettyTable()
+table.field_names = ["kernel"] + ["{} threads".format(n) for n in threads]
+table.align = "l"
+
+setup = setup_threads.format(size, density, positions)
+for name, stmt in kernels.items():
+    elapsed = []
+    for n in threads:
+        times = timeit.repeat(stmt.format(radius, n), setup, number=1, repeat=repetition)
+        elapsed.append(min(times))
+    table.add_row(
+        [name] + ["{:.2f} ms ({:.2f}x)".format(t * 10**3, elapsed[0] / t) for t in elapsed]
+    )
+
+print("{0}x{0} grid, {1} positions, radius {2}, {3} cores".format(size, positions, radius, os.cpu_count()))
+print(table)
@@ -26,21 +26,23 @@ cdef class SchellingAgent(cython_time.Agent):
         self.pos = pos
         self.type = agent_type
 
+    @property
+    def random(self):
+        # the grid draws empty cells with agent.random, as in mesa
+        return random
+
     cpdef step(self):
-        cdef int similar = 0
-        # for neighbor in self.model.grid.iter_neighbors(self.pos, True):
-        cdef object[:] neighbors = self.model.grid.get_neighbors_mview(self.pos, True, 1, False)
-        cdef int i
-        for i in range(len(neighbors)):
-            neighbor = neighbors[i]
-            if neighbor.type == self.type:
-                similar += 1
+        # the grid keeps per-type counts, no neighbor is fetched
+        cdef Schelling model = self.model
+        cdef long x, y
+        x, y = self.pos
+        cdef int similar = model.grid.count_neighbors_of_category_at(x, y, self.type, True, False, 1)
 
         # If unhappy, move:
-        if similar < self.model.homophily:
-            self.model.grid.move_to_empty(self)
+        if similar < model.homophily:
+            model.grid.move_to_empty(self)
         else:
-            self.model.happy += 1
+            model.happy += 1
 
 
 cdef class Schelling:
@@ -50,7 +52,7 @@ cdef class Schelling:
     cdef double minority_pc
     cdef public int homophily
     cdef cython_time.SchedulerPythonDict schedule
-    cdef public space._Grid grid
+    cdef public space.SingleGrid grid
     cdef public int happy
     cdef bint running
     def __init__(self, width=20, height=20, density=0.8, minority_pc=0.2, homophily=3):
@@ -63,7 +65,8 @@ cdef class Schelling:
         self.homophily = homophily
 
         self.schedule = cython_time.SchedulerPythonDict(self, True)
-        self.grid = space._Grid(width, height, True)
+        self.grid = space.SingleGrid(width, height, True)
+        self.grid.enable_categories("type", 2)
 
         self.happy = 0
 
@@ -76,6 +79,8 @@ cdef class Schelling:
         cdef int agent_type
         cdef SchellingAgent agent
         cdef int unique_id = 0
+        cdef list agents = []
+        cdef list positions = []
         for row in range(self.width):
             for col in range(self.height):
                 x = row
@@ -87,9 +92,11 @@ cdef class Schelling:
                         agent_type = 0
 
                     agent = SchellingAgent(unique_id, (x, y), self, agent_type)
-                    self.grid.place_agent(agent, (x, y))
+                    agents.append(agent)
+                    positions.append((x, y))
                     self.schedule.add(agent)
                     unique_id += 1
+        self.grid.place_agents(agents, positions)
 
         self.running = True
 
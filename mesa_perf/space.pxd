@@ -1,23 +1,234 @@
+cimport cython
+from libc.stdint cimport uint64_t
+
+# C-level API of the dense grids, for Cython models doing `cimport space`.
+# The *_at methods take the cell as (long x, long y) and skip tuple boxing
+# and Python dispatch; the inline ones are nogil and do no bounds checking,
+# so wrap or check the coordinates first (wrap_x / wrap_y / out_of_bounds_at).
+
+
+# kinds of the events of the mutation journal
+cpdef enum JournalEvent:
+    PLACE = 0
+    REMOVE = 1
+    MOVE = 2
+
+
+cdef class NeighborhoodCache:
+    cdef object _entries
+    cdef bint _bounded
+    cdef readonly long maxsize, maxcells, cells
+    cdef readonly long hits, misses, evictions
+
+    cdef object get(self, object key)
+    cdef put(self, object key, list value)
+    cdef _shrink(self)
+
+
+cdef class _AgentTable:
+    # dense slot -> agent table, freed slots are reused last in first out
+    cdef list agents
+    cdef list _free
+
+    cdef long add(self, agent)
+    cdef release(self, long slot)
+
+
+cdef class _Stencil:
+    cdef long[:, :] offsets
+    cdef long[:, :] cells
+    cdef long size
+    cdef list variants
+
+
 cdef class _Grid:
-    cdef long height, width, num_cells, num_empties
-    cdef bint torus
-    cdef long[:, :] _ids_grid
-    # TODO make private
-    cdef public object[:, :] _agents_grid
-    cdef dict _neighborhood_cache_cy
-    cdef dict _neighborhood_cache_py
-    cpdef long _default_val_ids(self)
+    cdef readonly long height, width, num_cells, num_empties
+    cdef readonly bint torus
+    cdef list _grid
+    # cell storage is flat, cell (x, y) sits at _x_offsets[x] + _y_offsets[y]
+    # which lays the cells out by rows, in square tiles or in Morton order
+    # within square tiles
+    cdef readonly str layout
+    cdef bint _rows
+    cdef long[:] _x_offsets
+    cdef long[:] _y_offsets
+    cdef char[:] _occupancy
+    cdef long[:] _ids
+    cdef _AgentTable _table
+    cdef readonly NeighborhoodCache neighborhood_cache
+    cdef dict _stencils
+    cdef readonly dict properties
+    # per-category agent counts, enabled with enable_categories
+    cdef object _category_attribute
+    cdef readonly long num_categories
+    cdef int[:, :] _category_counts
+    cdef int[:] _slot_categories
+    # one bit per empty cell, over the cells packed as x * height + y, and a
+    # Fenwick tree of the per-word counts for rank / select; _tree_top is
+    # the largest power of two not above the number of words
+    cdef uint64_t[:] _empty_bits
+    cdef long[:] _empty_tree
+    cdef long _tree_top
+    # opt-in mutation journal: one (event, slot, x0, y0, x1, y1) row per
+    # place, remove or move, -1 for the missing cell; size -1 when disabled
+    cdef long[:, :] _journal
+    cdef long _journal_size
+    # opt-in count index: agents per block x block tile and a 2D Fenwick
+    # tree of the cell counts; block 0 when disabled
+    cdef long _count_block
+    cdef int[:, :] _block_counts
+    cdef int[:, :] _count_tree
+    cdef long[:, :] _tile_spans
+
+    @cython.final
+    cdef inline long _offset(self, long x, long y) except -1:
+        return self._x_offsets[x] + self._y_offsets[y]
+
+    @cython.final
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline long _unchecked_offset(self, long x, long y) noexcept nogil:
+        # the rows layout skips the tables in the stencil loops
+        if self._rows:
+            return x * self.height + y
+        return self._x_offsets[x] + self._y_offsets[y]
+
+    @cython.final
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline int _record(self, long event, long slot, long x0, long y0, long x1, long y1) except -1:
+        # every place, remove and move goes through here, -1 for the missing cell
+        if self._count_block:
+            if x0 >= 0:
+                self._index_add(x0, y0, -1)
+            if x1 >= 0:
+                self._index_add(x1, y1, 1)
+        if self._journal_size < 0:
+            return 0
+        if self._journal_size == self._journal.shape[0]:
+            self._grow_journal()
+        self._journal[self._journal_size, 0] = event
+        self._journal[self._journal_size, 1] = slot
+        self._journal[self._journal_size, 2] = x0
+        self._journal[self._journal_size, 3] = y0
+        self._journal[self._journal_size, 4] = x1
+        self._journal[self._journal_size, 5] = y1
+        self._journal_size += 1
+        return 0
+
+    @cython.final
+    @cython.cdivision(True)
+    cdef inline long wrap_x(self, long x) noexcept nogil:
+        x = x % self.width
+        return x + self.width if x < 0 else x
+
+    @cython.final
+    @cython.cdivision(True)
+    cdef inline long wrap_y(self, long y) noexcept nogil:
+        y = y % self.height
+        return y + self.height if y < 0 else y
+
+    @cython.final
+    cdef inline bint out_of_bounds_at(self, long x, long y) noexcept nogil:
+        return x < 0 or x >= self.width or y < 0 or y >= self.height
+
+    @cython.final
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline bint is_cell_empty_at(self, long x, long y) noexcept nogil:
+        return self._occupancy[self._unchecked_offset(x, y)] == 0
+
+    cdef _init_fields(self, long width, long height, bint torus, str layout)
+    cdef _init_cells(self)
+    cdef _grow_journal(self)
+    cdef void _index_add(self, long x, long y, int delta) noexcept nogil
+    cdef long _count_prefix(self, long x, long y) noexcept nogil
+    cdef long _count_rect(self, long x, long y, long columns, long rows)
+    cdef tuple _region_range(self, long start, long stop, long size)
+    cdef long _split_tiles(self, long y, long length)
+    cdef long _flag_tiles(self, long x, long n)
+    cdef long _tile_cells(self, long x, long m, long low, long high, long skip, long[:, :] cells, long count)
+    cdef list _indexed_neighbors(self, _Stencil stencil, long x, long y, bint moore, bint include_center, int radius)
     cpdef default_val(self)
-    cpdef bint is_cell_empty(self, pos)
+    cdef long _storage_size(self)
+    cdef _cells_view(self, memview)
+    cdef _init_empties(self)
+    cdef void _update_empty_tree(self, long word, long delta) noexcept nogil
+    cdef long _rank_empty(self, long cell) noexcept nogil
+    cdef long _select_empty(self, long rank) noexcept nogil
+    cdef void _set_occupied(self, long x, long y)
+    cdef void _set_empty(self, long x, long y)
+    cdef object _cell(self, long x, long y)
+    cdef list _column(self, long x)
+    cdef _Stencil _get_stencil(self, bint moore, bint include_center, int radius)
+    cdef _Stencil _build_stencil(self, bint moore, bint include_center, int radius)
+    cdef long _translate_stencil(self, _Stencil stencil, long x, long y)
+    cdef list _cells_contents(self, long[:, :] cells, long count)
+    cpdef list get_neighborhood(self, object pos, bint moore=*, bint include_center=*, int radius=*)
+    cdef list get_neighbors_at(self, long x, long y, bint moore, bint include_center, int radius)
+    cpdef list get_neighbors(self, pos, bint moore=*, bint include_center=*, int radius=*)
+    cdef long _cell_count(self, long x, long y)
+    cdef long _write_cell_slots(self, long x, long y, long* out)
+    cpdef tuple torus_adj(self, pos)
+    cpdef bint out_of_bounds(self, pos)
+    cpdef list get_cell_list_contents(self, cell_list)
+    cdef _place(self, agent, long x, long y)
+    cdef _remove(self, agent, long x, long y)
+    cdef _check_agents(self, list agents, bint placing)
+    cdef _check_destinations(self, long[:, :] positions, dict leaving)
+    cdef long _slot_of(self, agent) except -1
+    cdef long _category_of(self, agent) except -2
+    cdef _count_category(self, long slot, long category, long x, long y)
+    cdef _uncount_category(self, long slot, long x, long y)
+    cdef _move_category(self, long slot, long x0, long y0, long x1, long y1)
+    cdef long count_neighbors_of_category_at(self, long x, long y, long category, bint moore, bint include_center, int radius) except -1
+    cpdef long count_neighbors_of_category(self, pos, long category, bint moore, bint include_center=*, int radius=*)
     cpdef place_agent(self, agent, pos)
     cpdef remove_agent(self, agent)
-    cpdef object[:] get_cell_mview_contents(self, long[:, :] tuples_mview)
-    cpdef long[:, :] convert_tuples_to_mview(self, object cell_list)
-    cpdef list convert_agent_mview_to_list(self, object[:] agent_mview)
-    cpdef get_cell_list_contents(self, object cell_list)
-    cpdef long[:, :] compute_neighborhood(self, object pos, bint moore, int radius, bint include_center)
-    cpdef long[:, :] get_neighborhood_mview(self, object pos, bint moore, int radius, bint include_center)
-    cpdef list get_neighborhood(self, object pos, bint moore, int radius, bint include_center)
-    cpdef object[:] get_neighbors_mview(self, object pos, bint moore, int radius, bint include_center)
-    cpdef list get_neighbors(self, object pos, bint moore, int radius, bint include_center)
-    cpdef move_to_empty(self, agent)
+    cdef _positions_array(self, positions)
+    cdef dict _state_arrays(self)
+    cdef _restore_arrays(self, dict arrays)
+    cdef _restore_agent(self, agent, long slot, long x, long y)
+    cdef _place_all(self, list agents, long[:, :] positions)
+    cdef _move_all(self, list agents, long[:, :] positions)
+    cdef _move(self, agent, long x0, long y0, long x1, long y1)
+    cdef _swap(self, agent_a, long xa, long ya, agent_b, long xb, long yb)
+    cpdef move_agent(self, agent, pos)
+    cpdef swap_pos(self, agent_a, agent_b)
+    cpdef bint is_cell_empty(self, pos)
+    cpdef move_to_empty(self, agent, double cutoff=*)
+    cpdef bint exists_empty_cells(self)
+    cdef long _nearest_cell(self, long x, long y, bint moore, bint include_center, long max_radius,
+                            bint occupied, object predicate) except -2
+    cpdef iter_neighbors(self, pos, bint moore=*, bint include_center=*, int radius=*)
+
+
+cdef class SingleGrid(_Grid):
+
+    @cython.final
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline long agent_slot_at(self, long x, long y) noexcept nogil:
+        # slot in agent_table of the agent in (x, y), -1 for an empty cell
+        return self._ids[self._unchecked_offset(x, y)]
+
+    @cython.final
+    cdef inline object agent_at(self, long x, long y):
+        cdef long slot = self.agent_slot_at(x, y)
+        return None if slot == -1 else self._table.agents[slot]
+
+    cdef _neighbors_batch_parallel(self, const long[:, :] positions, _Stencil stencil, int threads)
+
+
+cdef class MultiGrid(_Grid):
+    # id(agent) -> slot in the agent table
+    cdef dict _slots
+    cdef int[:] _counts
+
+    cdef _move_contents(self, agent, long x0, long y0, long x1, long y1)
+
+    @cython.final
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline int cell_count_at(self, long x, long y) noexcept nogil:
+        return self._counts[self._unchecked_offset(x, y)]
@@ -3,152 +3,1064 @@
 # cython: nonecheck=False
 # cython: initializedcheck=False
 
+cimport cython
+from cpython.dict cimport PyDict_GetItem
+from cpython.ref cimport PyObject
+from libc.math cimport floor, fabs, sqrt
+from libc.stdint cimport int64_t, uint64_t
+from cython.parallel cimport prange
 import numpy as np
+import os
 import itertools
+import json
+from collections import OrderedDict
+
+# numpy dtype matching the C long of the memoryviews below
+LONG = np.dtype("l")
+
+cdef extern from *:
+    """
+    #if defined(_MSC_VER)
+    #include <intrin.h>
+    static inline int mesa_perf_popcount(unsigned long long x) { return (int)__popcnt64(x); }
+    static inline int mesa_perf_ctz(unsigned long long x) { unsigned long i; _BitScanForward64(&i, x); return (int)i; }
+    #else
+    static inline int mesa_perf_popcount(unsigned long long x) { return __builtin_popcountll(x); }
+    static inline int mesa_perf_ctz(unsigned long long x) { return __builtin_ctzll(x); }
+    #endif
+    """
+    int _popcount "mesa_perf_popcount"(uint64_t x) nogil
+    int _ctz "mesa_perf_ctz"(uint64_t x) nogil
+
 
 cdef is_integer(x):
     return isinstance(x, int) or isinstance(x, np.integer)
 
+cdef _readonly_view(memview):
+    # zero-copy numpy view of the array behind a memoryview, which keeps
+    # following the grid state but cannot be written through
+    view = np.asarray(memview.base).view()
+    view.flags.writeable = False
+    return view
 
-cdef class _Grid:
 
-    cdef readonly long height, width, num_cells, num_empties
-    cdef readonly bint torus
-    cdef list _grid
-    cdef char[:, :] _occupancy_matrix
-    cdef dict _neighborhood_cache
-    cdef bint _empties_built 
-    cdef set _empties
+cdef class NeighborhoodCache:
+    # LRU cache of neighborhoods keyed by (pos, moore, include_center, radius).
+    # maxsize bounds the number of entries and maxcells the total number of
+    # stored positions (a proxy for memory); -1 means unbounded, maxsize 0
+    # disables caching.
+
+    def __init__(self, maxsize=None, maxcells=None):
+        self._entries = {}
+        self.resize(maxsize, maxcells)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def currsize(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return self.maxsize != 0
+
+    def resize(self, maxsize=None, maxcells=None):
+        self.maxsize = -1 if maxsize is None else maxsize
+        self.maxcells = -1 if maxcells is None else maxcells
+        if self.maxsize < -1 or self.maxcells < -1:
+            raise ValueError("Cache budgets must be non-negative or None.")
+        # recency is only tracked when there is something to evict
+        self._bounded = self.maxsize != -1 or self.maxcells != -1
+        if self._bounded and type(self._entries) is dict:
+            self._entries = OrderedDict(self._entries)
+        elif not self._bounded and type(self._entries) is not dict:
+            self._entries = dict(self._entries)
+        self._shrink()
+
+    def clear(self):
+        self._entries.clear()
+        self.cells = 0
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "currsize": len(self._entries),
+            "cells": self.cells,
+            "maxsize": None if self.maxsize == -1 else self.maxsize,
+            "maxcells": None if self.maxcells == -1 else self.maxcells,
+        }
+
+    cdef object get(self, object key):
+        cdef PyObject* value
+        
+        if self.maxsize == 0:
+            return None
+        # OrderedDict is a dict subclass, lookups can skip the method call
+        value = PyDict_GetItem(self._entries, key)
+        if value == NULL:
+            self.misses += 1
+            return None
+        if self._bounded:
+            self._entries.move_to_end(key)
+        self.hits += 1
+        return <object>value
+
+    cdef put(self, object key, list value):
+        cdef long size = len(value)
+        if self.maxsize == 0 or (self.maxcells != -1 and size > self.maxcells):
+            return
+        self._entries[key] = value
+        self.cells += size
+        if self._bounded:
+            self._shrink()
+
+    cdef _shrink(self):
+        if self.maxsize == 0:
+            self.clear()
+            return
+        while (
+            (self.maxsize != -1 and len(self._entries) > self.maxsize)
+            or (self.maxcells != -1 and self.cells > self.maxcells)
+        ):
+            _, value = self._entries.popitem(last=False)
+            self.cells -= len(value)
+            self.evictions += 1
+
+
+cdef long[:] _spread_bits(long[:] values):
+    # inserts a zero bit above each of the low 32 bits, for Morton order
+    spread = np.asarray(values).astype(np.uint64)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        spread = (spread | (spread << np.uint64(shift))) & np.uint64(mask)
+    return spread.astype(LONG)
+
+
+cdef tuple _layout_offsets(str layout, long width, long height, long tile):
+    # per column and per row offsets of the cell storage, see _Grid.layout
+    xs = np.arange(width, dtype=LONG)
+    ys = np.arange(height, dtype=LONG)
+    if layout == "rows":
+        return xs * height, ys
+    if layout == "morton":
+        # Morton order within tiles laid out as in the tiled layout, so the
+        # padding stays under a tile per axis. The tiles are a power of two,
+        # at most the smaller side of the grid
+        if tile < 1 or tile & (tile - 1):
+            raise ValueError("Morton tiles must be a power of two")
+        while tile > 1 and tile > min(width, height):
+            tile //= 2
+        padded_height = -(-height // tile) * tile
+        return (
+            (xs // tile) * tile * padded_height + (np.asarray(_spread_bits(xs % tile)) << 1),
+            (ys // tile) * tile * tile + np.asarray(_spread_bits(ys % tile)),
+        )
+    if layout == "tiled":
+        # tile x tile blocks stored one after the other, rows within a block
+        padded_height = -(-height // tile) * tile
+        return (xs // tile) * tile * padded_height + (xs % tile) * tile, (ys // tile) * tile * tile + ys % tile
+    raise ValueError(f"Unknown layout {layout}, expected rows, tiled or morton")
+
+
+cdef class _AgentTable:
+    # dense slot -> agent table, freed slots are reused last in first out
+
+    def __init__(self):
+        self.agents = []
+        self._free = []
+
+    cdef long add(self, agent):
+        cdef long slot
+        if self._free:
+            slot = self._free.pop()
+            self.agents[slot] = agent
+        else:
+            slot = len(self.agents)
+            self.agents.append(agent)
+        return slot
+
+    cdef release(self, long slot):
+        self.agents[slot] = None
+        self._free.append(slot)
+
+
+cdef class _Stencil:
+    # neighborhood offsets of one (moore, include_center, radius) shape, plus
+    # a scratch buffer receiving the cells of the last translation. Shapes
+    # depending on the column (hex grids) keep one stencil per x % len(variants),
+    # all sharing the scratch buffer, and size is the largest of them
+    pass
+
+
+cdef tuple _stencil_bounds(long width, long height, bint torus, int radius):
+    # (dx_min, dx_max, dy_min, dy_max) of the square stencils of this radius
+    cdef long x_radius, y_radius, kx, ky
+    
+    if torus:
+        x_max_radius, y_max_radius = width // 2, height // 2
+        x_radius, y_radius = min(radius, x_max_radius), min(radius, y_max_radius)
+
+        xdim_even, ydim_even = (width + 1) % 2, (height + 1) % 2
+        kx = 1 if x_radius == x_max_radius and xdim_even else 0
+        ky = 1 if y_radius == y_max_radius and ydim_even else 0
+    else:
+        # offsets past the grid extent can never be in bounds
+        x_radius, y_radius = min(radius, width - 1), min(radius, height - 1)
+        kx = ky = 0
+    return -x_radius, x_radius - kx, -y_radius, y_radius - ky
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _Stencil _square_stencil(long width, long height, bint torus, bint moore, bint include_center, int radius):
+    cdef _Stencil stencil
+    cdef long[:, :] offsets
+    cdef long dx_min, dx_max, dy_min, dy_max, dx, dy, count
+    
+    dx_min, dx_max, dy_min, dy_max = _stencil_bounds(width, height, torus, radius)
+    offsets_arr = np.empty(((dx_max - dx_min + 1) * (dy_max - dy_min + 1), 2), dtype=LONG)
+    offsets = offsets_arr
+    count = 0
+    for dx in range(dx_min, dx_max + 1):
+        for dy in range(dy_min, dy_max + 1):
+
+            if not moore and abs(dx) + abs(dy) > radius:
+                continue
+
+            if dx == 0 and dy == 0 and not include_center:
+                continue
+
+            offsets[count, 0] = dx
+            offsets[count, 1] = dy
+            count += 1
+
+    stencil = _Stencil()
+    stencil.offsets = offsets_arr[:count]
+    stencil.cells = np.empty((count, 2), dtype=LONG)
+    stencil.size = count
+    return stencil
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef long _translate(_Stencil stencil, long width, long height, bint torus, long x, long y):
+    # writes the cells of the stencil centered in (x, y) in stencil.cells
+    cdef long[:, :] offsets
+    cdef long[:, :] cells = stencil.cells
+    cdef long i, nx, ny, count
+    
+    if torus:
+        x, y = x % width, y % height
+    if stencil.variants is not None:
+        stencil = stencil.variants[x % len(stencil.variants)]
+    offsets = stencil.offsets
+    
+    count = 0
+    if torus:
+        for i in range(stencil.size):
+            nx = x + offsets[i, 0]
+            ny = y + offsets[i, 1]
+            if nx < 0:
+                nx += width
+            elif nx >= width:
+                nx -= width
+            if ny < 0:
+                ny += height
+            elif ny >= height:
+                ny -= height
+            cells[count, 0] = nx
+            cells[count, 1] = ny
+            count += 1
+    else:
+        for i in range(stencil.size):
+            nx = x + offsets[i, 0]
+            ny = y + offsets[i, 1]
+            if nx < 0 or nx >= width or ny < 0 or ny >= height:
+                continue
+            cells[count, 0] = nx
+            cells[count, 1] = ny
+            count += 1
+    return count
+
+
+cdef tuple _stencil_tables(_Stencil stencil):
+    # the offsets of every variant of a stencil as one (variants, size, 2)
+    # array and the variant sizes, readable without the GIL
+    cdef _Stencil variant
+    cdef list variants = stencil.variants if stencil.variants is not None else [stencil]
+    cdef long i
+    
+    tables = np.zeros((len(variants), stencil.size, 2), dtype=LONG)
+    sizes = np.empty(len(variants), dtype=LONG)
+    for i in range(len(variants)):
+        variant = variants[i]
+        tables[i, :variant.size] = np.asarray(variant.offsets)
+        sizes[i] = variant.size
+    return tables, sizes
+
+
+cdef int _thread_count(num_threads) except -1:
+    # the batch kernels run serially unless asked for threads, None uses
+    # every core; without OpenMP at build time prange is serial
+    if num_threads is None:
+        return os.cpu_count() or 1
+    if num_threads < 1:
+        raise ValueError("num_threads must be positive or None")
+    return num_threads
+
+
+@cython.cdivision(True)
+cdef inline long _wrap(long value, long size) noexcept nogil:
+    value = value % size
+    return value + size if value < 0 else value
+
+
+cdef inline long _stencil_coord(long value, long offset, long size, bint torus) noexcept nogil:
+    # one coordinate of a stencil cell, already wrapped on a torus; -1 when
+    # it is outside a bounded grid. The kernels assign it directly so that
+    # prange keeps the cell thread-private
+    value += offset
+    if torus:
+        if value < 0:
+            return value + size
+        if value >= size:
+            return value - size
+        return value
+    return value if 0 <= value < size else -1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _count_occupied_kernel(const long[:, :] positions, const long[:, :, :] tables, const long[:] sizes,
+                                 const long[:] x_offsets, const long[:] y_offsets, const char[:] occupancy,
+                                 long width, long height, bint torus, long[:] out, int threads) noexcept nogil:
+    cdef long i, j, x, y, nx, ny, variant, total
+    
+    for i in prange(positions.shape[0], num_threads=threads, schedule="static"):
+        x = positions[i, 0]
+        y = positions[i, 1]
+        if torus:
+            x = _wrap(x, width)
+            y = _wrap(y, height)
+        variant = _wrap(x, tables.shape[0])
+        total = 0
+        for j in range(sizes[variant]):
+            nx = _stencil_coord(x, tables[variant, j, 0], width, torus)
+            ny = _stencil_coord(y, tables[variant, j, 1], height, torus)
+            if nx >= 0 and ny >= 0:
+                if occupancy[x_offsets[nx] + y_offsets[ny]]:
+                    total = total + 1
+        out[i] = total
+
+
+# array geometry of the square grids, shared by the dense and sparse grids
+
+ctypedef fused _distance_t:
+    long
+    double
+
+cdef dict _METRICS = {"chebyshev": 0, "manhattan": 1, "euclidean": 2}
+
+
+cdef int _metric_code(str metric) except -1:
+    code = _METRICS.get(metric)
+    if code is None:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {', '.join(_METRICS)}")
+    return code
+
+
+@cython.cdivision(True)
+cdef inline void _displacement(long x1, long y1, long x2, long y2, long width, long height, bint torus,
+                               long* dx, long* dy) noexcept nogil:
+    # (x1, y1) -> (x2, y2), the shortest way around a torus, in
+    # [-size // 2, size - size // 2) on each axis
+    dx[0] = x2 - x1
+    dy[0] = y2 - y1
+    if torus:
+        dx[0] = _wrap(dx[0] + width // 2, width) - width // 2
+        dy[0] = _wrap(dy[0] + height // 2, height) - height // 2
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _distance_kernel(const long[:, :] a, const long[:, :] b, bint pairwise, long width, long height,
+                           bint torus, int metric, _distance_t[:, :] out, int threads) noexcept nogil:
+    # out[i, j] is the distance from a[i] to b[j] when pairwise, else out[i, 0]
+    # is the one from a[i] to b[i], or to b[0] when b holds a single position
+    cdef long i, j, k, dx, dy
+    
+    for i in prange(a.shape[0], num_threads=threads, schedule="static"):
+        for j in range(out.shape[1]):
+            if pairwise:
+                k = j
+            elif b.shape[0] == 1:
+                k = 0
+            else:
+                k = i
+            _displacement(a[i, 0], a[i, 1], b[k, 0], b[k, 1], width, height, torus, &dx, &dy)
+            if dx < 0:
+                dx = -dx
+            if dy < 0:
+                dy = -dy
+            if _distance_t is double:
+                out[i, j] = sqrt(<double>(dx * dx + dy * dy))
+            elif metric == 0:
+                out[i, j] = dx if dx > dy else dy
+            else:
+                out[i, j] = dx + dy
+
+
+cdef _distances(positions_1, positions_2, bint pairwise, long width, long height, bint torus, str metric, num_threads):
+    cdef const long[:, :] a = np.ascontiguousarray(positions_1, dtype=LONG).reshape(-1, 2)
+    cdef const long[:, :] b = np.ascontiguousarray(positions_2, dtype=LONG).reshape(-1, 2)
+    cdef int code = _metric_code(metric)
+    cdef int threads = _thread_count(num_threads)
+    cdef long[:, :] out_long
+    cdef double[:, :] out_double
+    
+    if not pairwise and b.shape[0] != 1 and b.shape[0] != a.shape[0]:
+        raise ValueError("positions_2 must hold one position or as many as positions_1")
+    shape = (a.shape[0], b.shape[0] if pairwise else 1)
+    if code == 2:
+        out = np.empty(shape, dtype=np.float64)
+        out_double = out
+        with nogil:
+            _distance_kernel(a, b, pairwise, width, height, torus, code, out_double, threads)
+    else:
+        out = np.empty(shape, dtype=LONG)
+        out_long = out
+        with nogil:
+            _distance_kernel(a, b, pairwise, width, height, torus, code, out_long, threads)
+    return out if pairwise else out.reshape(-1)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _headings(positions_1, positions_2, long width, long height, bint torus):
+    cdef const long[:, :] a = np.ascontiguousarray(positions_1, dtype=LONG).reshape(-1, 2)
+    cdef const long[:, :] b = np.ascontiguousarray(positions_2, dtype=LONG).reshape(-1, 2)
+    cdef long[:, :] out_view
+    cdef long i, k
+    
+    if b.shape[0] != 1 and b.shape[0] != a.shape[0]:
+        raise ValueError("positions_2 must hold one position or as many as positions_1")
+    out = np.empty((a.shape[0], 2), dtype=LONG)
+    out_view = out
+    with nogil:
+        for i in range(a.shape[0]):
+            k = 0 if b.shape[0] == 1 else i
+            _displacement(a[i, 0], a[i, 1], b[k, 0], b[k, 1], width, height, torus, &out_view[i, 0], &out_view[i, 1])
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _out_of_bounds_mask(positions, long width, long height):
+    cdef const long[:, :] pos_view = np.ascontiguousarray(positions, dtype=LONG).reshape(-1, 2)
+    cdef unsigned char[:] out_view
+    cdef long i, x, y
+    
+    out = np.empty(pos_view.shape[0], dtype=np.bool_)
+    out_view = out.view(np.uint8)
+    with nogil:
+        for i in range(pos_view.shape[0]):
+            x = pos_view[i, 0]
+            y = pos_view[i, 1]
+            out_view[i] = x < 0 or x >= width or y < 0 or y >= height
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _torus_adj_positions(positions, long width, long height, bint torus):
+    cdef long[:, :] out_view
+    cdef long i
+    
+    out = np.array(positions, dtype=LONG).reshape(-1, 2)
+    if not torus:
+        if _out_of_bounds_mask(out, width, height).any():
+            raise Exception("Point out of bounds, and space non-toroidal.")
+        return out
+    out_view = out
+    with nogil:
+        for i in range(out_view.shape[0]):
+            out_view[i, 0] = _wrap(out_view[i, 0], width)
+            out_view[i, 1] = _wrap(out_view[i, 1], height)
+    return out
+
+
+cdef class _Empties:
+    # read-only set-like view of the empty cells of a grid
+
+    cdef _Grid grid
+
+    def __init__(self, _Grid grid):
+        self.grid = grid
+
+    def __len__(self):
+        return self.grid.num_empties
+
+    def __contains__(self, pos):
+        cdef long x, y
+        x, y = pos
+        if self.grid.out_of_bounds(pos):
+            return False
+        return self.grid._occupancy[self.grid._offset(x, y)] == 0
+
+    def __getitem__(self, long i):
+        # i-th empty cell in (x, y) order
+        cdef long cell
+        if i < 0:
+            i += self.grid.num_empties
+        if i < 0 or i >= self.grid.num_empties:
+            raise IndexError("empties index out of range")
+        cell = self.grid._select_empty(i)
+        return (cell // self.grid.height, cell % self.grid.height)
+
+    def index(self, pos):
+        cdef long x, y
+        if pos not in self:
+            raise ValueError(f"{pos} is not empty")
+        x, y = pos
+        return self.grid._rank_empty(x * self.grid.height + y)
+
+    def to_array(self):
+        # (num_empties, 2) array of the empty cells in (x, y) order
+        bits = np.asarray(self.grid._empty_bits).view(np.uint8)
+        cells = np.flatnonzero(np.unpackbits(bits, bitorder="little")[:self.grid.num_cells])
+        return np.stack(np.divmod(cells, self.grid.height), axis=1)
+
+    def __iter__(self):
+        return map(tuple, self.to_array().tolist())
+
+    def __repr__(self):
+        return f"<empties of {self.grid!r}: {len(self)} cells>"
+
+
+cdef class PropertyLayer:
+    # named (width, height) array of per-cell values; operations and
+    # conditions are applied to the whole array at once, so they must be
+    # NumPy ufuncs or other array-aware callables
+
+    cdef readonly str name
+    cdef readonly long width, height
+    cdef readonly object data
+
+    def __init__(self, str name, long width, long height, default_value, dtype=np.float64):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.data = np.full((width, height), default_value, dtype=dtype)
+
+    def set_cell(self, position, value):
+        self.data[position] = value
+
+    def set_cells(self, value, condition=None):
+        if condition is None:
+            self.data[...] = value
+        else:
+            np.copyto(self.data, value, casting="unsafe", where=condition(self.data))
+
+    def modify_cell(self, position, operation, value=None):
+        if value is None:
+            self.data[position] = operation(self.data[position])
+        else:
+            self.data[position] = operation(self.data[position], value)
+
+    def modify_cells(self, operation, value=None, condition=None):
+        if value is None:
+            result = operation(self.data)
+        else:
+            result = operation(self.data, value)
+        if condition is None:
+            self.data[...] = result
+        else:
+            np.copyto(self.data, result, casting="unsafe", where=condition(self.data))
+
+    def select_cells(self, condition):
+        # (N, 2) array of the positions satisfying condition
+        return np.argwhere(condition(self.data))
+
+    def aggregate_property(self, operation):
+        return operation(self.data)
+
+
+cdef class _Grid:
+    # attributes and the inline C-level API are declared in space.pxd
     
-    def __init__(self, long width, long height, bint torus):
+    def __init__(self, long width, long height, bint torus, cache_size=None, cache_cells=None, property_layers=None, layout="rows", long tile=16):
         
+        self._init_fields(width, height, torus, layout)
+        x_offsets, y_offsets = _layout_offsets(layout, width, height, tile)
+        self._x_offsets = x_offsets
+        self._y_offsets = y_offsets
+        self._occupancy = np.zeros(self._storage_size(), dtype=np.int8)
+        self._ids = np.full(self._storage_size(), -1, dtype=LONG)
+
+        self._init_cells()
+        self._init_empties()
+        
+        self.neighborhood_cache = NeighborhoodCache(cache_size, cache_cells)
+        
+        if property_layers is not None:
+            if isinstance(property_layers, PropertyLayer):
+                property_layers = [property_layers]
+            for layer in property_layers:
+                self.add_property_layer(layer)
+
+    cdef _init_fields(self, long width, long height, bint torus, str layout):
+        # everything but the storage arrays, which load_state reads instead
         self.height = height
         self.width = width
         self.torus = torus
         self.num_cells = height * width
         self.num_empties = self.num_cells
         
-        self._occupancy_matrix = np.zeros((self.width, self.height), dtype=np.int8)
-
+        self.layout = layout
+        self._rows = layout == "rows"
+        self._table = _AgentTable()
+        self._journal_size = -1
+        self._stencils = {}
+        self.properties = {}
+
+    cdef _init_cells(self):
         self._grid = [
             [self.default_val() for _ in range(self.height)] for _ in range(self.width)
         ]
-        
-        self._empties_built = False
-        self._neighborhood_cache = {}
 
     cpdef default_val(self):
         return None
 
+    cdef long _storage_size(self):
+        return self._x_offsets[self.width - 1] + self._y_offsets[self.height - 1] + 1
+
+    cdef _cells_view(self, memview):
+        # read-only (width, height, ...) array of a cell storage buffer, a view
+        # following the grid for the rows layout and a snapshot otherwise
+        storage = np.asarray(memview.base)
+        if self.layout == "rows":
+            view = storage[:self.num_cells].reshape((self.width, self.height) + storage.shape[1:])
+        else:
+            view = storage[np.add.outer(np.asarray(self._x_offsets), np.asarray(self._y_offsets))]
+        view.flags.writeable = False
+        return view
+
     @property
-    def empties(self):
-        if not self._empties_built:
-            self._build_empties()
-        return self._empties
+    def agent_table(self):
+        return self._table.agents
 
-    cdef _build_empties(self):
-        self._empties = set()
+    @property
+    def occupancy(self):
+        return self._cells_view(self._occupancy)
+
+    def add_property_layer(self, PropertyLayer layer):
+        if (layer.width, layer.height) != (self.width, self.height):
+            raise ValueError("Property layer dimensions do not match the grid")
+        if layer.name in self.properties:
+            raise ValueError(f"Property layer {layer.name} already exists")
+        self.properties[layer.name] = layer
+
+    def remove_property_layer(self, str name):
+        if name not in self.properties:
+            raise ValueError(f"Property layer {name} does not exist")
+        del self.properties[name]
+
+    def select_cells(self, conditions=None, bint only_empty=False):
+        # (N, 2) array of the positions satisfying every condition of the
+        # {layer name: condition} dict
+        mask = np.ones((self.width, self.height), dtype=bool)
+        if conditions is not None:
+            for name, condition in conditions.items():
+                mask &= condition(self.properties[name].data)
+        if only_empty:
+            mask &= self.occupancy == 0
+        return np.argwhere(mask)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def diffuse_property(self, str name, double rate, bint moore = True):
+        # every cell keeps (1 - rate) of its value and splits the rest evenly
+        # between its neighbors, conserving the total on bounded grids too
+        cdef PropertyLayer layer = self.properties[name]
+        cdef double[:, :] data
+        cdef double[:, :] out
+        cdef long[:, :] cells
+        cdef _Stencil stencil
+        cdef long x, y, j, count
+        cdef double share
+        
+        if layer.data.dtype != np.float64:
+            raise TypeError("Only float64 property layers can be diffused")
+        data = layer.data
+        out = np.zeros((self.width, self.height), dtype=np.float64)
+        stencil = self._get_stencil(moore, False, 1)
+        cells = stencil.cells
         for x in range(self.width):
             for y in range(self.height):
-                pos = (x, y)
-                if self.is_cell_empty(pos):
-                    self._empties.add(pos)
-        self._empties_built = True
+                count = self._translate_stencil(stencil, x, y)
+                if count == 0:
+                    out[x, y] += data[x, y]
+                    continue
+                out[x, y] += data[x, y] * (1 - rate)
+                share = data[x, y] * rate / count
+                for j in range(count):
+                    out[cells[j, 0], cells[j, 1]] += share
+        data[...] = out
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def aggregate_neighborhood(self, str name, str operation, bint moore, bint include_center = False, int radius = 1, positions = None):
+        # sum, mean, max or min of a property layer over the neighborhood of N
+        # positions, or of every cell as a (width, height) array when
+        # positions is None; empty neighborhoods give nan (0 for sum)
+        cdef double[:, :] data
+        cdef long[:, :] pos_view
+        cdef double[:] out
+        cdef long[:, :] cells
+        cdef _Stencil stencil
+        cdef long i, j, n, count, op
+        cdef double acc, value
+        
+        ops = {"sum": 0, "mean": 1, "max": 2, "min": 3}
+        if operation not in ops:
+            raise ValueError(f"Unknown operation {operation}, expected one of {list(ops)}")
+        op = ops[operation]
+        data = np.asarray(self.properties[name].data, dtype=np.float64)
+        if positions is None:
+            xs, ys = np.indices((self.width, self.height), dtype=LONG)
+            pos_view = np.stack([xs.ravel(), ys.ravel()], axis=1)
+        else:
+            pos_view = np.ascontiguousarray(positions, dtype=LONG).reshape(-1, 2)
+        n = pos_view.shape[0]
+        stencil = self._get_stencil(moore, include_center, radius)
+        cells = stencil.cells
+        
+        out_arr = np.empty(n, dtype=np.float64)
+        out = out_arr
+        for i in range(n):
+            count = self._translate_stencil(stencil, pos_view[i, 0], pos_view[i, 1])
+            if count == 0:
+                out[i] = 0 if op == 0 else np.nan
+                continue
+            acc = data[cells[0, 0], cells[0, 1]]
+            for j in range(1, count):
+                value = data[cells[j, 0], cells[j, 1]]
+                if op <= 1:
+                    acc += value
+                elif op == 2:
+                    if value > acc:
+                        acc = value
+                elif value < acc:
+                    acc = value
+            out[i] = acc / count if op == 1 else acc
+        
+        if positions is None:
+            return out_arr.reshape(self.width, self.height)
+        return out_arr
+
+    @property
+    def empties(self):
+        return _Empties(self)
+
+    cdef _init_empties(self):
+        cdef long words = (self.num_cells + 63) // 64
+        cdef long i, j
+        
+        bits = np.full(words, np.iinfo(np.uint64).max, dtype=np.uint64)
+        if self.num_cells % 64:
+            bits[-1] = (<uint64_t>1 << (self.num_cells % 64)) - 1
+        self._empty_bits = bits
+        # linear time Fenwick construction from the word counts
+        tree = np.zeros(words + 1, dtype=LONG)
+        tree[1:] = 64
+        tree[-1] -= 64 * words - self.num_cells
+        self._empty_tree = tree
+        for i in range(1, words + 1):
+            j = i + (i & -i)
+            if j <= words:
+                self._empty_tree[j] += self._empty_tree[i]
+        self._tree_top = 1
+        while 2 * self._tree_top <= words:
+            self._tree_top *= 2
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _update_empty_tree(self, long word, long delta) noexcept nogil:
+        cdef long i = word + 1
+        cdef long size = self._empty_tree.shape[0]
+        while i < size:
+            self._empty_tree[i] += delta
+            i += i & -i
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef long _rank_empty(self, long cell) noexcept nogil:
+        # number of empty cells packed before cell
+        cdef long i = cell >> 6
+        cdef long rank = _popcount(self._empty_bits[i] & ((<uint64_t>1 << (cell & 63)) - 1))
+        while i > 0:
+            rank += self._empty_tree[i]
+            i -= i & -i
+        return rank
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef long _select_empty(self, long rank) noexcept nogil:
+        # packed cell of the empty cell of the given rank, rank < num_empties
+        cdef long word = 0, step = self._tree_top
+        cdef long size = self._empty_tree.shape[0]
+        cdef uint64_t bits
+        
+        while step:
+            if word + step < size and self._empty_tree[word + step] <= rank:
+                word += step
+                rank -= self._empty_tree[word]
+            step >>= 1
+        bits = self._empty_bits[word]
+        while rank:
+            bits &= bits - 1
+            rank -= 1
+        return (word << 6) + _ctz(bits)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline void _set_occupied(self, long x, long y):
+        cdef long cell = x * self.height + y
+        
+        self._occupancy[self._unchecked_offset(x, y)] = 1
+        self._empty_bits[cell >> 6] &= ~(<uint64_t>1 << (cell & 63))
+        self._update_empty_tree(cell >> 6, -1)
+        self.num_empties -= 1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline void _set_empty(self, long x, long y):
+        cdef long cell = x * self.height + y
+        
+        self._occupancy[self._unchecked_offset(x, y)] = 0
+        self._empty_bits[cell >> 6] |= <uint64_t>1 << (cell & 63)
+        self._update_empty_tree(cell >> 6, 1)
+        self.num_empties += 1
+
+    cdef object _cell(self, long x, long y):
+        return self._grid[x][y]
+
+    cdef list _column(self, long x):
+        return self._grid[x]
 
     def __getitem__(self, index):
         
         if isinstance(index, int):
             # grid[x]
-            return self._grid[index]
+            return self._column(range(self.width)[index])
         elif isinstance(index[0], tuple):
             # grid[(x1, y1), (x2, y2), ...]
-            return [self._grid[x][y] for x, y in map(self.torus_adj, index)]
+            return [self._cell(x, y) for x, y in map(self.torus_adj, index)]
         else:
             x, y = index
             x_int, y_int = is_integer(x), is_integer(y)
             if x_int and y_int:
                 # grid[x, y]
                 x, y = self.torus_adj(index)
-                return self._grid[x][y]
+                return self._cell(x, y)
             elif x_int:
                 # grid[x, :]
                 x, _ = self.torus_adj((x, 0))
-                return self._grid[x][y]
+                return self._column(x)[y]
             elif y_int:
                 # grid[:, y]
                 _, y = self.torus_adj((0, y))
-                return [rows[y] for rows in self._grid[x]]
+                return [self._cell(i, y) for i in range(self.width)[x]]
             else:
                 # grid[:, :]
-                return [cell for rows in self._grid[x] for cell in rows[y]]
+                return [cell for i in range(self.width)[x] for cell in self._column(i)[y]]
             
-    cpdef list get_neighborhood(self, object pos, bint moore, bint include_center = False, int radius = 1):
+    cdef _Stencil _get_stencil(self, bint moore, bint include_center, int radius):
+        cdef _Stencil stencil
+        
+        key = (moore, include_center, radius)
+        stencil = self._stencils.get(key)
+        if stencil is None:
+            stencil = self._build_stencil(moore, include_center, radius)
+            self._stencils[key] = stencil
+        return stencil
+
+    cdef _Stencil _build_stencil(self, bint moore, bint include_center, int radius):
+        return _square_stencil(self.width, self.height, self.torus, moore, include_center, radius)
+
+    cdef long _translate_stencil(self, _Stencil stencil, long x, long y):
+        return _translate(stencil, self.width, self.height, self.torus, x, y)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef list _cells_contents(self, long[:, :] cells, long count):
+        cdef list agents = []
+        cdef long i, x, y
+        
+        for i in range(count):
+            x, y = cells[i, 0], cells[i, 1]
+            if self._occupancy[self._unchecked_offset(x, y)]:
+                agents.append(self._grid[x][y])
+        return agents
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef list get_neighborhood(self, object pos, bint moore = True, bint include_center = False, int radius = 1):
         cdef list neighborhood
-        cdef long nx, ny
-        cdef int n, x_radius, y_radius, dx, dy, kx, ky
-        cdef int min_x_range, max_x_range, min_y_range, max_y_range
-        cdef int x, y, count
+        cdef _Stencil stencil
+        cdef long[:, :] cells
+        cdef long x, y, i, count
         
         cache_key = (pos, moore, include_center, radius)
-        neighborhood = self._neighborhood_cache.get(cache_key, None)
+        neighborhood = self.neighborhood_cache.get(cache_key)
         
-        if neighborhood:
+        if neighborhood is not None:
             return neighborhood
         
         x, y = pos
-        count = 0
-        if self.torus:
-            x_max_radius, y_max_radius = self.width // 2, self.height // 2
-            x_radius, y_radius = min(radius, x_max_radius), min(radius, y_max_radius)
-
-            xdim_even, ydim_even = (self.width + 1) % 2, (self.height + 1) % 2
-            kx = 1 if x_radius == x_max_radius and xdim_even else 0
-            ky = 1 if y_radius == y_max_radius and ydim_even else 0
-            
-            n = (2 * x_radius + 1 - kx) * (2 * y_radius + 1 - ky) 
-            neighborhood = [None] * n
-            for dx in range(-x_radius, x_radius + 1 - kx):
-                for dy in range(-y_radius, y_radius + 1 - ky):
-
-                    if not moore and abs(dx) + abs(dy) > radius:
-                        continue
-
-                    nx = (x + dx) % self.width
-                    ny = (y + dy) % self.height
+        stencil = self._get_stencil(moore, include_center, radius)
+        count = self._translate_stencil(stencil, x, y)
+        cells = stencil.cells
+        
+        neighborhood = [None] * count
+        for i in range(count):
+            neighborhood[i] = (cells[i, 0], cells[i, 1])
+        self.neighborhood_cache.put(cache_key, neighborhood)
+        
+        return neighborhood
 
-                    if nx == x and ny == y and not include_center:
-                        continue
-                    
-                    neighborhood[count] = (nx, ny)
-                    count += 1
-        else:
-            min_x_range = max(0, x - radius)
-            max_x_range = min(self.width, x + radius + 1)
-            min_y_range = max(0, y - radius)
-            max_y_range = min(self.height, y + radius + 1)
-            
-            n = (max_x_range-min_x_range) * (max_y_range-min_y_range)
-            neighborhood = [None] * n
-            for nx in range(min_x_range, max_x_range):
-                for ny in range(min_y_range, max_y_range):
+    cdef list get_neighbors_at(self, long x, long y, bint moore, bint include_center, int radius):
+        cdef _Stencil stencil = self._get_stencil(moore, include_center, radius)
+        cdef long count
+        
+        # skipping tiles pays off for neighborhoods spanning several tiles
+        # while most tiles are empty: under a quarter of an occupied cell per
+        # tile on average
+        if (
+            self._count_block and radius >= self._count_block and stencil.variants is None
+            and 4 * (self.num_cells - self.num_empties) * self._count_block * self._count_block < self.num_cells
+        ):
+            return self._indexed_neighbors(stencil, x, y, moore, include_center, radius)
+        count = self._translate_stencil(stencil, x, y)
+        return self._cells_contents(stencil.cells, count)
+
+    cpdef list get_neighbors(self, pos, bint moore = True, bint include_center = False, int radius = 1):
+        cdef long x, y
+        
+        x, y = pos
+        return self.get_neighbors_at(x, y, moore, include_center, radius)
 
-                    if not moore and abs(nx - x) + abs(ny - y) > radius:
-                        continue
+    cdef long _cell_count(self, long x, long y):
+        ...
 
-                    if nx == x and ny == y and not include_center:
-                        continue
+    cdef long _write_cell_slots(self, long x, long y, long* out):
+        ...
 
-                    neighborhood[count] = (nx, ny)
-                    count += 1
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def get_neighbors_batch(self, positions, bint moore, bint include_center = False, int radius = 1):
+        # CSR neighbors of N positions: the agents around positions[i] are
+        # agent_table[slots[offsets[i]:offsets[i + 1]]]
+        cdef long[:, :] pos_view
+        cdef long[:] offsets, slots
+        cdef long[:, :] cells
+        cdef _Stencil stencil
+        cdef long i, j, n, count, total, k
         
-        neighborhood = neighborhood[:count]
-        self._neighborhood_cache[cache_key] = neighborhood
+        pos_view = np.ascontiguousarray(positions, dtype=LONG).reshape(-1, 2)
+        n = pos_view.shape[0]
+        stencil = self._get_stencil(moore, include_center, radius)
+        cells = stencil.cells
         
-        return neighborhood
+        offsets_arr = np.empty(n + 1, dtype=LONG)
+        offsets = offsets_arr
+        offsets[0] = total = 0
+        for i in range(n):
+            count = self._translate_stencil(stencil, pos_view[i, 0], pos_view[i, 1])
+            for j in range(count):
+                total += self._cell_count(cells[j, 0], cells[j, 1])
+            offsets[i + 1] = total
+        
+        # one spare entry so that the buffer pointer is valid when total is 0
+        slots_arr = np.empty(total + 1, dtype=LONG)
+        slots = slots_arr
+        k = 0
+        for i in range(n):
+            count = self._translate_stencil(stencil, pos_view[i, 0], pos_view[i, 1])
+            for j in range(count):
+                k += self._write_cell_slots(cells[j, 0], cells[j, 1], &slots[k])
+        slots_arr = slots_arr[:total]
+        
+        return offsets_arr, slots_arr
+
+    def count_occupied_neighbors_batch(self, positions, bint moore, bint include_center = False, int radius = 1, out = None, num_threads = 1):
+        # number of occupied cells around each of N positions, computed
+        # without the GIL over num_threads threads (1 by default, None for
+        # every core), into out if given
+        cdef const long[:, :] pos_view
+        cdef const long[:, :, :] tables
+        cdef const long[:] sizes
+        cdef long[:] out_view
+        cdef int threads = _thread_count(num_threads)
+        
+        pos_view = np.ascontiguousarray(positions, dtype=LONG).reshape(-1, 2)
+        tables, sizes = _stencil_tables(self._get_stencil(moore, include_center, radius))
+        if out is None:
+            out = np.empty(pos_view.shape[0], dtype=LONG)
+        out_view = out
+        with nogil:
+            _count_occupied_kernel(pos_view, tables, sizes, self._x_offsets, self._y_offsets, self._occupancy,
+                                   self.width, self.height, self.torus, out_view, threads)
+        return out
 
-    cpdef list get_neighbors(self, pos, bint moore, bint include_center = False, int radius = 1):
-        neighbors = self.get_neighborhood(pos, moore, include_center, radius)
-        return self.get_cell_list_contents(neighbors)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def find_empty_neighbors_batch(self, positions, bint moore, bint include_center = False, int radius = 1, out = None, num_threads = 1):
+        # (N, 2) first empty cell, in neighborhood order, around each of N
+        # positions or (-1, -1) when there is none; same threading as
+        # count_occupied_neighbors_batch
+        cdef const long[:, :] pos_view
+        cdef const long[:, :, :] tables
+        cdef const long[:] sizes
+        cdef const long[:] x_offsets = self._x_offsets, y_offsets = self._y_offsets
+        cdef const char[:] occupancy = self._occupancy
+        cdef long[:, :] out_view
+        cdef long i, j, x, y, nx, ny, variant, found_x, found_y
+        cdef long width = self.width, height = self.height
+        cdef bint torus = self.torus
+        cdef int threads = _thread_count(num_threads)
+        
+        pos_view = np.ascontiguousarray(positions, dtype=LONG).reshape(-1, 2)
+        tables, sizes = _stencil_tables(self._get_stencil(moore, include_center, radius))
+        if out is None:
+            out = np.empty((pos_view.shape[0], 2), dtype=LONG)
+        out_view = out
+        
+        for i in prange(pos_view.shape[0], nogil=True, num_threads=threads, schedule="static"):
+            x = pos_view[i, 0]
+            y = pos_view[i, 1]
+            if torus:
+                x = _wrap(x, width)
+                y = _wrap(y, height)
+            variant = _wrap(x, tables.shape[0])
+            found_x = found_y = -1
+            for j in range(sizes[variant]):
+                nx = _stencil_coord(x, tables[variant, j, 0], width, torus)
+                ny = _stencil_coord(y, tables[variant, j, 1], height, torus)
+                if nx >= 0 and ny >= 0:
+                    if not occupancy[x_offsets[nx] + y_offsets[ny]]:
+                        found_x = nx
+                        found_y = ny
+                        break
+            out_view[i, 0] = found_x
+            out_view[i, 1] = found_y
+        return out
 
     cpdef tuple torus_adj(self, pos):
         cdef long x, y
@@ -165,6 +1077,28 @@ cdef class _Grid:
         x, y = pos
         return x < 0 or x >= self.width or y < 0 or y >= self.height
 
+    def torus_adj_batch(self, positions):
+        # (N, 2) copy of N positions wrapped into the grid, see torus_adj
+        return _torus_adj_positions(positions, self.width, self.height, self.torus)
+
+    def out_of_bounds_batch(self, positions):
+        # boolean mask of the positions outside the grid
+        return _out_of_bounds_mask(positions, self.width, self.height)
+
+    def get_heading_batch(self, positions_1, positions_2):
+        # (N, 2) displacements from positions_1 to positions_2 (N positions
+        # or a single one), the shortest way around a torus
+        return _headings(positions_1, positions_2, self.width, self.height, self.torus)
+
+    def get_distance_batch(self, positions_1, positions_2, str metric = "euclidean", num_threads = 1):
+        # N distances between positions_1 and positions_2 (N positions or a
+        # single one): integer "chebyshev" or "manhattan", float "euclidean"
+        return _distances(positions_1, positions_2, False, self.width, self.height, self.torus, metric, num_threads)
+
+    def get_distance_matrix(self, positions_1, positions_2, str metric = "euclidean", num_threads = 1):
+        # (N, M) distances from each of N positions to each of M positions
+        return _distances(positions_1, positions_2, True, self.width, self.height, self.torus, metric, num_threads)
+
     cpdef list get_cell_list_contents(self, cell_list):
         cdef list agents
         cdef long count
@@ -183,18 +1117,264 @@ cdef class _Grid:
                 
         return agents[:count]
 
+    cdef _place(self, agent, long x, long y):
+        # stores agent in (x, y) without any check, nor touching agent.pos
+        ...
+
+    cdef _remove(self, agent, long x, long y):
+        ...
+
+    cdef _check_agents(self, list agents, bint placing):
+        # raises on an agent listed twice in a batch, or already on the grid
+        # when placing
+        cdef set seen = set()
+        for agent in agents:
+            if id(agent) in seen:
+                raise Exception(f"<Agent id: {agent.unique_id}> - listed twice")
+            if placing and agent.pos is not None:
+                raise Exception(f"<Agent id: {agent.unique_id}> - already on the grid")
+            seen.add(id(agent))
+
+    cdef _check_destinations(self, long[:, :] positions, dict leaving):
+        # raises if agents cannot be placed in positions, given that the
+        # agents in the packed cells of leaving, if not None, leave them
+        pass
+
+    cdef long _slot_of(self, agent) except -1:
+        ...
+
+    cdef long _category_of(self, agent) except -2:
+        # -1 when category layers are disabled
+        cdef long category
+        if self._category_attribute is None:
+            return -1
+        category = getattr(agent, self._category_attribute)
+        if category < 0 or category >= self.num_categories:
+            raise ValueError(f"Category {category} not in [0, {self.num_categories})")
+        return category
+
+    cdef _count_category(self, long slot, long category, long x, long y):
+        if category < 0:
+            return
+        if slot >= self._slot_categories.shape[0]:
+            self._slot_categories = np.resize(
+                np.asarray(self._slot_categories), 2 * (slot + 1)
+            )
+        self._slot_categories[slot] = category
+        self._category_counts[self._offset(x, y), category] += 1
+
+    cdef _uncount_category(self, long slot, long x, long y):
+        if self._category_attribute is None:
+            return
+        self._category_counts[self._offset(x, y), self._slot_categories[slot]] -= 1
+
+    cdef _move_category(self, long slot, long x0, long y0, long x1, long y1):
+        cdef int category
+        if self._category_attribute is None:
+            return
+        category = self._slot_categories[slot]
+        self._category_counts[self._offset(x0, y0), category] -= 1
+        self._category_counts[self._offset(x1, y1), category] += 1
+
+    def enable_categories(self, attribute, long num_categories):
+        # counts agents per cell by the integer category in agent.<attribute>,
+        # which must stay in [0, num_categories) while the agent is placed
+        # or be refreshed with update_category
+        cdef long x, y, category, slot
+        
+        self._category_attribute = attribute
+        self.num_categories = num_categories
+        self._category_counts = np.zeros((self._storage_size(), num_categories), dtype=np.intc)
+        self._slot_categories = np.full(len(self._table.agents) + 16, -1, dtype=np.intc)
+        for slot, agent in enumerate(self._table.agents):
+            if agent is not None:
+                x, y = agent.pos
+                category = self._category_of(agent)
+                self._count_category(slot, category, x, y)
+
+    def update_category(self, agent):
+        cdef long x, y, slot, category
+        
+        category = self._category_of(agent)
+        if category < 0 or agent.pos is None:
+            return
+        x, y = agent.pos
+        slot = self._slot_of(agent)
+        self._uncount_category(slot, x, y)
+        self._count_category(slot, category, x, y)
+
+    @property
+    def category_counts(self):
+        if self._category_attribute is None:
+            return None
+        return self._cells_view(self._category_counts)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef long count_neighbors_of_category_at(self, long x, long y, long category, bint moore, bint include_center, int radius) except -1:
+        cdef _Stencil stencil
+        cdef long[:, :] cells
+        cdef long i, count, total
+        
+        if self._category_attribute is None:
+            raise Exception("Category layers are not enabled")
+        stencil = self._get_stencil(moore, include_center, radius)
+        count = self._translate_stencil(stencil, x, y)
+        cells = stencil.cells
+        total = 0
+        for i in range(count):
+            total += self._category_counts[self._unchecked_offset(cells[i, 0], cells[i, 1]), category]
+        return total
+
+    cpdef long count_neighbors_of_category(self, pos, long category, bint moore, bint include_center = False, int radius = 1):
+        cdef long x, y
+        
+        x, y = pos
+        return self.count_neighbors_of_category_at(x, y, category, moore, include_center, radius)
+
+    def count_neighbors_by_category(self, pos, bint moore, bint include_center = False, int radius = 1):
+        return self.count_neighbors_by_category_batch([pos], moore, include_center, radius)[0]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def count_neighbors_by_category_batch(self, positions, bint moore, bint include_center = False, int radius = 1):
+        # (N, num_categories) counts around N positions, or
+        # (width, height, num_categories) for the whole grid when positions is None
+        cdef long[:, :] pos_view
+        cdef int[:, :] out
+        cdef long[:, :] cells
+        cdef _Stencil stencil
+        cdef long i, j, k, n, count, x, y
+        
+        if self._category_attribute is None:
+            raise Exception("Category layers are not enabled")
+        if positions is None:
+            xs, ys = np.indices((self.width, self.height), dtype=LONG)
+            pos_view = np.stack([xs.ravel(), ys.ravel()], axis=1)
+        else:
+            pos_view = np.ascontiguousarray(positions, dtype=LONG).reshape(-1, 2)
+        n = pos_view.shape[0]
+        stencil = self._get_stencil(moore, include_center, radius)
+        cells = stencil.cells
+        
+        out_arr = np.zeros((n, self.num_categories), dtype=np.intc)
+        out = out_arr
+        for i in range(n):
+            count = self._translate_stencil(stencil, pos_view[i, 0], pos_view[i, 1])
+            for j in range(count):
+                x, y = cells[j, 0], cells[j, 1]
+                for k in range(self.num_categories):
+                    out[i, k] += self._category_counts[self._unchecked_offset(x, y), k]
+        
+        if positions is None:
+            return out_arr.reshape(self.width, self.height, self.num_categories)
+        return out_arr
+
     cpdef place_agent(self, agent, pos):
         ...
 
     cpdef remove_agent(self, agent):
         ...
 
+    cdef _positions_array(self, positions):
+        positions = np.array(positions, dtype=LONG).reshape(-1, 2)
+        if self.torus:
+            positions %= (self.width, self.height)
+        elif (
+            (positions < 0).any()
+            or (positions[:, 0] >= self.width).any()
+            or (positions[:, 1] >= self.height).any()
+        ):
+            raise Exception("Point out of bounds, and space non-toroidal.")
+        return positions
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _place_all(self, list agents, long[:, :] positions):
+        cdef long i, x, y
+        for i in range(len(agents)):
+            x, y = positions[i, 0], positions[i, 1]
+            agent = agents[i]
+            self._place(agent, x, y)
+            agent.pos = (x, y)
+
+    def place_agents(self, agents, positions):
+        # all the positions are validated before the first agent is placed
+        if not isinstance(agents, list):
+            agents = list(agents)
+        positions = self._positions_array(positions)
+        if len(agents) != len(positions):
+            raise ValueError("agents and positions must have the same length")
+        self._check_agents(agents, True)
+        self._check_destinations(positions, None)
+        self._place_all(agents, positions)
+
+    def remove_agents(self, agents):
+        cdef long x, y
+        for agent in agents:
+            pos = agent.pos
+            if pos is None:
+                continue
+            x, y = pos
+            self._remove(agent, x, y)
+            agent.pos = None
+
+    def move_agents(self, agents, positions):
+        # agents can move into cells vacated by other agents of the batch;
+        # placed agents go through _move and keep their slots
+        if not isinstance(agents, list):
+            agents = list(agents)
+        positions = self._positions_array(positions)
+        if len(agents) != len(positions):
+            raise ValueError("agents and positions must have the same length")
+        self._check_agents(agents, False)
+        self._move_all(agents, positions)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _move_all(self, list agents, long[:, :] positions):
+        # cells hold any number of agents, so the order does not matter
+        cdef long i, x0, y0, x1, y1
+        for i in range(len(agents)):
+            agent = agents[i]
+            x1, y1 = positions[i, 0], positions[i, 1]
+            if agent.pos is None:
+                self._place(agent, x1, y1)
+            else:
+                x0, y0 = agent.pos
+                self._move(agent, x0, y0, x1, y1)
+            agent.pos = (x1, y1)
+
+    cdef _move(self, agent, long x0, long y0, long x1, long y1):
+        # moves a placed agent from (x0, y0) to (x1, y1), which are in bounds
+        self._remove(agent, x0, y0)
+        self._place(agent, x1, y1)
+
+    cdef _swap(self, agent_a, long xa, long ya, agent_b, long xb, long yb):
+        self._move(agent_a, xa, ya, xb, yb)
+        self._move(agent_b, xb, yb, xa, ya)
+
     cpdef move_agent(self, agent, pos):
-        pos = self.torus_adj(pos)
-        self.remove_agent(agent)
-        self.place_agent(agent, pos)
+        # a single pass over the source and destination cells, the agent
+        # keeps its slot in agent_table
+        cdef long x0, y0, x1, y1
+        
+        source = agent.pos
+        if source is None:
+            self.place_agent(agent, self.torus_adj(pos))
+            return
+        x1, y1 = pos
+        if self.torus:
+            x1, y1 = self.wrap_x(x1), self.wrap_y(y1)
+        elif self.out_of_bounds_at(x1, y1):
+            raise Exception("Point out of bounds, and space non-toroidal.")
+        x0, y0 = source
+        self._move(agent, x0, y0, x1, y1)
+        agent.pos = (x1, y1)
 
     cpdef swap_pos(self, agent_a, agent_b):
+        cdef long xa, ya, xb, yb
+        
         agents_no_pos = []
         pos_a, pos_b = agent_a.pos, agent_b.pos
         if pos_a is None:
@@ -208,68 +1388,705 @@ cdef class _Grid:
         if pos_a == pos_b:
             return
 
-        self.remove_agent(agent_a)
-        self.remove_agent(agent_b)
-
-        self.place_agent(agent_a, pos_b)
-        self.place_agent(agent_b, pos_a)
+        xa, ya = pos_a
+        xb, yb = pos_b
+        self._swap(agent_a, xa, ya, agent_b, xb, yb)
+        agent_a.pos, agent_b.pos = pos_b, pos_a
 
     cpdef bint is_cell_empty(self, pos):
         cdef long x, y
         
         x, y = pos
-        return self._occupancy_matrix[x, y] == 0
+        return self._occupancy[self._offset(x, y)] == 0
 
     cpdef move_to_empty(self, agent, double cutoff = 0.998):
-        cdef long num_empty_cells
+        # cutoff is kept for compatibility with mesa; selecting a uniform rank
+        # among the empty cells, in (x, y) order, draws the same cell as
+        # mesa's agent.random.choice(sorted(empties))
+        cdef long cell
         
-        num_empty_cells = self.num_empties
-        if num_empty_cells == 0:
+        if self.num_empties == 0:
             raise Exception("ERROR: No empty cells")
 
-        if 1 - num_empty_cells / self.num_cells < cutoff:
-            while True:
-                new_pos = (
-                    agent.random.randrange(self.width),
-                    agent.random.randrange(self.height),
-                )
-                if self.is_cell_empty(new_pos):
-                    break
-        else:
-            new_pos = agent.random.choice(sorted(self.empties))
-        self.move_agent(agent, new_pos)
+        cell = self._select_empty(agent.random.randrange(self.num_empties))
+        self.move_agent(agent, (cell // self.height, cell % self.height))
 
     cpdef bint exists_empty_cells(self):
         return self.num_empties > 0
-        
-    def iter_cell_list_contents(self, cell_list) :
-        if len(cell_list) == 2 and isinstance(cell_list, tuple):
-            cell_list = [cell_list]
-        return (self._grid[x][y] for x, y in itertools.filterfalse(self.is_cell_empty, cell_list))
 
-    cpdef iter_neighbors(self, pos, bint moore, bint include_center = False, int radius = 1):
-        neighborhood = self.get_neighborhood(pos, moore, include_center, radius)
-        return self.iter_cell_list_contents(neighborhood)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef long _nearest_cell(self, long x, long y, bint moore, bint include_center, long max_radius,
+                            bint occupied, object predicate) except -2:
+        # packed cell x * height + y of the closest cell around (x, y) that is
+        # occupied (empty if not occupied), by rings of growing Chebyshev
+        # (moore) or Manhattan distance, -1 if there is none within
+        # max_radius (-1 for no limit). Rings are walked by column, dx then
+        # dy increasing, and predicate, if not None, must accept one of the
+        # agents of an occupied cell
+        cdef long r, dx, dy, k, step, nx, ny, limit, far_x, far_y
+        cdef long dx_min, dx_max, dy_min, dy_max
         
-    def __iter__(self):
-        return itertools.chain(*self._grid)
+        far_x = self.width // 2 if self.torus else max(x, self.width - 1 - x)
+        far_y = self.height // 2 if self.torus else max(y, self.height - 1 - y)
+        limit = max(far_x, far_y) if moore else far_x + far_y
+        if max_radius >= 0:
+            limit = min(limit, max_radius)
+        # on a torus the rings are clipped like the stencils, past half the
+        # grid they would wrap back onto cells already visited
+        if self.torus:
+            dx_min, dx_max, dy_min, dy_max = _stencil_bounds(self.width, self.height, True, limit)
+        else:
+            dx_min, dx_max, dy_min, dy_max = -limit, limit, -limit, limit
+        
+        for r in range(0 if include_center else 1, limit + 1):
+            for dx in range(max(-r, dx_min), min(r, dx_max) + 1):
+                nx = x + dx
+                if self.torus:
+                    nx = self.wrap_x(nx)
+                elif nx < 0 or nx >= self.width:
+                    continue
+                # a full column on the sides of a square ring, else the two
+                # cells dy = -k and dy = k
+                k = r if moore else r - (dx if dx >= 0 else -dx)
+                step = 1 if k == 0 or (moore and (dx == -r or dx == r)) else 2 * k
+                dy = -k
+                while dy <= k:
+                    ny = y + dy
+                    dy += step
+                    if ny - y < dy_min or ny - y > dy_max:
+                        continue
+                    if self.torus:
+                        ny = self.wrap_y(ny)
+                    elif ny < 0 or ny >= self.height:
+                        continue
+                    if self._occupancy[self._unchecked_offset(nx, ny)] != occupied:
+                        continue
+                    if predicate is not None and not any(
+                        map(predicate, self.get_cell_list_contents([(nx, ny)]))
+                    ):
+                        continue
+                    return nx * self.height + ny
+        return -1
+
+    def find_nearest_empty(self, pos, max_radius=None, bint moore=True, bint include_center=False):
+        # closest empty cell to pos or None, ties going to the smallest dx
+        # then dy; the search stops at the first ring holding one
+        cdef long x, y, cell
+        
+        x, y = self.torus_adj(pos)
+        if self.num_empties == 0:
+            return None
+        cell = self._nearest_cell(x, y, moore, include_center, -1 if max_radius is None else max_radius, False, None)
+        return None if cell < 0 else (cell // self.height, cell % self.height)
+
+    def find_nearest_agent(self, pos, max_radius=None, bint moore=True, bint include_center=False, predicate=None):
+        # closest agent to pos, among those accepted by predicate if given,
+        # or None; same ring order as find_nearest_empty
+        cdef long x, y, cell
+        
+        x, y = self.torus_adj(pos)
+        if self.num_empties == self.num_cells:
+            return None
+        cell = self._nearest_cell(x, y, moore, include_center, -1 if max_radius is None else max_radius, True, predicate)
+        if cell < 0:
+            return None
+        agents = self.get_cell_list_contents([(cell // self.height, cell % self.height)])
+        return next(filter(predicate, agents)) if predicate is not None else agents[0]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def find_nearest_batch(self, positions, bint empty=True, max_radius=None, bint moore=True, bint include_center=False, out=None):
+        # (N, 2) closest empty (or occupied, empty=False) cell to each of N
+        # positions, (-1, -1) where there is none
+        cdef long[:, :] pos_view, out_view
+        cdef long i, cell
+        cdef long radius = -1 if max_radius is None else max_radius
+        
+        pos_view = self._positions_array(positions)
+        if out is None:
+            out = np.empty((pos_view.shape[0], 2), dtype=LONG)
+        out_view = out
+        for i in range(pos_view.shape[0]):
+            cell = self._nearest_cell(pos_view[i, 0], pos_view[i, 1], moore, include_center, radius, not empty, None)
+            if cell < 0:
+                out_view[i, 0] = out_view[i, 1] = -1
+            else:
+                out_view[i, 0] = cell // self.height
+                out_view[i, 1] = cell % self.height
+        return out
+        
+    def iter_cell_list_contents(self, cell_list) :
+        if len(cell_list) == 2 and isinstance(cell_list, tuple):
+            cell_list = [cell_list]
+        return (self._grid[x][y] for x, y in itertools.filterfalse(self.is_cell_empty, cell_list))
+
+    cpdef iter_neighbors(self, pos, bint moore = True, bint include_center = False, int radius = 1):
+        return iter(self.get_neighbors(pos, moore, include_center, radius))
+        
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._column(x) for x in range(self.width))
 
     def coord_iter(self):
         for row in range(self.width):
+            column = self._column(row)
             for col in range(self.height):
-                yield self._grid[row][col], row, col  # agent, x, y
+                yield column[col], row, col  # agent, x, y
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def coord_arrays(self):
+        # (xs, ys, ids) of every placed agent with its cell, in (x, y) order,
+        # ids being slots in agent_table: a whole-grid scan without coord_iter
+        cdef long[:] cells_view, counts_view, ids_view
+        cdef long i, x, y, k, total = 0
+        
+        cells = np.flatnonzero(self.occupancy.reshape(-1))
+        cells_view = cells
+        counts = np.empty(len(cells), dtype=LONG)
+        counts_view = counts
+        for i in range(cells_view.shape[0]):
+            x, y = cells_view[i] // self.height, cells_view[i] % self.height
+            counts_view[i] = self._cell_count(x, y)
+            total += counts_view[i]
+        
+        ids = np.empty(total + 1, dtype=LONG)
+        ids_view = ids
+        k = 0
+        for i in range(cells_view.shape[0]):
+            x, y = cells_view[i] // self.height, cells_view[i] % self.height
+            k += self._write_cell_slots(x, y, &ids_view[k])
+        
+        cells = np.repeat(cells, counts)
+        return cells // self.height, cells % self.height, ids[:total]
+
+    def enable_journal(self, long capacity = 1024):
+        # records every place, remove and move from now on, see journal
+        if self._journal_size < 0:
+            self._journal = np.empty((max(capacity, 1), 6), dtype=LONG)
+            self._journal_size = 0
+
+    def disable_journal(self):
+        self._journal = None
+        self._journal_size = -1
+
+    cdef _grow_journal(self):
+        self._journal = np.resize(np.asarray(self._journal), (2 * self._journal.shape[0], 6))
+
+    @property
+    def journal(self):
+        # read-only (events, 6) view of the events since the last
+        # reset_journal: event (JournalEvent), slot in agent_table, then the
+        # source and destination cells, -1 where there is none. Swaps are
+        # two moves. None while the journal is disabled
+        if self._journal_size < 0:
+            return None
+        view = np.asarray(self._journal)[:self._journal_size]
+        view.flags.writeable = False
+        return view
+
+    def reset_journal(self):
+        # to call once the journal has been read, the buffer is reused
+        if self._journal_size > 0:
+            self._journal_size = 0
+
+    def enable_count_index(self, long block = 8):
+        # agent counts per block x block tile, to skip the empty tiles of large
+        # neighborhoods and regions, plus a 2D Fenwick tree of the cell counts
+        # for count_agents_in_region; both follow every place, remove and move
+        cdef long x, y
+        
+        if block < 1:
+            raise ValueError("block must be positive")
+        counts = np.zeros((self.width, self.height), dtype=LONG)
+        for x in range(self.width):
+            for y in range(self.height):
+                counts[x, y] = self._cell_count(x, y)
+        
+        padded = np.zeros((-(-self.width // block) * block, -(-self.height // block) * block), dtype=LONG)
+        padded[:self.width, :self.height] = counts
+        self._block_counts = padded.reshape(
+            padded.shape[0] // block, block, padded.shape[1] // block, block
+        ).sum(axis=(1, 3)).astype(np.intc)
+        # linear time Fenwick construction from the prefix sums
+        prefix = np.zeros((self.width + 1, self.height + 1), dtype=LONG)
+        prefix[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+        xs = np.arange(self.width + 1)
+        ys = np.arange(self.height + 1)
+        xs_low, ys_low = xs - (xs & -xs), ys - (ys & -ys)
+        tree = prefix - prefix[xs_low] - prefix[:, ys_low] + prefix[np.ix_(xs_low, ys_low)]
+        self._count_tree = tree.astype(np.intc)
+        # a wrapped range of rows crosses at most height // block + 2 tiles
+        self._tile_spans = np.empty((self.height // block + 3, 4), dtype=LONG)
+        self._count_block = block
+
+    def disable_count_index(self):
+        self._count_block = 0
+        self._block_counts = None
+        self._count_tree = None
+        self._tile_spans = None
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void _index_add(self, long x, long y, int delta) noexcept nogil:
+        cdef long i = x + 1, j
+        cdef long rows = self._count_tree.shape[0], columns = self._count_tree.shape[1]
+        
+        self._block_counts[x // self._count_block, y // self._count_block] += delta
+        while i < rows:
+            j = y + 1
+            while j < columns:
+                self._count_tree[i, j] += delta
+                j += j & -j
+            i += i & -i
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef long _count_prefix(self, long x, long y) noexcept nogil:
+        # number of agents in the cells [0, x) x [0, y)
+        cdef long i = x, j
+        cdef long total = 0
+        
+        while i > 0:
+            j = y
+            while j > 0:
+                total += self._count_tree[i, j]
+                j -= j & -j
+            i -= i & -i
+        return total
+
+    cdef long _count_rect(self, long x, long y, long columns, long rows):
+        return (
+            self._count_prefix(x + columns, y + rows) - self._count_prefix(x, y + rows)
+            - self._count_prefix(x + columns, y) + self._count_prefix(x, y)
+        )
+
+    cdef tuple _region_range(self, long start, long stop, long size):
+        # (start, length) of the inclusive range [start, stop] of one axis,
+        # clipped on a bounded grid. On a torus the range goes upwards from
+        # start to stop, wrapping, and covers the whole axis when
+        # stop - start + 1 >= size
+        if self.torus:
+            if stop - start + 1 >= size:
+                return _wrap(start, size), size
+            return _wrap(start, size), _wrap(stop - start, size) + 1
+        start, stop = max(start, 0), min(stop, size - 1)
+        return start, max(stop - start + 1, 0)
+
+    def count_agents_in_region(self, long x0, long y0, long x1, long y1):
+        # agents in the cells x0 <= x <= x1, y0 <= y <= y1, wrapped around the
+        # edges of a torus (see _region_range)
+        cdef long x, y, columns, rows, total
+        
+        if not self._count_block:
+            raise Exception("Count index is not enabled")
+        x, columns = self._region_range(x0, x1, self.width)
+        y, rows = self._region_range(y0, y1, self.height)
+        if not columns or not rows:
+            return 0
+        # the torus splits the region in up to four rectangles
+        total = 0
+        for x, columns in ((x, min(columns, self.width - x)), (0, x + columns - self.width)):
+            if columns <= 0:
+                continue
+            total += self._count_rect(x, y, columns, min(rows, self.height - y))
+            if y + rows > self.height:
+                total += self._count_rect(x, 0, columns, y + rows - self.height)
+        return total
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef long _split_tiles(self, long y, long length):
+        # cuts the rows y, y + 1, ..., y + length - 1, wrapped, at the tile
+        # boundaries into _tile_spans as (first row, row past the end, index
+        # in the range of the first row); returns the number of spans
+        cdef long n = 0, offset = 0, stop, end
+        
+        while length > 0:
+            stop = min(y + length, self.height)
+            length -= stop - y
+            while y < stop:
+                end = min((y // self._count_block + 1) * self._count_block, stop)
+                self._tile_spans[n, 0] = y
+                self._tile_spans[n, 1] = end
+                self._tile_spans[n, 2] = offset
+                offset += end - y
+                n += 1
+                y = end
+            y = 0
+        return n
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef long _flag_tiles(self, long x, long n):
+        # lists in _tile_spans[:, 3] the spans of _split_tiles falling in the
+        # occupied tiles of column x; returns their number
+        cdef long i, m = 0, bx = x // self._count_block
+        
+        for i in range(n):
+            if self._block_counts[bx, self._tile_spans[i, 0] // self._count_block]:
+                self._tile_spans[m, 3] = i
+                m += 1
+        return m
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef long _tile_cells(self, long x, long m, long low, long high, long skip, long[:, :] cells, long count):
+        # appends to cells[count:] the cells (x, y) of the m listed spans
+        # whose index in the range is within [low, high], in order, but index skip
+        cdef long k, i, y, first, last, offset
+        
+        for k in range(m):
+            i = self._tile_spans[k, 3]
+            offset = self._tile_spans[i, 2] - self._tile_spans[i, 0]
+            first = max(self._tile_spans[i, 0], low - offset)
+            last = min(self._tile_spans[i, 1], high + 1 - offset)
+            for y in range(first, last):
+                if y + offset != skip:
+                    cells[count, 0] = x
+                    cells[count, 1] = y
+                    count += 1
+        return count
+
+    @cython.cdivision(True)
+    cdef list _indexed_neighbors(self, _Stencil stencil, long x, long y, bint moore, bint include_center, int radius):
+        # same cells and order as the square stencil, skipping the empty tiles
+        cdef long[:, :] cells = stencil.cells
+        cdef long dx_min, dx_max, dy_min, dy_max, dx, nx, n, m = 0, bx = -1, low, high, count = 0
+        
+        dx_min, dx_max, dy_min, dy_max = _stencil_bounds(self.width, self.height, self.torus, radius)
+        if self.torus:
+            x, y = _wrap(x, self.width), _wrap(y, self.height)
+        else:
+            dx_min, dx_max = max(dx_min, -x), min(dx_max, self.width - 1 - x)
+            dy_min, dy_max = max(dy_min, -y), min(dy_max, self.height - 1 - y)
+        n = self._split_tiles(_wrap(y + dy_min, self.height), dy_max - dy_min + 1)
+        for dx in range(dx_min, dx_max + 1):
+            nx = _wrap(x + dx, self.width)
+            if nx // self._count_block != bx:
+                bx = nx // self._count_block
+                m = self._flag_tiles(nx, n)
+            if not m:
+                continue
+            low, high = 0, dy_max - dy_min
+            if not moore:
+                low, high = max(low, abs(dx) - radius - dy_min), min(high, radius - abs(dx) - dy_min)
+            count = self._tile_cells(nx, m, low, high, -dy_min if dx == 0 and not include_center else -1, cells, count)
+        return self._cells_contents(cells, count)
+
+    @cython.cdivision(True)
+    def get_agents_in_region(self, long x0, long y0, long x1, long y1):
+        # agents in the region of count_agents_in_region, column by column,
+        # skipping the empty tiles
+        cdef long x, y, columns, rows, i, n, m = 0, nx, bx = -1, count
+        cdef list agents = []
+        cdef long[:, :] cells
+        
+        if not self._count_block:
+            raise Exception("Count index is not enabled")
+        x, columns = self._region_range(x0, x1, self.width)
+        y, rows = self._region_range(y0, y1, self.height)
+        if not columns or not rows:
+            return agents
+        cells = np.empty((rows, 2), dtype=LONG)
+        n = self._split_tiles(y, rows)
+        for i in range(columns):
+            nx = _wrap(x + i, self.width)
+            if nx // self._count_block != bx:
+                bx = nx // self._count_block
+                m = self._flag_tiles(nx, n)
+            if not m:
+                continue
+            count = self._tile_cells(nx, m, 0, rows - 1, -1, cells, 0)
+            if count:
+                agents.extend(self._cells_contents(cells, count))
+        return agents
+
+    cdef dict _state_arrays(self):
+        # storage arrays written as is by save_state
+        arrays = {
+            "x_offsets": np.asarray(self._x_offsets),
+            "y_offsets": np.asarray(self._y_offsets),
+            "occupancy": np.asarray(self._occupancy),
+            "ids": np.asarray(self._ids),
+            "empty_bits": np.asarray(self._empty_bits),
+            "empty_tree": np.asarray(self._empty_tree),
+        }
+        if self._category_attribute is not None:
+            arrays["category_counts"] = np.asarray(self._category_counts)
+            arrays["slot_categories"] = np.asarray(self._slot_categories)
+        return arrays
+
+    cdef _restore_arrays(self, dict arrays):
+        self._x_offsets = arrays["x_offsets"]
+        self._y_offsets = arrays["y_offsets"]
+        self._occupancy = arrays["occupancy"]
+        self._ids = arrays["ids"]
+        self._empty_bits = arrays["empty_bits"]
+        self._empty_tree = arrays["empty_tree"]
+        if self._category_attribute is not None:
+            self._category_counts = arrays["category_counts"]
+            self._slot_categories = arrays["slot_categories"]
+
+    cdef _restore_agent(self, agent, long slot, long x, long y):
+        # puts back the Python side of an agent whose cell is already in the
+        # restored arrays
+        ...
+
+    def save_state(self, path):
+        # checkpoint of the grid in the directory path: one .npy file per
+        # storage array, so that loading is bounded by disk bandwidth, plus
+        # grid.json. Agents are stored by their integer unique_id
+        cdef list table = self._table.agents
+        
+        os.makedirs(path, exist_ok=True)
+        arrays = self._state_arrays()
+        arrays["unique_ids"] = np.array(
+            [-1 if agent is None else agent.unique_id for agent in table], dtype=np.int64
+        )
+        arrays["free_slots"] = np.array(self._table._free, dtype=LONG)
+        xs, ys, slots = self.coord_arrays()
+        arrays["agent_cells"] = np.stack([xs, ys, slots], axis=1)
+        for name, layer in self.properties.items():
+            arrays["property_" + name] = layer.data
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), array, allow_pickle=False)
+        
+        meta = {
+            "class": type(self).__name__,
+            "width": self.width,
+            "height": self.height,
+            "torus": self.torus,
+            "layout": self.layout,
+            "num_empties": self.num_empties,
+            "category_attribute": self._category_attribute,
+            "num_categories": self.num_categories,
+            "properties": list(self.properties),
+            "arrays": list(arrays),
+        }
+        with open(os.path.join(path, "grid.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load_state(cls, path, agents, mmap_mode=None, remap=None):
+        # grid saved by save_state, agents mapping the saved unique ids to the
+        # agent objects, which get their pos back. remap, when given, turns
+        # the array of saved unique ids into the ids to look up. With
+        # mmap_mode "c" (copy on write) or "r+" (writing back to the files)
+        # the arrays are memory maps instead of being read upfront
+        cdef _Grid grid
+        cdef PropertyLayer layer
+        cdef list table
+        cdef long[:, :] cells
+        cdef long i, slot
+        
+        if mmap_mode not in (None, "c", "r+"):
+            raise ValueError("mmap_mode must be None, 'c' or 'r+', the grid writes to its arrays")
+        with open(os.path.join(path, "grid.json")) as f:
+            meta = json.load(f)
+        if meta["class"] != cls.__name__:
+            raise ValueError(f"State saved by {meta['class']}, not {cls.__name__}")
+        arrays = {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode, allow_pickle=False)
+            for name in meta["arrays"]
+        }
+        
+        # the storage arrays come from the files, only the Python cell lists
+        # of the list backends are built
+        grid = cls.__new__(cls)
+        grid._init_fields(meta["width"], meta["height"], meta["torus"], meta["layout"])
+        grid._init_cells()
+        grid.neighborhood_cache = NeighborhoodCache()
+        grid.num_empties = meta["num_empties"]
+        grid._category_attribute = meta["category_attribute"]
+        grid.num_categories = meta["num_categories"]
+        grid._restore_arrays(arrays)
+        grid._tree_top = 1
+        while 2 * grid._tree_top < grid._empty_tree.shape[0]:
+            grid._tree_top *= 2
+        for name in meta["properties"]:
+            layer = PropertyLayer.__new__(PropertyLayer)
+            layer.name = name
+            layer.width = grid.width
+            layer.height = grid.height
+            layer.data = arrays["property_" + name]
+            grid.properties[name] = layer
+        
+        unique_ids = arrays["unique_ids"]
+        if remap is not None:
+            unique_ids = np.where(unique_ids == -1, -1, remap(unique_ids))
+        table = [None if uid == -1 else agents[uid] for uid in unique_ids.tolist()]
+        grid._table.agents = table
+        grid._table._free = arrays["free_slots"].tolist()
+        cells = np.ascontiguousarray(arrays["agent_cells"], dtype=LONG)
+        for i in range(cells.shape[0]):
+            slot = cells[i, 2]
+            agent = table[slot]
+            grid._restore_agent(agent, slot, cells[i, 0], cells[i, 1])
+            agent.pos = (cells[i, 0], cells[i, 1])
+        return grid
 
 cdef class SingleGrid(_Grid):
 
+    @property
+    def agent_ids(self):
+        # slot in agent_table of the agent in each cell, -1 for empty cells
+        return self._cells_view(self._ids)
+
+    def agent_array(self, index=Ellipsis):
+        # object array of the agents, None in empty cells, of grid[index] for
+        # any NumPy index over (width, height); only the occupied cells of the
+        # selection touch Python objects
+        cdef list table = self._table.agents
+        
+        ids = self.agent_ids[index]
+        out = np.full(np.shape(ids), None, dtype=object)
+        occupied = ids >= 0
+        slots = ids[occupied]
+        out[occupied] = np.fromiter([table[slot] for slot in slots.tolist()], dtype=object, count=len(slots))
+        return out
+
+    def coord_arrays(self):
+        cells = np.flatnonzero(self.occupancy.reshape(-1))
+        return cells // self.height, cells % self.height, self.agent_ids.reshape(-1)[cells]
+
+    cdef _restore_agent(self, agent, long slot, long x, long y):
+        self._grid[x][y] = agent
+
+    cdef _place(self, agent, long x, long y):
+        cdef long category = self._category_of(agent)
+        cdef long slot = self._table.add(agent)
+        self._set_occupied(x, y)
+        self._ids[self._offset(x, y)] = slot
+        self._grid[x][y] = agent
+        self._count_category(slot, category, x, y)
+        self._record(PLACE, slot, -1, -1, x, y)
+
+    cdef _remove(self, agent, long x, long y):
+        cdef long slot = self._ids[self._offset(x, y)]
+        self._uncount_category(slot, x, y)
+        self._set_empty(x, y)
+        self._table.release(slot)
+        self._ids[self._offset(x, y)] = -1
+        self._grid[x][y] = self.default_val()
+        self._record(REMOVE, slot, x, y, -1, -1)
+
+    cdef long _slot_of(self, agent) except -1:
+        cdef long x, y
+        x, y = agent.pos
+        return self._ids[self._offset(x, y)]
+
+    cdef _move(self, agent, long x0, long y0, long x1, long y1):
+        cdef long source = self._offset(x0, y0)
+        cdef long target = self._offset(x1, y1)
+        cdef long slot = self._ids[source]
+        
+        if source == target:
+            return
+        if self._occupancy[target]:
+            raise Exception("Cell not empty")
+        self._set_empty(x0, y0)
+        self._set_occupied(x1, y1)
+        self._ids[target] = slot
+        self._ids[source] = -1
+        self._move_category(slot, x0, y0, x1, y1)
+        if self._grid is not None:
+            # the empty value of the destination goes back to the source
+            self._grid[x0][y0], self._grid[x1][y1] = self._grid[x1][y1], agent
+        self._record(MOVE, slot, x0, y0, x1, y1)
+
+    cdef _swap(self, agent_a, long xa, long ya, agent_b, long xb, long yb):
+        # both cells stay occupied, only their slots trade places
+        cdef long a = self._offset(xa, ya)
+        cdef long b = self._offset(xb, yb)
+        cdef long slot_a = self._ids[a]
+        cdef long slot_b = self._ids[b]
+        
+        self._ids[a] = slot_b
+        self._ids[b] = slot_a
+        self._move_category(slot_a, xa, ya, xb, yb)
+        self._move_category(slot_b, xb, yb, xa, ya)
+        if self._grid is not None:
+            self._grid[xa][ya] = agent_b
+            self._grid[xb][yb] = agent_a
+        self._record(MOVE, slot_a, xa, ya, xb, yb)
+        self._record(MOVE, slot_b, xb, yb, xa, ya)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _check_destinations(self, long[:, :] positions, dict leaving):
+        # only the cells of the batch are tracked, packed as x * height + y
+        cdef set taken = set()
+        cdef long i, x, y, cell
+        
+        for i in range(positions.shape[0]):
+            x, y = positions[i, 0], positions[i, 1]
+            cell = x * self.height + y
+            if cell in taken or (
+                self._occupancy[self._unchecked_offset(x, y)] and (leaving is None or cell not in leaving)
+            ):
+                raise Exception("Cell not empty")
+            taken.add(cell)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _move_all(self, list agents, long[:, :] positions):
+        # an agent moves once the agent leaving its destination, if any, has
+        # moved: each chain of moves runs from its end, and a cycle, where the
+        # last agent moves into the cell of the first, by swaps
+        cdef long n = len(agents)
+        cdef long[:, :] sources = np.full((n, 2), -1, dtype=LONG)
+        cdef char[:] done = np.zeros(n, dtype=np.int8)
+        # packed source cell -> index of the agent leaving it
+        cdef dict leaving = {}
+        cdef list chain
+        cdef long i, j, k, x, y
+        
+        for i in range(n):
+            pos = agents[i].pos
+            if pos is not None:
+                x, y = pos
+                sources[i, 0], sources[i, 1] = x, y
+                leaving[x * self.height + y] = i
+        self._check_destinations(positions, leaving)
+        
+        for i in range(n):
+            if done[i]:
+                continue
+            chain = [i]
+            j = leaving.get(positions[i, 0] * self.height + positions[i, 1], -1)
+            while j >= 0 and j != i and not done[j]:
+                chain.append(j)
+                j = leaving.get(positions[j, 0] * self.height + positions[j, 1], -1)
+            if j == i:
+                # the first agent travels around the cycle, each swap leaves
+                # the agent it meets in its destination
+                for k in range(1, len(chain)):
+                    j = chain[k]
+                    self._swap(agents[chain[k - 1]], sources[i, 0], sources[i, 1], agents[j], sources[j, 0], sources[j, 1])
+            else:
+                for k in reversed(chain):
+                    x, y = positions[k, 0], positions[k, 1]
+                    if sources[k, 0] < 0:
+                        self._place(agents[k], x, y)
+                    else:
+                        self._move(agents[k], sources[k, 0], sources[k, 1], x, y)
+            for k in chain:
+                done[k] = True
+                agents[k].pos = (positions[k, 0], positions[k, 1])
+
     cpdef place_agent(self, agent, pos):
         cdef long x, y
-        if self.is_cell_empty(pos):
+        x, y = pos
+        # the empty-cell bitset is indexed by x * height + y, unchecked
+        if self.out_of_bounds_at(x, y):
+            pos = self.torus_adj(pos)
             x, y = pos
-            self._occupancy_matrix[x, y] = 1
-            self.num_empties -= 1
-            self._grid[x][y] = agent
-            if self._empties_built:
-                self._empties.discard(pos)
+        if self.is_cell_empty_at(x, y):
+            self._place(agent, x, y)
             agent.pos = pos
         else:
             raise Exception("Cell not empty")
@@ -280,41 +2097,186 @@ cdef class SingleGrid(_Grid):
         if pos is None:
             return
         x, y = pos
-        self._occupancy_matrix[x, y] = 0
-        self.num_empties += 1
-        self._grid[x][y] = self.default_val()
-        if self._empties_built:
-            self._empties.add(pos)
+        self._remove(agent, x, y)
         agent.pos = None
 
+    cdef long _cell_count(self, long x, long y):
+        return self._occupancy[self._offset(x, y)]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def get_neighbors_batch(self, positions, bint moore, bint include_center = False, int radius = 1, num_threads = 1):
+        # at most one agent per cell: a single pass over a buffer sized for
+        # full neighborhoods is enough
+        cdef long[:, :] pos_view
+        cdef long[:] offsets, slots
+        cdef long[:, :] cells
+        cdef _Stencil stencil
+        cdef long i, j, n, count, k, x, y
+        cdef int threads = _thread_count(num_threads)
+        
+        pos_view = np.ascontiguousarray(positions, dtype=LONG).reshape(-1, 2)
+        n = pos_view.shape[0]
+        stencil = self._get_stencil(moore, include_center, radius)
+        cells = stencil.cells
+        if threads > 1:
+            return self._neighbors_batch_parallel(pos_view, stencil, threads)
+        
+        offsets_arr = np.empty(n + 1, dtype=LONG)
+        slots_arr = np.empty(n * stencil.size, dtype=LONG)
+        offsets = offsets_arr
+        slots = slots_arr
+        offsets[0] = k = 0
+        for i in range(n):
+            count = self._translate_stencil(stencil, pos_view[i, 0], pos_view[i, 1])
+            for j in range(count):
+                x, y = cells[j, 0], cells[j, 1]
+                if self._occupancy[self._unchecked_offset(x, y)]:
+                    slots[k] = self._ids[self._unchecked_offset(x, y)]
+                    k += 1
+            offsets[i + 1] = k
+        
+        return offsets_arr, slots_arr[:k].copy()
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _neighbors_batch_parallel(self, const long[:, :] positions, _Stencil stencil, int threads):
+        # counts first so that every thread knows where its slots go
+        cdef const long[:, :, :] tables
+        cdef const long[:] sizes
+        cdef const long[:] x_offsets = self._x_offsets, y_offsets = self._y_offsets
+        cdef const char[:] occupancy = self._occupancy
+        cdef const long[:] ids = self._ids
+        cdef long[:] offsets, slots
+        cdef long i, j, k, x, y, nx, ny, variant, cell
+        cdef long n = positions.shape[0], width = self.width, height = self.height
+        cdef bint torus = self.torus
+        
+        tables, sizes = _stencil_tables(stencil)
+        offsets_arr = np.zeros(n + 1, dtype=LONG)
+        offsets = offsets_arr
+        with nogil:
+            _count_occupied_kernel(positions, tables, sizes, x_offsets, y_offsets, occupancy,
+                                   width, height, torus, offsets[1:], threads)
+        np.cumsum(offsets_arr, out=offsets_arr)
+        
+        slots_arr = np.empty(offsets[n], dtype=LONG)
+        slots = slots_arr
+        for i in prange(n, nogil=True, num_threads=threads, schedule="static"):
+            x = positions[i, 0]
+            y = positions[i, 1]
+            if torus:
+                x = _wrap(x, width)
+                y = _wrap(y, height)
+            variant = _wrap(x, tables.shape[0])
+            k = offsets[i]
+            for j in range(sizes[variant]):
+                nx = _stencil_coord(x, tables[variant, j, 0], width, torus)
+                ny = _stencil_coord(y, tables[variant, j, 1], height, torus)
+                if nx >= 0 and ny >= 0:
+                    cell = x_offsets[nx] + y_offsets[ny]
+                    if occupancy[cell]:
+                        slots[k] = ids[cell]
+                        k = k + 1
+        return offsets_arr, slots_arr
+
 
 cdef class MultiGrid(_Grid):
 
+    def __init__(self, long width, long height, bint torus, **kwargs):
+        super().__init__(width, height, torus, **kwargs)
+        self._counts = np.zeros(self._storage_size(), dtype=np.intc)
+
+    cdef _init_fields(self, long width, long height, bint torus, str layout):
+        _Grid._init_fields(self, width, height, torus, layout)
+        self._slots = {}
+
+    @property
+    def counts(self):
+        return self._cells_view(self._counts)
+
     cpdef default_val(self):
         return []
 
+    cdef _place(self, agent, long x, long y):
+        cdef long category = self._category_of(agent)
+        cdef long slot
+        if self._occupancy[self._offset(x, y)] == 0:
+            self._set_occupied(x, y)
+        self._grid[x][y].append(agent)
+        self._counts[self._offset(x, y)] += 1
+        if id(agent) in self._slots:
+            slot = self._slots[id(agent)]
+        else:
+            slot = self._slots[id(agent)] = self._table.add(agent)
+        self._count_category(slot, category, x, y)
+        self._record(PLACE, slot, -1, -1, x, y)
+
+    cdef _remove(self, agent, long x, long y):
+        cdef long slot = self._slots.pop(id(agent))
+        self._uncount_category(slot, x, y)
+        self._grid[x][y].remove(agent)
+        self._counts[self._offset(x, y)] -= 1
+        self._table.release(slot)
+        if self._counts[self._offset(x, y)] == 0:
+            self._set_empty(x, y)
+        self._record(REMOVE, slot, x, y, -1, -1)
+
+    cdef long _slot_of(self, agent) except -1:
+        return self._slots[id(agent)]
+
+    cdef _move(self, agent, long x0, long y0, long x1, long y1):
+        cdef long source = self._offset(x0, y0)
+        cdef long target = self._offset(x1, y1)
+        cdef long slot
+        
+        if source == target:
+            return
+        slot = self._slots[id(agent)]
+        self._move_contents(agent, x0, y0, x1, y1)
+        self._counts[source] -= 1
+        if self._counts[source] == 0:
+            self._set_empty(x0, y0)
+        if self._counts[target] == 0:
+            self._set_occupied(x1, y1)
+        self._counts[target] += 1
+        self._move_category(slot, x0, y0, x1, y1)
+        self._record(MOVE, slot, x0, y0, x1, y1)
+
+    cdef _move_contents(self, agent, long x0, long y0, long x1, long y1):
+        self._grid[x0][y0].remove(agent)
+        self._grid[x1][y1].append(agent)
+
+    cdef dict _state_arrays(self):
+        arrays = _Grid._state_arrays(self)
+        arrays["counts"] = np.asarray(self._counts)
+        return arrays
+
+    cdef _restore_arrays(self, dict arrays):
+        _Grid._restore_arrays(self, arrays)
+        self._counts = arrays["counts"]
+
+    cdef _restore_agent(self, agent, long slot, long x, long y):
+        self._grid[x][y].append(agent)
+        self._slots[id(agent)] = slot
+
     cpdef place_agent(self, agent, pos):
         cdef long x, y
         x, y = pos
+        if self.out_of_bounds_at(x, y):
+            pos = self.torus_adj(pos)
+            x, y = pos
         if agent.pos is None or agent not in self._grid[x][y]:
-            if self.is_cell_empty(pos):
-                self._occupancy_matrix[x, y] = 1
-                self.num_empties -= 1
-            self._grid[x][y].append(agent)
+            self._place(agent, x, y)
             agent.pos = pos
-            if self._empties_built:
-                self._empties.discard(pos)
 
     cpdef remove_agent(self, agent):
         cdef long x, y
         pos = agent.pos
+        if pos is None:
+            return
         x, y = pos
-        self._grid[x][y].remove(agent)
-        if self.is_cell_empty(pos):
-            self.num_empties += 1
-            self._occupancy_matrix[x, y] = 0
-            if self._empties_built:
-                self._empties.add(pos)
+        self._remove(agent, x, y)
         agent.pos = None
     
     cpdef list get_cell_list_contents(self, cell_list):
@@ -336,6 +2298,31 @@ cdef class MultiGrid(_Grid):
                 
         return agents
     
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef list _cells_contents(self, long[:, :] cells, long count):
+        cdef list agents = []
+        cdef long i, x, y
+        
+        for i in range(count):
+            x, y = cells[i, 0], cells[i, 1]
+            if self._occupancy[self._unchecked_offset(x, y)]:
+                agents.extend(self._grid[x][y])
+        return agents
+
+    cdef long _cell_count(self, long x, long y):
+        if self._occupancy[self._offset(x, y)]:
+            return len(self._grid[x][y])
+        return 0
+
+    cdef long _write_cell_slots(self, long x, long y, long* out):
+        cdef long k = 0
+        if self._occupancy[self._offset(x, y)]:
+            for agent in self._grid[x][y]:
+                out[k] = self._slots[id(agent)]
+                k += 1
+        return k
+    
     def iter_cell_list_contents(self, cell_list):
         if len(cell_list) == 2 and isinstance(cell_list, tuple):
             cell_list = [cell_list]
@@ -345,222 +2332,1337 @@ cdef class MultiGrid(_Grid):
                 x, y = pos
                 for content in self._grid[x][y]:
                     yield content
-                    
-                    
-cdef class _Grid_memviews:
-    def __init__(self, long width, long height, bint torus):
-        self.height = height
-        self.width = width
-        self.torus = torus
-        self.num_cells = height * width
-        self.num_empties = self.num_cells
 
-        self._ids_grid = np.full((self.width, self.height), self._default_val_ids(), dtype=long)
-        self._agents_grid = np.full((self.width, self.height), self.default_val(), dtype=object)
-        
-        # Neighborhood caches
-        self._neighborhood_cache_py = {}
-        self._neighborhood_cache_cy = {}
 
-    cpdef long _default_val_ids(self):
-        return -1
-    
-    cpdef default_val(self):
-        return None
-    
-    # TODO: we need fused types for pos arg for fast execution
+cdef class IdSingleGrid(SingleGrid):
+    # SingleGrid backend without per-cell Python lists: the id matrix is the
+    # occupancy test and agents are looked up in the agent table
+
+    cdef _init_cells(self):
+        self._grid = None
+
+    cdef _restore_agent(self, agent, long slot, long x, long y):
+        pass
+
+    cdef object _cell(self, long x, long y):
+        cdef long slot = self._ids[self._offset(x, y)]
+        if slot < 0:
+            return None
+        return self._table.agents[slot]
+
+    cdef list _column(self, long x):
+        cdef long y
+        return [self._cell(x, y) for y in range(self.height)]
+
     cpdef bint is_cell_empty(self, pos):
         cdef long x, y
+        
+        x, y = pos
+        return self._ids[self._offset(x, y)] < 0
+
+    cdef _place(self, agent, long x, long y):
+        cdef long category = self._category_of(agent)
+        cdef long slot = self._table.add(agent)
+        self._set_occupied(x, y)
+        self._ids[self._offset(x, y)] = slot
+        self._count_category(slot, category, x, y)
+        self._record(PLACE, slot, -1, -1, x, y)
+
+    cdef _remove(self, agent, long x, long y):
+        cdef long slot = self._ids[self._offset(x, y)]
+        self._uncount_category(slot, x, y)
+        self._set_empty(x, y)
+        self._table.release(slot)
+        self._ids[self._offset(x, y)] = -1
+        self._record(REMOVE, slot, x, y, -1, -1)
 
-        x, y = pos[0], pos[1]
-        return self._ids_grid[x, y] == self._default_val_ids()
+    cpdef list get_cell_list_contents(self, cell_list):
+        cdef list agents
+        cdef long x, y, slot
+        
+        if len(cell_list) == 2 and isinstance(cell_list, tuple):
+            cell_list = [cell_list]
+        
+        agents = []
+        for pos in cell_list:
+            x, y = pos
+            slot = self._ids[self._offset(x, y)]
+            if slot >= 0:
+                agents.append(self._table.agents[slot])
+        return agents
 
-    cpdef place_agent(self, agent, pos):
-        cdef long x, y, agent_id
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef list _cells_contents(self, long[:, :] cells, long count):
+        cdef list agents = []
+        cdef list table = self._table.agents
+        cdef long i, slot
+        
+        for i in range(count):
+            slot = self._ids[self._unchecked_offset(cells[i, 0], cells[i, 1])]
+            if slot >= 0:
+                agents.append(table[slot])
+        return agents
 
-        if self.is_cell_empty(pos):
-            x, y = pos[0], pos[1]
-            agent_id = agent.unique_id
-            self._ids_grid[x, y] = agent_id
-            self._agents_grid[x, y] = agent
-            agent.pos = pos
-            self.num_empties -= 1
-        else:
-            raise Exception("Cell not empty")
-            
-    cpdef remove_agent(self, agent):
-        cdef long x, y, agent_id
-        if (pos := agent.pos) is None:
+    def iter_cell_list_contents(self, cell_list):
+        return iter(self.get_cell_list_contents(cell_list))
+
+
+cdef class CompactMultiGrid(MultiGrid):
+    # MultiGrid backend without per-cell Python lists: every cell is a
+    # circular doubly linked list of agent_table slots, _ids holds the head
+    # slot of each cell (-1 when empty) and _next / _prev link the slots
+
+    cdef long[:] _next
+    cdef long[:] _prev
+
+    cdef _init_cells(self):
+        self._grid = None
+        self._next = np.empty(16, dtype=LONG)
+        self._prev = np.empty(16, dtype=LONG)
+
+    cdef dict _state_arrays(self):
+        arrays = MultiGrid._state_arrays(self)
+        arrays["next"] = np.asarray(self._next)
+        arrays["prev"] = np.asarray(self._prev)
+        return arrays
+
+    cdef _restore_arrays(self, dict arrays):
+        MultiGrid._restore_arrays(self, arrays)
+        self._next = arrays["next"]
+        self._prev = arrays["prev"]
+
+    cdef _restore_agent(self, agent, long slot, long x, long y):
+        self._slots[id(agent)] = slot
+
+    cdef _reserve(self, long slot):
+        cdef long capacity = self._next.shape[0]
+        if slot < capacity:
             return
-        x, y = pos
-        self._ids_grid[x][y] = self._default_val_ids()
-        self._agents_grid[x][y] = self.default_val()
-        self.num_empties += 1
-        agent.pos = None
+        while capacity <= slot:
+            capacity *= 2
+        self._next = np.resize(np.asarray(self._next), capacity)
+        self._prev = np.resize(np.asarray(self._prev), capacity)
 
-    @cython.wraparound(False)
     @cython.boundscheck(False)
-    cpdef object[:] get_cell_mview_contents(self, long[:, :] tuples_mview):
-        cdef long default_val
-        cdef int count
-        cdef object[:] agent_mview
-        cdef long x, y
-
-        length = len(tuples_mview)
-        agent_mview = np.ndarray(length, object)
-        count = 0
-        default_val = self._default_val_ids()
-        for i in range(length):
-            x, y = tuples_mview[i, 0], tuples_mview[i, 1]
-            id_agent = self._ids_grid[x, y]
-            if id_agent == default_val:
-                continue
-            agent_mview[count] = self._agents_grid[x, y]
-            count += 1
-        return agent_mview[:count]
- 
     @cython.wraparound(False)
-    @cython.boundscheck(False)   
-    cpdef long[:, :] convert_tuples_to_mview(self, object cell_list):
-        cdef long x, y
-        cdef long[:, :] tuples_mview
+    cdef _link(self, long x, long y, long slot):
+        cdef long head = self._ids[self._unchecked_offset(x, y)]
+        cdef long tail
+        
+        if head < 0:
+            self._ids[self._unchecked_offset(x, y)] = slot
+            self._next[slot] = self._prev[slot] = slot
+        else:
+            tail = self._prev[head]
+            self._next[tail] = slot
+            self._prev[slot] = tail
+            self._next[slot] = head
+            self._prev[head] = slot
 
-        length = len(cell_list)
-        tuples_mview = np.ndarray((length, 2), long)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _unlink(self, long x, long y, long slot):
+        cdef long nxt = self._next[slot]
+        cdef long prv = self._prev[slot]
+        
+        if nxt == slot:
+            self._ids[self._unchecked_offset(x, y)] = -1
+        else:
+            self._next[prv] = nxt
+            self._prev[nxt] = prv
+            if self._ids[self._unchecked_offset(x, y)] == slot:
+                self._ids[self._unchecked_offset(x, y)] = nxt
+
+    cdef object _cell(self, long x, long y):
+        cdef list agents = []
+        cdef list table = self._table.agents
+        cdef long head = self._ids[self._offset(x, y)]
+        cdef long slot = head
+        
+        if head < 0:
+            return agents
+        while True:
+            agents.append(table[slot])
+            slot = self._next[slot]
+            if slot == head:
+                return agents
+
+    cdef list _column(self, long x):
+        cdef long y
+        return [self._cell(x, y) for y in range(self.height)]
+
+    cdef _place(self, agent, long x, long y):
+        cdef long category = self._category_of(agent)
+        cdef long slot
+        if id(agent) in self._slots:
+            # an agent links a single cell, placing it again moves it
+            self.remove_agent(agent)
+        if self._occupancy[self._offset(x, y)] == 0:
+            self._set_occupied(x, y)
+        slot = self._table.add(agent)
+        self._reserve(slot)
+        self._link(x, y, slot)
+        self._slots[id(agent)] = slot
+        self._counts[self._offset(x, y)] += 1
+        self._count_category(slot, category, x, y)
+        self._record(PLACE, slot, -1, -1, x, y)
+
+    cdef _remove(self, agent, long x, long y):
+        cdef long slot = self._slots.pop(id(agent))
+        self._uncount_category(slot, x, y)
+        self._unlink(x, y, slot)
+        self._table.release(slot)
+        self._counts[self._offset(x, y)] -= 1
+        if self._counts[self._offset(x, y)] == 0:
+            self._set_empty(x, y)
+        self._record(REMOVE, slot, x, y, -1, -1)
+
+    cdef _move_contents(self, agent, long x0, long y0, long x1, long y1):
+        cdef long slot = self._slots[id(agent)]
+        self._unlink(x0, y0, slot)
+        self._link(x1, y1, slot)
 
-        for i in range(length):
-            pos = cell_list[i]
-            x, y = pos[0], pos[1]
-            tuples_mview[i, 0], tuples_mview[i, 1] = x, y
+    cpdef place_agent(self, agent, pos):
+        cdef long x, y
+        x, y = pos
+        if self.out_of_bounds_at(x, y):
+            pos = self.torus_adj(pos)
+            x, y = pos
+        if agent.pos == pos and id(agent) in self._slots:
+            return
+        self._place(agent, x, y)
+        agent.pos = pos
 
-        return tuples_mview
-    
+    @cython.boundscheck(False)
     @cython.wraparound(False)
-    @cython.boundscheck(False) 
-    cpdef list convert_agent_mview_to_list(self, object[:] agent_mview):
+    cdef int _append_cell(self, long x, long y, list agents) except -1:
+        # appends the agents of (x, y) to agents, in cell order
+        cdef list table = self._table.agents
+        cdef long head = self._ids[self._unchecked_offset(x, y)]
+        cdef long slot = head
         
-        length = len(agent_mview)
-        agent_list = [0] * length
+        if head < 0:
+            return 0
+        while True:
+            agents.append(table[slot])
+            slot = self._next[slot]
+            if slot == head:
+                return 0
+
+    cpdef list get_cell_list_contents(self, cell_list):
+        cdef list agents
+        cdef long x, y
         
-        for i in range(length):
-            agent_list[i] = agent_mview[i]
+        if len(cell_list) == 2 and isinstance(cell_list, tuple):
+            cell_list = [cell_list]
         
-        return agent_list
-    
-    cpdef get_cell_list_contents(self, object cell_list):
-    
-        tuples_mview = self.convert_tuples_to_mview(cell_list)
-        agent_mview = self.get_cell_mview_contents(tuples_mview)
-        return self.convert_agent_mview_to_list(agent_mview)
+        agents = []
+        for pos in cell_list:
+            x, y = pos
+            self._append_cell(x, y, agents)
+        return agents
 
-    @cython.wraparound(False)
     @cython.boundscheck(False)
-    cpdef long[:, :] compute_neighborhood(self, object pos, bint moore, int radius, bint include_center):
+    @cython.wraparound(False)
+    cdef list _cells_contents(self, long[:, :] cells, long count):
+        cdef list agents = []
+        cdef long i
         
-        cdef long[:, :] neighborhood
-        cdef long nx, ny
-        cdef int x_radius, y_radius, dx, dy, kx, ky
-        cdef int min_x_range, max_x_range, min_y_range, max_y_range
-        cdef int x, y, count
+        for i in range(count):
+            self._append_cell(cells[i, 0], cells[i, 1], agents)
+        return agents
 
-        neighborhood = np.empty(((radius*2+1)**2, 2), long)
-        x, y = pos[0], pos[1]
-        count = 0
-        if self.torus:
+    def iter_cell_list_contents(self, cell_list):
+        return iter(self.get_cell_list_contents(cell_list))
 
-            x_max_radius, y_max_radius = self.width // 2, self.height // 2
-            x_radius, y_radius = min(radius, x_max_radius), min(radius, y_max_radius)
+    cdef long _cell_count(self, long x, long y):
+        return self._counts[self._offset(x, y)]
 
-            xdim_even, ydim_even = (self.width + 1) % 2, (self.height + 1) % 2
-            kx = 1 if x_radius == x_max_radius and xdim_even else 0
-            ky = 1 if y_radius == y_max_radius and ydim_even else 0
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef long _write_cell_slots(self, long x, long y, long* out):
+        cdef long head = self._ids[self._unchecked_offset(x, y)]
+        cdef long slot = head
+        cdef long k = 0
+        
+        if head < 0:
+            return 0
+        while True:
+            out[k] = slot
+            k += 1
+            slot = self._next[slot]
+            if slot == head:
+                return k
+
+
+cdef class _SparseGrid:
+    # grid keeping only its occupied cells, in an open addressing hash table
+    # (linear probing, backward shift deletion) keyed by x * height + y, so
+    # memory follows the number of agents rather than width * height.
+    # Neighborhood queries probe the stencil cells or scan the table,
+    # whichever is shorter. Keys are 64 bits wide, long is 32 bits on Windows
+
+    cdef readonly long height, width, num_occupied
+    cdef readonly int64_t num_cells
+    cdef readonly bint torus
+    cdef _AgentTable _table
+    cdef int64_t[:] _keys
+    cdef long[:] _values
+    cdef long _mask
+    cdef int _shift
+    cdef readonly NeighborhoodCache neighborhood_cache
+    cdef dict _stencils
+
+    def __init__(self, long width, long height, bint torus, cache_size=None, cache_cells=None):
+        self.height = height
+        self.width = width
+        self.torus = torus
+        self.num_cells = <int64_t>height * width
+        self.num_occupied = 0
+        self._table = _AgentTable()
+        self._allocate(16)
+        self.neighborhood_cache = NeighborhoodCache(cache_size, cache_cells)
+        self._stencils = {}
 
-            for dx in range(-x_radius, x_radius + 1 - kx):
-                for dy in range(-y_radius, y_radius + 1 - ky):
+    cpdef default_val(self):
+        return None
 
-                    if not moore and abs(dx) + abs(dy) > radius:
-                        continue
+    @property
+    def agent_table(self):
+        return self._table.agents
 
-                    nx = (x + dx) % self.width
-                    ny = (y + dy) % self.height
+    @property
+    def capacity(self):
+        return self._keys.shape[0]
 
-                    if nx == x and ny == y and not include_center:
-                        continue
+    @property
+    def num_empties(self):
+        return self.num_cells - self.num_occupied
 
-                    neighborhood[count, 0] = nx
-                    neighborhood[count, 1] = ny
-                    count += 1
-        else:
-            min_x_range = max(0, x - radius)
-            max_x_range = min(self.width, x + radius + 1)
-            min_y_range = max(0, y - radius)
-            max_y_range = min(self.height, y + radius + 1)
+    cdef _allocate(self, long capacity):
+        self._keys = np.full(capacity, -1, dtype=np.int64)
+        self._values = np.empty(capacity, dtype=LONG)
+        self._mask = capacity - 1
+        self._shift = 65 - capacity.bit_length()
 
-            for nx in range(min_x_range, max_x_range):
-                for ny in range(min_y_range, max_y_range):
+    cdef inline int64_t _key(self, long x, long y):
+        return <int64_t>x * self.height + y
 
-                    if not moore and abs(nx - x) + abs(ny - y) > radius:
-                        continue
+    cdef inline long _home(self, int64_t key):
+        # fibonacci hashing, the top bits of the product index the table
+        return <long>((<uint64_t>key * 11400714819323198485ULL) >> self._shift)
 
-                    if nx == x and ny == y and not include_center:
-                        continue
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef long _find(self, int64_t key):
+        cdef long i = self._home(key)
+        while self._keys[i] != key:
+            if self._keys[i] < 0:
+                return -1
+            i = (i + 1) & self._mask
+        return i
+
+    cdef inline long _lookup(self, long x, long y):
+        # value stored for the cell, -1 if it is empty
+        cdef long i = self._find(self._key(x, y))
+        return self._values[i] if i >= 0 else -1
 
-                    neighborhood[count, 0] = nx
-                    neighborhood[count, 1] = ny
-                    count += 1
-        
-        return neighborhood[:count]
-        
-    cpdef long[:, :] get_neighborhood_mview(self, object pos, bint moore, int radius, bint include_center):
-    
-        cache_key = (pos, moore, include_center, radius)
-        cached_neighborhood = self._neighborhood_cache_cy.get(cache_key, None)
-        
-        if cached_neighborhood is not None:
-            return cached_neighborhood
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _store(self, int64_t key, long value):
+        cdef long i
         
-        neighborhood = self.compute_neighborhood(pos, moore, radius, include_center)
+        if 2 * (self.num_occupied + 1) > self._keys.shape[0]:
+            self._grow()
+        i = self._home(key)
+        while self._keys[i] != key and self._keys[i] >= 0:
+            i = (i + 1) & self._mask
+        if self._keys[i] < 0:
+            self._keys[i] = key
+            self.num_occupied += 1
+        self._values[i] = value
+
+    cdef _grow(self):
+        cdef int64_t[:] keys = self._keys
+        cdef long[:] values = self._values
+        cdef long i
         
-        self._neighborhood_cache_cy[cache_key] = neighborhood
+        self._allocate(2 * keys.shape[0])
+        self.num_occupied = 0
+        for i in range(keys.shape[0]):
+            if keys[i] >= 0:
+                self._store(keys[i], values[i])
 
-        return neighborhood
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _discard(self, int64_t key):
+        cdef long i = self._find(key), j, home
         
-    cpdef list get_neighborhood(self, object pos, bint moore, int radius, bint include_center):
-    
-        cache_key = (pos, moore, include_center, radius)
-        cached_neighborhood = self._neighborhood_cache_py.get(cache_key, None)
+        if i < 0:
+            return
+        j = i
+        while True:
+            j = (j + 1) & self._mask
+            if self._keys[j] < 0:
+                break
+            # entries whose home is cyclically in (i, j] must stay put
+            home = self._home(self._keys[j])
+            if (i < j and (home <= i or home > j)) or (j < i and home <= i and home > j):
+                self._keys[i] = self._keys[j]
+                self._values[i] = self._values[j]
+                i = j
+        self._keys[i] = -1
+        self.num_occupied -= 1
+
+    cdef _append_value(self, long value, list agents):
+        ...
+
+    cdef object _cell(self, long x, long y):
+        ...
+
+    cpdef place_agent(self, agent, pos):
+        ...
+
+    cpdef remove_agent(self, agent):
+        ...
+
+    cpdef move_agent(self, agent, pos):
+        pos = self.torus_adj(pos)
+        self.remove_agent(agent)
+        self.place_agent(agent, pos)
+
+    cpdef move_to_empty(self, agent, double cutoff = 0.998):
+        # rejection sampling, cheap as long as the grid is mostly empty
+        cdef long x, y
         
-        if cached_neighborhood is not None:
-            return cached_neighborhood
+        if self.num_occupied == self.num_cells:
+            raise Exception("ERROR: No empty cells")
+        while True:
+            x = agent.random.randrange(self.width)
+            y = agent.random.randrange(self.height)
+            if self._find(self._key(x, y)) < 0:
+                break
+        self.move_agent(agent, (x, y))
+
+    cpdef bint exists_empty_cells(self):
+        return self.num_occupied < self.num_cells
+
+    cpdef bint is_cell_empty(self, pos):
+        cdef long x, y
+        x, y = pos
+        return self._find(self._key(x, y)) < 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def occupied_cells(self):
+        # (N, 2) array of the occupied positions, in table order
+        keys = np.asarray(self._keys)
+        keys = keys[keys >= 0]
+        return np.stack([keys // self.height, keys % self.height], axis=1)
+
+    cpdef tuple torus_adj(self, pos):
+        cdef long x, y
+        if not self.out_of_bounds(pos):
+            return pos
+        elif not self.torus:
+            raise Exception("Point out of bounds, and space non-toroidal.")
+        else:
+            x, y = pos
+            return x % self.width, y % self.height
+
+    cpdef bint out_of_bounds(self, pos):
+        cdef long x, y
+        x, y = pos
+        return x < 0 or x >= self.width or y < 0 or y >= self.height
+
+    def torus_adj_batch(self, positions):
+        # (N, 2) copy of N positions wrapped into the grid, see torus_adj
+        return _torus_adj_positions(positions, self.width, self.height, self.torus)
+
+    def out_of_bounds_batch(self, positions):
+        # boolean mask of the positions outside the grid
+        return _out_of_bounds_mask(positions, self.width, self.height)
+
+    def get_heading_batch(self, positions_1, positions_2):
+        # (N, 2) displacements from positions_1 to positions_2 (N positions
+        # or a single one), the shortest way around a torus
+        return _headings(positions_1, positions_2, self.width, self.height, self.torus)
+
+    def get_distance_batch(self, positions_1, positions_2, str metric = "euclidean", num_threads = 1):
+        # N distances between positions_1 and positions_2 (N positions or a
+        # single one): integer "chebyshev" or "manhattan", float "euclidean"
+        return _distances(positions_1, positions_2, False, self.width, self.height, self.torus, metric, num_threads)
+
+    def get_distance_matrix(self, positions_1, positions_2, str metric = "euclidean", num_threads = 1):
+        # (N, M) distances from each of N positions to each of M positions
+        return _distances(positions_1, positions_2, True, self.width, self.height, self.torus, metric, num_threads)
+
+    def __getitem__(self, index):
+        cdef long x, y
+        if isinstance(index, tuple) and len(index) == 2 and is_integer(index[0]) and is_integer(index[1]):
+            x, y = self.torus_adj(index)
+            return self._cell(x, y)
+        # slices would walk width * height cells, only lists of cells are supported
+        return [self._cell(x, y) for x, y in map(self.torus_adj, index)]
+
+    cdef _Stencil _get_stencil(self, bint moore, bint include_center, int radius):
+        cdef _Stencil stencil
         
-        cdef list neighborhood_list
+        key = (moore, include_center, radius)
+        stencil = self._stencils.get(key)
+        if stencil is None:
+            stencil = _square_stencil(self.width, self.height, self.torus, moore, include_center, radius)
+            self._stencils[key] = stencil
+        return stencil
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef list get_neighborhood(self, object pos, bint moore, bint include_center = False, int radius = 1):
+        cdef list neighborhood
+        cdef _Stencil stencil
+        cdef long[:, :] cells
+        cdef long x, y, i, count
+        
+        cache_key = (pos, moore, include_center, radius)
+        neighborhood = self.neighborhood_cache.get(cache_key)
+        
+        if neighborhood is not None:
+            return neighborhood
         
-        neighborhood = self.compute_neighborhood(pos, moore, radius, include_center)
+        x, y = pos
+        stencil = self._get_stencil(moore, include_center, radius)
+        count = _translate(stencil, self.width, self.height, self.torus, x, y)
+        cells = stencil.cells
         
-        count = len(neighborhood)
-        neighborhood_list = [0] * count
+        neighborhood = [None] * count
         for i in range(count):
-            neighborhood_list[i] = (neighborhood[i, 0], neighborhood[i, 1])
+            neighborhood[i] = (cells[i, 0], cells[i, 1])
+        self.neighborhood_cache.put(cache_key, neighborhood)
         
-        self._neighborhood_cache_py[cache_key] = neighborhood_list
+        return neighborhood
 
-        return neighborhood_list
-    
-    cpdef object[:] get_neighbors_mview(self, object pos, bint moore, int radius, bint include_center):
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef list get_neighbors(self, pos, bint moore, bint include_center = False, int radius = 1):
+        cdef list agents = []
+        cdef list found
+        cdef _Stencil stencil
+        cdef long[:, :] cells
+        cdef long x, y, i, count, dx, dy, value, span
+        cdef int64_t key
+        cdef long dx_min, dx_max, dy_min, dy_max
+        
+        x, y = pos
+        dx_min, dx_max, dy_min, dy_max = _stencil_bounds(self.width, self.height, self.torus, radius)
+        span = dy_max - dy_min + 1
+        if (dx_max - dx_min + 1) * span <= self._keys.shape[0]:
+            stencil = self._get_stencil(moore, include_center, radius)
+            cells = stencil.cells
+            count = _translate(stencil, self.width, self.height, self.torus, x, y)
+            for i in range(count):
+                value = self._lookup(cells[i, 0], cells[i, 1])
+                if value >= 0:
+                    self._append_value(value, agents)
+            return agents
+        
+        # fewer table entries than stencil cells: test every occupied cell
+        # and sort the hits back into stencil order
+        if self.torus:
+            x, y = x % self.width, y % self.height
+        found = []
+        for i in range(self._keys.shape[0]):
+            key = self._keys[i]
+            if key < 0:
+                continue
+            dx = key // self.height - x
+            dy = key % self.height - y
+            if self.torus:
+                dx = (dx - dx_min) % self.width + dx_min
+                dy = (dy - dy_min) % self.height + dy_min
+            if dx < dx_min or dx > dx_max or dy < dy_min or dy > dy_max:
+                continue
+            if not moore and abs(dx) + abs(dy) > radius:
+                continue
+            if dx == 0 and dy == 0 and not include_center:
+                continue
+            found.append(((dx - dx_min) * span + dy - dy_min, self._values[i]))
+        found.sort()
+        for _, value in found:
+            self._append_value(value, agents)
+        return agents
+
+    cpdef iter_neighbors(self, pos, bint moore, bint include_center = False, int radius = 1):
+        return iter(self.get_neighbors(pos, moore, include_center, radius))
+
+    cpdef list get_cell_list_contents(self, cell_list):
+        cdef list agents = []
+        cdef long x, y, value
         
-        neighborhood_mview = self.get_neighborhood_mview(pos, moore, radius, include_center)
-        return self.get_cell_mview_contents(neighborhood_mview)
+        if len(cell_list) == 2 and isinstance(cell_list, tuple):
+            cell_list = [cell_list]
+        for x, y in cell_list:
+            value = self._lookup(x, y)
+            if value >= 0:
+                self._append_value(value, agents)
+        return agents
+
+    def iter_cell_list_contents(self, cell_list):
+        return iter(self.get_cell_list_contents(cell_list))
+
+
+cdef class SparseSingleGrid(_SparseGrid):
+
+    cdef _append_value(self, long value, list agents):
+        agents.append(self._table.agents[value])
+
+    cdef object _cell(self, long x, long y):
+        cdef long value = self._lookup(x, y)
+        return self._table.agents[value] if value >= 0 else None
+
+    cpdef place_agent(self, agent, pos):
+        cdef long x, y
+        # off-grid keys would alias other cells or the empty-slot marker
+        if self.out_of_bounds(pos):
+            pos = self.torus_adj(pos)
+        x, y = pos
+        if self._find(self._key(x, y)) >= 0:
+            raise Exception("Cell not empty")
+        self._store(self._key(x, y), self._table.add(agent))
+        agent.pos = pos
+
+    cpdef remove_agent(self, agent):
+        cdef long x, y
+        pos = agent.pos
+        if pos is None:
+            return
+        x, y = pos
+        self._table.release(self._lookup(x, y))
+        self._discard(self._key(x, y))
+        agent.pos = None
+
+
+cdef class SparseMultiGrid(_SparseGrid):
+    # the table stores the first slot of each cell, the agents of a cell are
+    # linked in placement order as in CompactMultiGrid
+
+    cdef dict _slots
+    cdef long[:] _next
+    cdef long[:] _prev
+
+    def __init__(self, long width, long height, bint torus, **kwargs):
+        super().__init__(width, height, torus, **kwargs)
+        self._slots = {}
+        self._next = np.empty(16, dtype=LONG)
+        self._prev = np.empty(16, dtype=LONG)
+
+    cpdef default_val(self):
+        return []
+
+    cdef _reserve(self, long slot):
+        cdef long capacity = self._next.shape[0]
+        if slot < capacity:
+            return
+        while capacity <= slot:
+            capacity *= 2
+        self._next = np.resize(np.asarray(self._next), capacity)
+        self._prev = np.resize(np.asarray(self._prev), capacity)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _append_value(self, long head, list agents):
+        cdef list table = self._table.agents
+        cdef long slot = head
+        
+        while True:
+            agents.append(table[slot])
+            slot = self._next[slot]
+            if slot == head:
+                return
+
+    cdef object _cell(self, long x, long y):
+        cdef list agents = []
+        cdef long head = self._lookup(x, y)
+        if head >= 0:
+            self._append_value(head, agents)
+        return agents
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef place_agent(self, agent, pos):
+        cdef long x, y, slot, head, tail
+        
+        if self.out_of_bounds(pos):
+            pos = self.torus_adj(pos)
+        if id(agent) in self._slots:
+            if agent.pos == pos:
+                return
+            self.remove_agent(agent)
+        x, y = pos
+        slot = self._slots[id(agent)] = self._table.add(agent)
+        self._reserve(slot)
+        head = self._lookup(x, y)
+        if head < 0:
+            self._store(self._key(x, y), slot)
+            self._next[slot] = self._prev[slot] = slot
+        else:
+            tail = self._prev[head]
+            self._next[tail] = slot
+            self._prev[slot] = tail
+            self._next[slot] = head
+            self._prev[head] = slot
+        agent.pos = pos
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef remove_agent(self, agent):
+        cdef long x, y, slot, nxt, prv
+        
+        pos = agent.pos
+        if pos is None:
+            return
+        x, y = pos
+        slot = self._slots.pop(id(agent))
+        nxt, prv = self._next[slot], self._prev[slot]
+        if nxt == slot:
+            self._discard(self._key(x, y))
+        else:
+            self._next[prv] = nxt
+            self._prev[nxt] = prv
+            if self._lookup(x, y) == slot:
+                self._store(self._key(x, y), nxt)
+        self._table.release(slot)
+        agent.pos = None
+
+
+cdef list _hex_offsets(long x0, int radius, bint include_center, long width, long height, bint torus):
+    # offsets of the cells at most radius steps from (x0, 0), searched breadth
+    # first like mesa's _HexGrid on the wrapped grid when torus, otherwise on
+    # the unbounded plane (clipping its translations gives the same cells)
+    cdef set seen = {(x0, 0)}
+    cdef list frontier = [(x0, 0)]
+    cdef list found, offsets = []
+    
+    for _ in range(radius):
+        found = []
+        for x, y in frontier:
+            dy = 1 if x % 2 == 0 else -1
+            for cell in ((x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y), (x - 1, y + dy), (x + 1, y + dy)):
+                if torus:
+                    cell = (cell[0] % width, cell[1] % height)
+                if cell not in seen:
+                    seen.add(cell)
+                    found.append(cell)
+        frontier = found
+    if not include_center:
+        seen.discard((x0, 0))
+    
+    for x, y in seen:
+        dx, dy = x - x0, y
+        if torus:
+            dx = (dx + width // 2) % width - width // 2
+            dy = (dy + height // 2) % height - height // 2
+        offsets.append((dx, dy))
+    return sorted(offsets)
+
+
+cdef _Stencil _hex_stencil(_Grid grid, bint include_center, int radius):
+    # one offset table per column parity, shifting by an even number of
+    # columns keeps the layout. Wrapping an odd number of columns breaks the
+    # parity, so those tori get one table per column
+    cdef _Stencil stencil = _Stencil(), variant
+    cdef long x0, period = grid.width if grid.torus and grid.width % 2 else 2
+    
+    if not grid.torus:
+        radius = min(radius, grid.width + grid.height)
+    stencil.variants = []
+    stencil.size = 0
+    for x0 in range(period):
+        variant = _Stencil()
+        variant.offsets = np.array(_hex_offsets(x0, radius, include_center, grid.width, grid.height, grid.torus), dtype=LONG).reshape(-1, 2)
+        variant.size = variant.offsets.shape[0]
+        stencil.variants.append(variant)
+        stencil.size = max(stencil.size, variant.size)
+    
+    stencil.offsets = np.empty((0, 2), dtype=LONG)
+    stencil.cells = np.empty((stencil.size, 2), dtype=LONG)
+    for variant in stencil.variants:
+        variant.cells = stencil.cells
+    return stencil
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef list _hex_neighborhood(_Grid grid, object pos, bint include_center, int radius):
+    cdef list neighborhood
+    cdef _Stencil stencil
+    cdef long[:, :] cells
+    cdef long x, y, i, count
+    
+    cache_key = (pos, include_center, radius)
+    neighborhood = grid.neighborhood_cache.get(cache_key)
+    if neighborhood is not None:
+        return neighborhood
     
-    cpdef list get_neighbors(self, object pos, bint moore, int radius, bint include_center):
+    x, y = pos
+    stencil = grid._get_stencil(True, include_center, radius)
+    count = grid._translate_stencil(stencil, x, y)
+    cells = stencil.cells
     
-        neighbors_mview = self.get_neighbors_mview(pos, moore, radius, include_center)
-        return self.convert_agent_mview_to_list(neighbors_mview)
+    neighborhood = [None] * count
+    for i in range(count):
+        neighborhood[i] = (cells[i, 0], cells[i, 1])
+    # cells come in sorted order unless the torus wrapped them
+    if grid.torus:
+        neighborhood.sort()
+    grid.neighborhood_cache.put(cache_key, neighborhood)
+    return neighborhood
+
+
+cdef class HexSingleGrid(SingleGrid):
+    # SingleGrid with the hexagonal neighborhoods of mesa's HexSingleGrid: the
+    # diagonal neighbors of even columns are a row up (y + 1), those of odd
+    # columns a row down (y - 1). The neighborhood methods take mesa's
+    # (pos, include_center, radius), which cannot override the cpdef square
+    # grid methods, so they wrap hex_neighborhood / hex_neighbors for the C
+    # level; called with the square grid arguments from C, the inherited
+    # methods still walk the hexagonal stencils and ignore moore.
+    # get_neighbors follows the sorted neighborhood except across the edges
+    # of a torus
+
+    cdef _Stencil _build_stencil(self, bint moore, bint include_center, int radius):
+        return _hex_stencil(self, include_center, radius)
+
+    cpdef list hex_neighborhood(self, object pos, bint include_center = False, int radius = 1):
+        return _hex_neighborhood(self, pos, include_center, radius)
+
+    cpdef list hex_neighbors(self, object pos, bint include_center = False, int radius = 1):
+        cdef long x, y
+        
+        x, y = pos
+        return self.get_neighbors_at(x, y, True, include_center, radius)
+
+    def get_neighborhood(self, pos, bint include_center = False, int radius = 1):
+        return self.hex_neighborhood(pos, include_center, radius)
+
+    def iter_neighborhood(self, pos, bint include_center = False, int radius = 1):
+        return iter(self.hex_neighborhood(pos, include_center, radius))
+
+    def get_neighbors(self, pos, bint include_center = False, int radius = 1):
+        return self.hex_neighbors(pos, include_center, radius)
+
+    def iter_neighbors(self, pos, bint include_center = False, int radius = 1):
+        return iter(self.hex_neighbors(pos, include_center, radius))
+
+    def neighbor_iter(self, pos):
+        return iter(self.hex_neighbors(pos, False, 1))
+
+
+cdef class HexMultiGrid(MultiGrid):
+    # MultiGrid with the hexagonal neighborhoods of HexSingleGrid
+
+    cdef _Stencil _build_stencil(self, bint moore, bint include_center, int radius):
+        return _hex_stencil(self, include_center, radius)
+
+    cpdef list hex_neighborhood(self, object pos, bint include_center = False, int radius = 1):
+        return _hex_neighborhood(self, pos, include_center, radius)
+
+    cpdef list hex_neighbors(self, object pos, bint include_center = False, int radius = 1):
+        cdef long x, y
+        
+        x, y = pos
+        return self.get_neighbors_at(x, y, True, include_center, radius)
+
+    def get_neighborhood(self, pos, bint include_center = False, int radius = 1):
+        return self.hex_neighborhood(pos, include_center, radius)
+
+    def iter_neighborhood(self, pos, bint include_center = False, int radius = 1):
+        return iter(self.hex_neighborhood(pos, include_center, radius))
+
+    def get_neighbors(self, pos, bint include_center = False, int radius = 1):
+        return self.hex_neighbors(pos, include_center, radius)
+
+    def iter_neighbors(self, pos, bint include_center = False, int radius = 1):
+        return iter(self.hex_neighbors(pos, include_center, radius))
+
+    def neighbor_iter(self, pos):
+        return iter(self.hex_neighbors(pos, False, 1))
+
+
+cdef class ContinuousSpace:
+    # mesa.space.ContinuousSpace backed by a uniform bucket grid: each agent
+    # is linked into the bucket holding its position, so radius queries only
+    # walk the buckets overlapping the query circle instead of every agent.
+    # cell_size is a lower bound on the bucket side, buckets are stretched
+    # to tile the space exactly so that toroidal wrapping stays bucket aligned
+
+    cdef readonly double x_min, x_max, y_min, y_max, width, height
+    cdef readonly bint torus
+    cdef readonly object center, size
+    cdef readonly long buckets_x, buckets_y
+    cdef double _bucket_width, _bucket_height
+    cdef _AgentTable _table
+    cdef dict _slots
+    cdef long[:] _heads
+    cdef long[:] _next
+    cdef long[:] _prev
+    cdef long[:] _buckets
+    cdef double[:] _xs
+    cdef double[:] _ys
+
+    def __init__(self, double x_max, double y_max, bint torus, double x_min=0, double y_min=0, cell_size=None):
+        self.x_min = x_min
+        self.x_max = x_max
+        self.width = x_max - x_min
+        self.y_min = y_min
+        self.y_max = y_max
+        self.height = y_max - y_min
+        self.center = np.array(((x_max + x_min) / 2, (y_max + y_min) / 2))
+        self.size = np.array((self.width, self.height))
+        self.torus = torus
+
+        if cell_size is None:
+            cell_size = max(self.width, self.height) / 64
+        self.buckets_x = max(1, <long>(self.width / cell_size))
+        self.buckets_y = max(1, <long>(self.height / cell_size))
+        self._bucket_width = self.width / self.buckets_x
+        self._bucket_height = self.height / self.buckets_y
+        self._heads = np.full(self.buckets_x * self.buckets_y, -1, dtype=LONG)
+
+        self._table = _AgentTable()
+        self._slots = {}
+        self._next = np.empty(16, dtype=LONG)
+        self._prev = np.empty(16, dtype=LONG)
+        self._buckets = np.empty(16, dtype=LONG)
+        self._xs = np.empty(16, dtype=np.float64)
+        self._ys = np.empty(16, dtype=np.float64)
+
+    @property
+    def agent_table(self):
+        return self._table.agents
+
+    @property
+    def bucket_counts(self):
+        # number of agents in each bucket, shaped (buckets_x, buckets_y)
+        return np.bincount(np.asarray(self._buckets)[self._live_slots()], minlength=self.buckets_x * self.buckets_y).reshape(self.buckets_x, self.buckets_y)
+
+    cdef _live_slots(self):
+        return np.fromiter(self._slots.values(), dtype=LONG, count=len(self._slots))
+
+    cdef _reserve(self, long slot):
+        cdef long capacity = self._next.shape[0]
+        if slot < capacity:
+            return
+        while capacity <= slot:
+            capacity *= 2
+        self._next = np.resize(np.asarray(self._next), capacity)
+        self._prev = np.resize(np.asarray(self._prev), capacity)
+        self._buckets = np.resize(np.asarray(self._buckets), capacity)
+        self._xs = np.resize(np.asarray(self._xs), capacity)
+        self._ys = np.resize(np.asarray(self._ys), capacity)
+
+    cdef inline long _bucket_of(self, double x, double y):
+        cdef long bx = <long>((x - self.x_min) / self._bucket_width)
+        cdef long by = <long>((y - self.y_min) / self._bucket_height)
+        # guards against rounding at the upper edges
+        bx = min(max(bx, 0), self.buckets_x - 1)
+        by = min(max(by, 0), self.buckets_y - 1)
+        return bx * self.buckets_y + by
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _link(self, long slot, long bucket):
+        cdef long head = self._heads[bucket]
+        self._buckets[slot] = bucket
+        self._prev[slot] = -1
+        self._next[slot] = head
+        if head >= 0:
+            self._prev[head] = slot
+        self._heads[bucket] = slot
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _unlink(self, long slot):
+        cdef long prev = self._prev[slot], next = self._next[slot]
+        if prev >= 0:
+            self._next[prev] = next
+        else:
+            self._heads[self._buckets[slot]] = next
+        if next >= 0:
+            self._prev[next] = prev
+
+    cdef _set_position(self, long slot, pos):
+        cdef double x, y
+        cdef long bucket
+        x, y = pos
+        self._xs[slot] = x
+        self._ys[slot] = y
+        bucket = self._bucket_of(x, y)
+        if bucket != self._buckets[slot]:
+            self._unlink(slot)
+            self._link(slot, bucket)
+
+    def place_agent(self, agent, pos):
+        cdef long slot
+        pos = self.torus_adj(pos)
+        if id(agent) in self._slots:
+            self._set_position(self._slots[id(agent)], pos)
+        else:
+            slot = self._slots[id(agent)] = self._table.add(agent)
+            self._reserve(slot)
+            x, y = pos
+            self._xs[slot] = x
+            self._ys[slot] = y
+            self._link(slot, self._bucket_of(x, y))
+        agent.pos = pos
+
+    def move_agent(self, agent, pos):
+        pos = self.torus_adj(pos)
+        self._set_position(self._slots[id(agent)], pos)
+        agent.pos = pos
+
+    def remove_agent(self, agent):
+        if id(agent) not in self._slots:
+            raise Exception("Agent does not exist in the space")
+        cdef long slot = self._slots.pop(id(agent))
+        self._unlink(slot)
+        self._table.release(slot)
+        agent.pos = None
+
+    cdef inline long _bucket_range(self, double low, double high, double origin, double bucket_size, long buckets, long* start):
+        # first bucket (in start) and number of buckets covering [low, high],
+        # wrapped around on a torus and clipped otherwise
+        cdef long first = <long>floor((low - origin) / bucket_size)
+        cdef long last = <long>floor((high - origin) / bucket_size)
+        if self.torus:
+            if last - first + 1 >= buckets:
+                start[0] = 0
+                return buckets
+            start[0] = first % buckets
+            return last - first + 1
+        first = max(first, 0)
+        last = min(last, buckets - 1)
+        start[0] = first
+        return max(last - first + 1, 0)
+
+    cdef inline double _distance2(self, double x1, double y1, double x2, double y2):
+        cdef double dx = fabs(x1 - x2), dy = fabs(y1 - y2)
+        if self.torus:
+            dx = min(dx, self.width - dx)
+            dy = min(dy, self.height - dy)
+        return dx * dx + dy * dy
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef list get_neighbors(self, pos, double radius, bint include_center = True):
+        cdef list agents = self._table.agents
+        cdef list neighbors = []
+        cdef double x, y, d2, radius2 = radius * radius
+        cdef long x_start, y_start, nx, ny, i, j, slot
+        
+        x, y = pos
+        nx = self._bucket_range(x - radius, x + radius, self.x_min, self._bucket_width, self.buckets_x, &x_start)
+        ny = self._bucket_range(y - radius, y + radius, self.y_min, self._bucket_height, self.buckets_y, &y_start)
+        for i in range(nx):
+            for j in range(ny):
+                slot = self._heads[((x_start + i) % self.buckets_x) * self.buckets_y + (y_start + j) % self.buckets_y]
+                while slot >= 0:
+                    d2 = self._distance2(self._xs[slot], self._ys[slot], x, y)
+                    if d2 <= radius2 and (include_center or d2 > 0):
+                        neighbors.append(agents[slot])
+                    slot = self._next[slot]
+        return neighbors
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def get_neighbor_pairs(self, double radius):
+        # (M, 2) array of agent_table slots (i < j) of every pair of agents
+        # at most radius apart
+        cdef long[:] live = self._live_slots()
+        cdef long[:, :] pairs
+        cdef double x, y, radius2 = radius * radius
+        cdef long x_start, y_start, nx, ny, i, j, k, a, b, count = 0
+        
+        pairs_arr = np.empty((max(16, 4 * live.shape[0]), 2), dtype=LONG)
+        pairs = pairs_arr
+        for k in range(live.shape[0]):
+            a = live[k]
+            x = self._xs[a]
+            y = self._ys[a]
+            nx = self._bucket_range(x - radius, x + radius, self.x_min, self._bucket_width, self.buckets_x, &x_start)
+            ny = self._bucket_range(y - radius, y + radius, self.y_min, self._bucket_height, self.buckets_y, &y_start)
+            for i in range(nx):
+                for j in range(ny):
+                    b = self._heads[((x_start + i) % self.buckets_x) * self.buckets_y + (y_start + j) % self.buckets_y]
+                    while b >= 0:
+                        if b > a and self._distance2(self._xs[b], self._ys[b], x, y) <= radius2:
+                            if count == pairs.shape[0]:
+                                pairs_arr = np.resize(pairs_arr, (2 * count, 2))
+                                pairs = pairs_arr
+                            pairs[count, 0] = a
+                            pairs[count, 1] = b
+                            count += 1
+                        b = self._next[b]
+        return pairs_arr[:count]
+
+    def get_heading(self, pos_1, pos_2):
+        one = np.array(pos_1)
+        two = np.array(pos_2)
+        heading = two - one
+        if self.torus:
+            heading = (heading + self.size / 2) % self.size - self.size / 2
+        return heading
+
+    def get_distance(self, pos_1, pos_2):
+        cdef double x1, y1, x2, y2
+        x1, y1 = pos_1
+        x2, y2 = pos_2
+        return sqrt(self._distance2(x1, y1, x2, y2))
+
+    def torus_adj(self, pos):
+        if not self.out_of_bounds(pos):
+            return pos
+        elif not self.torus:
+            raise Exception("Point out of bounds, and space non-toroidal.")
+        x = self.x_min + ((pos[0] - self.x_min) % self.width)
+        y = self.y_min + ((pos[1] - self.y_min) % self.height)
+        if isinstance(pos, tuple):
+            return (x, y)
+        return np.array((x, y))
+
+    cpdef bint out_of_bounds(self, pos):
+        cdef double x, y
+        x, y = pos
+        return x < self.x_min or x >= self.x_max or y < self.y_min or y >= self.y_max
+
+
+cdef class NetworkGrid:
+    # mesa.space.NetworkGrid on a graph frozen into CSR arrays when the grid
+    # is built, later changes to G are not seen. Agents are kept in a slot
+    # table and linked per node in placement order, instead of in the
+    # "agent" attribute of the networkx nodes. Neighborhoods of radius
+    # above 1 are breadth first searches over the CSR arrays, cached per
+    # (node, include_center, radius).
+
+    cdef readonly object G
+    cdef readonly long num_nodes
+    cdef list _nodes
+    cdef dict _index
+    cdef long[:] _indptr
+    cdef long[:] _indices
+    cdef _AgentTable _table
+    cdef dict _slots
+    cdef long[:] _heads
+    cdef long[:] _next
+    cdef long[:] _prev
+    cdef long[:] _seen
+    cdef long[:] _queue
+    cdef long _stamp
+    cdef readonly NeighborhoodCache neighborhood_cache
+
+    def __init__(self, g, cache_size=None, cache_cells=None):
+        cdef long i
+        
+        self.G = g
+        self._nodes = list(g.nodes)
+        self.num_nodes = len(self._nodes)
+        self._index = {node: i for i, node in enumerate(self._nodes)}
+        
+        adjacency = g.adj
+        degrees = np.fromiter((len(adjacency[node]) for node in self._nodes), dtype=LONG, count=self.num_nodes)
+        indptr = np.zeros(self.num_nodes + 1, dtype=LONG)
+        np.cumsum(degrees, out=indptr[1:])
+        self._indptr = indptr
+        self._indices = np.fromiter(
+            (self._index[neighbor] for node in self._nodes for neighbor in adjacency[node]),
+            dtype=LONG,
+            count=indptr[-1],
+        )
+        
+        self._table = _AgentTable()
+        self._slots = {}
+        self._heads = np.full(self.num_nodes, -1, dtype=LONG)
+        self._next = np.empty(16, dtype=LONG)
+        self._prev = np.empty(16, dtype=LONG)
+        self._seen = np.zeros(self.num_nodes, dtype=LONG)
+        self._queue = np.empty(self.num_nodes, dtype=LONG)
+        self._stamp = 0
+        self.neighborhood_cache = NeighborhoodCache(cache_size, cache_cells)
+
+    @staticmethod
+    def default_val():
+        return []
+
+    @property
+    def agent_table(self):
+        return self._table.agents
 
-    cpdef move_to_empty(self, agent):
+    @property
+    def indptr(self):
+        return _readonly_view(self._indptr)
+
+    @property
+    def indices(self):
+        # CSR column indices, positions of the neighbors in list(G.nodes)
+        return _readonly_view(self._indices)
+
+    cdef _reserve(self, long slot):
+        cdef long capacity = self._next.shape[0]
+        if slot < capacity:
+            return
+        while capacity <= slot:
+            capacity *= 2
+        self._next = np.resize(np.asarray(self._next), capacity)
+        self._prev = np.resize(np.asarray(self._prev), capacity)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _link(self, long node, long slot):
+        cdef long head = self._heads[node]
+        cdef long tail
+        
+        if head < 0:
+            self._heads[node] = slot
+            self._next[slot] = self._prev[slot] = slot
+        else:
+            tail = self._prev[head]
+            self._next[tail] = slot
+            self._prev[slot] = tail
+            self._next[slot] = head
+            self._prev[head] = slot
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _unlink(self, long node, long slot):
+        cdef long nxt = self._next[slot]
+        cdef long prv = self._prev[slot]
+        
+        if nxt == slot:
+            self._heads[node] = -1
+        else:
+            self._next[prv] = nxt
+            self._prev[nxt] = prv
+            if self._heads[node] == slot:
+                self._heads[node] = nxt
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _append_node(self, long node, list agents):
+        cdef list table = self._table.agents
+        cdef long head = self._heads[node]
+        cdef long slot = head
+        
+        if head < 0:
+            return
         while True:
-            new_pos = (random.randrange(self.width), random.randrange(self.height))
-            if self.is_cell_empty(new_pos):
-                break
+            agents.append(table[slot])
+            slot = self._next[slot]
+            if slot == head:
+                return
+
+    def place_agent(self, agent, node_id):
+        cdef long node = self._index[node_id]
+        cdef long slot
+        
+        if id(agent) in self._slots:
+            self.remove_agent(agent)
+        slot = self._slots[id(agent)] = self._table.add(agent)
+        self._reserve(slot)
+        self._link(node, slot)
+        agent.pos = node_id
+
+    def remove_agent(self, agent):
+        cdef long slot = self._slots.pop(id(agent))
+        self._unlink(self._index[agent.pos], slot)
+        self._table.release(slot)
+        agent.pos = None
+
+    def move_agent(self, agent, node_id):
         self.remove_agent(agent)
-        self.place_agent(agent, new_pos)
+        self.place_agent(agent, node_id)
+
+    def is_cell_empty(self, node_id):
+        return self._heads[self._index[node_id]] < 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef list _search(self, long source, bint include_center, int radius):
+        # node indices within radius hops of source, sorted like the node ids
+        cdef long[:] indptr = self._indptr, indices = self._indices
+        cdef long[:] seen = self._seen, queue = self._queue
+        cdef long head = 0, tail = 1, level_end, depth = 0, node, k, neighbor
+        
+        self._stamp += 1
+        seen[source] = self._stamp
+        queue[0] = source
+        while head < tail and depth < radius:
+            level_end = tail
+            while head < level_end:
+                node = queue[head]
+                head += 1
+                for k in range(indptr[node], indptr[node + 1]):
+                    neighbor = indices[k]
+                    if seen[neighbor] != self._stamp:
+                        seen[neighbor] = self._stamp
+                        queue[tail] = neighbor
+                        tail += 1
+            depth += 1
+        
+        found = list(self._queue[0 if include_center else 1:tail])
+        return sorted(found, key=self._nodes.__getitem__)
+
+    cdef list _neighborhood_indices(self, long node, bint include_center, int radius):
+        cdef list neighborhood
+        
+        if radius == 1:
+            neighborhood = list(self._indices[self._indptr[node]:self._indptr[node + 1]])
+            if include_center:
+                neighborhood.append(node)
+            return neighborhood
         
+        cache_key = (node, include_center, radius)
+        neighborhood = self.neighborhood_cache.get(cache_key)
+        if neighborhood is None:
+            neighborhood = self._search(node, include_center, radius)
+            self.neighborhood_cache.put(cache_key, neighborhood)
+        return neighborhood
+
+    cpdef list get_neighborhood(self, node_id, bint include_center = False, int radius = 1):
+        cdef list nodes = self._nodes
+        return [nodes[i] for i in self._neighborhood_indices(self._index[node_id], include_center, radius)]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef list get_neighbors(self, node_id, bint include_center = False, int radius = 1):
+        cdef list agents = []
+        cdef long node = self._index[node_id]
+        cdef long k
+        
+        if radius == 1:
+            for k in range(self._indptr[node], self._indptr[node + 1]):
+                self._append_node(self._indices[k], agents)
+            if include_center:
+                self._append_node(node, agents)
+        else:
+            for k in self._neighborhood_indices(node, include_center, radius):
+                self._append_node(k, agents)
+        return agents
+
+    cpdef list get_cell_list_contents(self, cell_list):
+        cdef list agents = []
+        cdef dict index = self._index
+        
+        for node_id in cell_list:
+            self._append_node(index[node_id], agents)
+        return agents
+
+    def get_all_cell_contents(self):
+        cdef list agents = []
+        cdef long node
+        
+        for node in range(self.num_nodes):
+            self._append_node(node, agents)
+        return agents
+
+    def iter_cell_list_contents(self, cell_list):
+        return iter(self.get_cell_list_contents(cell_list))
@@ -1,11 +1,29 @@
 """
 Test the Grid objects.
 """
+import os
 import random
+import tempfile
 import unittest
 from unittest.mock import Mock, patch
 
-from space import MultiGrid, SingleGrid
+import networkx as nx
+import numpy as np
+
+from space import (
+    CompactMultiGrid,
+    ContinuousSpace,
+    HexMultiGrid,
+    HexSingleGrid,
+    IdSingleGrid,
+    JournalEvent,
+    MultiGrid,
+    NetworkGrid,
+    PropertyLayer,
+    SingleGrid,
+    SparseMultiGrid,
+    SparseSingleGrid,
+)
 
 # Initial agent positions for testing
 #
@@ -30,12 +48,69 @@ class MockAgent:
         self.pos = pos
 
 
+def check_place_out_of_bounds(test, grid_class, grid_kwargs):
+    # positions off the grid wrap on a torus and raise otherwise, the empty
+    # cells following the occupancy either way
+    for torus in (False, True):
+        grid = grid_class(10, 10, torus, **grid_kwargs)
+        for pos in ((0, -1), (-1, 0), (3, -1), (10, 0), (0, 13)):
+            agent = MockAgent(0, None)
+            if not torus:
+                with test.assertRaises(Exception):
+                    grid.place_agent(agent, pos)
+                assert agent.pos is None
+            else:
+                grid.place_agent(agent, pos)
+                cell = (pos[0] % 10, pos[1] % 10)
+                assert agent.pos == cell
+                assert grid.get_cell_list_contents([cell]) == [agent]
+                assert grid.num_empties == 99
+                assert cell not in set(grid.empties)
+                grid.remove_agent(agent)
+            assert grid.num_empties == 100
+            assert len(set(grid.empties)) == 100
+
+
+def check_count_index(test, grid):
+    width, height = grid.width, grid.height
+    counts = np.zeros((width, height), dtype=int)
+    for x in range(width):
+        for y in range(height):
+            counts[x, y] = len(grid.get_cell_list_contents([(x, y)]))
+
+    def axis(start, stop, size):
+        if grid.torus:
+            length = size if stop - start + 1 >= size else (stop - start) % size + 1
+            return [(start + k) % size for k in range(length)]
+        return list(range(max(start, 0), min(stop, size - 1) + 1))
+
+    for x0 in range(-1, width + 1):
+        for x1 in range(-1, width + 1):
+            for y0, y1 in ((0, height - 1), (-2, 1), (4, 2), (1, 1), (3, 1), (7, -1)):
+                xs, ys = axis(x0, x1, width), axis(y0, y1, height)
+                expected = counts[np.ix_(xs, ys)].sum() if xs and ys else 0
+                test.assertEqual(grid.count_agents_in_region(x0, y0, x1, y1), expected)
+                agents = grid.get_agents_in_region(x0, y0, x1, y1)
+                test.assertEqual(len(agents), expected)
+                assert all(agent.pos[0] in xs and agent.pos[1] in ys for agent in agents)
+
+    cells = [(x, y) for x in range(width) for y in range(height)]
+    shapes = [(moore, center, radius) for moore in (True, False) for center in (True, False) for radius in (2, 3)]
+    indexed = [grid.get_neighbors(pos, *shape) for pos in cells for shape in shapes]
+    grid.disable_count_index()
+    assert indexed == [grid.get_neighbors(pos, *shape) for pos in cells for shape in shapes]
+    with test.assertRaises(Exception):
+        grid.count_agents_in_region(0, 0, 1, 1)
+
+
 class TestSingleGrid(unittest.TestCase):
     """
     Testing a non-toroidal singlegrid.
     """
 
     torus = False
+    grid_class = SingleGrid
+    grid_kwargs = {}
 
     def setUp(self):
         """
@@ -44,7 +119,7 @@ class TestSingleGrid(unittest.TestCase):
         # The height needs to be even to test the edge case described in PR #1517
         height = 6  # height of grid
         width = 3  # width of grid
-        self.grid = SingleGrid(width, height, self.torus)
+        self.grid = self.grid_class(width, height, self.torus, **self.grid_kwargs)
         self.agents = []
         counter = 0
         for x in range(width):
@@ -131,6 +206,174 @@ class TestSingleGrid(unittest.TestCase):
         neighbors = self.grid.get_neighbors((1, 3), moore=False, radius=2)
         assert len(neighbors) == 3
 
+    def test_array_views(self):
+        """
+        Test the zero-copy occupancy and agent id views.
+        """
+        occupancy = self.grid.occupancy
+        agent_ids = self.grid.agent_ids
+        assert occupancy.shape == agent_ids.shape == (self.grid.width, self.grid.height)
+        assert occupancy.tolist() == [[int(v) for v in row] for row in TEST_GRID]
+        for agent in self.agents:
+            x, y = agent.pos
+            assert self.grid.agent_table[agent_ids[x, y]] is agent
+        assert (agent_ids[occupancy == 0] == -1).all()
+
+        with self.assertRaises(ValueError):
+            occupancy[0, 0] = 1
+
+        # the views follow the grid state, other layouts give snapshots
+        agent = self.agents[0]
+        x, y = agent.pos
+        self.grid.remove_agent(agent)
+        if self.grid.layout != "rows":
+            occupancy, agent_ids = self.grid.occupancy, self.grid.agent_ids
+        assert occupancy[x, y] == 0
+        assert agent_ids[x, y] == -1
+
+    def test_bulk_placement(self):
+        """
+        Test place_agents, move_agents and remove_agents.
+        """
+        empties = sorted(self.grid.empties)
+        new_agents = [MockAgent(100 + i, None) for i in range(3)]
+        self.grid.place_agents(new_agents, empties[:3])
+        for agent, pos in zip(new_agents, empties[:3]):
+            assert agent.pos == pos
+            assert self.grid[pos] is agent
+        assert self.grid.num_empties == len(empties) - 3
+
+        # conflicts leave the grid untouched
+        with self.assertRaises(Exception):
+            self.grid.place_agents([MockAgent(200, None)], [self.agents[0].pos])
+        with self.assertRaises(Exception):
+            self.grid.place_agents(
+                [MockAgent(200, None), MockAgent(201, None)], [empties[3], empties[3]]
+            )
+        with self.assertRaises(ValueError):
+            self.grid.place_agents([MockAgent(200, None)], empties[3:5])
+        # so do agents listed twice or already on the grid
+        twice = MockAgent(200, None)
+        with self.assertRaises(Exception):
+            self.grid.place_agents([twice, twice], empties[3:5])
+        with self.assertRaises(Exception):
+            self.grid.place_agents([MockAgent(201, None), new_agents[0]], empties[3:5])
+        assert twice.pos is None
+        assert self.grid.num_empties == len(empties) - 3
+        assert sorted(self.grid.empties) == empties[3:]
+
+        # rotate three agents through each other's cells, then shift them
+        # along a chain ending in an empty cell; the agents keep their slots
+        # and the journal only sees moves
+        pos = [agent.pos for agent in new_agents]
+        slots = [self.grid.agent_table.index(agent) for agent in new_agents]
+        self.grid.enable_journal()
+        self.grid.move_agents(new_agents, pos[1:] + pos[:1])
+        assert [agent.pos for agent in new_agents] == pos[1:] + pos[:1]
+        self.grid.move_agents(new_agents, pos[2:] + [empties[3]] + pos[:1])
+        assert [agent.pos for agent in new_agents] == pos[2:] + [empties[3]] + pos[:1]
+        assert [self.grid.agent_table.index(agent) for agent in new_agents] == slots
+        assert set(self.grid.journal[:, 0].tolist()) == {JournalEvent.MOVE}
+        self.grid.disable_journal()
+        with self.assertRaises(Exception):
+            self.grid.move_agents(new_agents[:1], [self.agents[0].pos])
+        with self.assertRaises(Exception):
+            self.grid.move_agents(new_agents[:1] * 2, [pos[1], empties[4]])
+        assert new_agents[0].pos == pos[2]
+        assert sorted(self.grid.empties) == [pos[1]] + empties[4:]
+
+        self.grid.remove_agents(new_agents)
+        assert all(agent.pos is None for agent in new_agents)
+        assert sorted(self.grid.empties) == empties
+
+    def test_category_counts(self):
+        """
+        Test the per-category neighbor counts against get_neighbors.
+        """
+        for agent in self.agents:
+            agent.type = agent.unique_id % 2
+        self.grid.enable_categories("type", 2)
+
+        def check():
+            whole_grid = self.grid.count_neighbors_by_category_batch(None, True, radius=2)
+            for x in range(self.grid.width):
+                for y in range(self.grid.height):
+                    neighbors = self.grid.get_neighbors((x, y), True, radius=2)
+                    expected = [sum(n.type == t for n in neighbors) for t in (0, 1)]
+                    counts = self.grid.count_neighbors_by_category((x, y), True, radius=2)
+                    assert list(counts) == expected
+                    assert list(whole_grid[x, y]) == expected
+                    assert self.grid.count_neighbors_of_category((x, y), 1, True, radius=2) == expected[1]
+
+        check()
+        agent = self.agents[0]
+        self.grid.move_agent(agent, sorted(self.grid.empties)[0])
+        agent.type = 1 - agent.type
+        self.grid.update_category(agent)
+        new_agent = MockAgent(100, None)
+        new_agent.type = 1
+        self.grid.place_agent(new_agent, sorted(self.grid.empties)[0])
+        self.grid.remove_agent(self.agents[1])
+        check()
+
+        new_agent = MockAgent(101, None)
+        new_agent.type = 2
+        with self.assertRaises(ValueError):
+            self.grid.place_agent(new_agent, sorted(self.grid.empties)[0])
+
+    def test_neighbors_batch(self):
+        """
+        Test that the CSR batch query agrees with get_neighbors.
+        """
+        positions = [(x, y) for x in range(self.grid.width) for y in range(self.grid.height)]
+        for moore in (False, True):
+            offsets, slots = self.grid.get_neighbors_batch(positions, moore, radius=2)
+            assert len(offsets) == len(positions) + 1
+            table = self.grid.agent_table
+            for i, pos in enumerate(positions):
+                batch = [table[slot] for slot in slots[offsets[i] : offsets[i + 1]]]
+                assert batch == self.grid.get_neighbors(pos, moore, radius=2)
+
+    def test_threaded_batches(self):
+        """
+        Test the nogil batch kernels against the serial queries.
+        """
+        positions = [(x, y) for x in range(self.grid.width) for y in range(self.grid.height)]
+        for moore in (False, True):
+            serial = self.grid.get_neighbors_batch(positions, moore, radius=2)
+            threaded = self.grid.get_neighbors_batch(positions, moore, radius=2, num_threads=2)
+            assert np.array_equal(serial[0], threaded[0])
+            assert np.array_equal(serial[1], threaded[1])
+
+            counts = np.full(len(positions), -1)
+            empties = np.full((len(positions), 2), -2)
+            self.grid.count_occupied_neighbors_batch(positions, moore, out=counts, num_threads=2)
+            self.grid.find_empty_neighbors_batch(positions, moore, out=empties, num_threads=2)
+            for i, pos in enumerate(positions):
+                neighborhood = self.grid.get_neighborhood(pos, moore)
+                assert counts[i] == len(self.grid.get_neighbors(pos, moore))
+                expected = next((cell for cell in neighborhood if self.grid.is_cell_empty(cell)), (-1, -1))
+                assert tuple(empties[i]) == expected
+
+        with self.assertRaises(ValueError):
+            self.grid.count_occupied_neighbors_batch(positions, True, num_threads=0)
+
+        # enough positions per thread for the threads to interleave
+        grid = self.grid_class(60, 50, self.grid.torus, **self.grid_kwargs)
+        rng = np.random.default_rng(0)
+        cells = rng.choice(grid.width * grid.height, 1000, replace=False)
+        grid.place_agents([MockAgent(i, None) for i in range(len(cells))], np.stack(np.divmod(cells, grid.height), axis=1))
+        positions = np.array([(x, y) for x in range(grid.width) for y in range(grid.height)] * 4)
+        for moore in (False, True):
+            serial = grid.get_neighbors_batch(positions, moore, radius=2, num_threads=1)
+            threaded = grid.get_neighbors_batch(positions, moore, radius=2, num_threads=4)
+            assert np.array_equal(serial[0], threaded[0])
+            assert np.array_equal(serial[1], threaded[1])
+            for method in (grid.count_occupied_neighbors_batch, grid.find_empty_neighbors_batch):
+                assert np.array_equal(method(positions, moore, num_threads=1), method(positions, moore, num_threads=4))
+                # serial by default, None for every core
+                assert np.array_equal(method(positions, moore), method(positions, moore, num_threads=None))
+
     def test_coord_iter(self):
         ci = self.grid.coord_iter()
 
@@ -147,6 +390,226 @@ class TestSingleGrid(unittest.TestCase):
         assert second[1] == 0
         assert second[2] == 1
 
+    def test_coord_arrays(self):
+        """
+        Test the array snapshots against coord_iter and __getitem__.
+        """
+        xs, ys, ids = self.grid.coord_arrays()
+        table = self.grid.agent_table
+        expected = [(agent, x, y) for agent, x, y in self.grid.coord_iter() if agent is not None]
+        assert [(table[i], x, y) for i, x, y in zip(ids, xs, ys)] == expected
+
+        agents = self.grid.agent_array()
+        assert agents.shape == (self.grid.width, self.grid.height)
+        for agent, x, y in self.grid.coord_iter():
+            assert agents[x, y] is agent
+        assert agents[1, :].tolist() == self.grid[1, :]
+        assert agents[:, 2].tolist() == self.grid[:, 2]
+        assert self.grid.agent_array((0, 1)) == self.grid[0, 1]
+
+    def test_fused_moves(self):
+        """
+        Test that moves and swaps leave the grid as placing from scratch does.
+        """
+        rng = random.Random(2)
+        for agent in self.agents:
+            agent.type = agent.unique_id % 2
+        self.grid.enable_categories("type", 2)
+        for _ in range(50):
+            agent = rng.choice(self.agents)
+            if rng.random() < 0.5:
+                self.grid.swap_pos(agent, rng.choice(self.agents))
+            else:
+                self.grid.move_to_empty(agent)
+        pos = self.agents[0].pos
+        with self.assertRaises(Exception):
+            self.grid.move_agent(self.agents[0], self.agents[1].pos)
+        assert self.agents[0].pos == pos and self.grid[pos] is self.agents[0]
+
+        reference = self.grid_class(self.grid.width, self.grid.height, self.grid.torus, **self.grid_kwargs)
+        reference.enable_categories("type", 2)
+        for agent in self.agents:
+            copy = MockAgent(agent.unique_id, None)
+            copy.type = agent.type
+            reference.place_agent(copy, agent.pos)
+        assert (reference.occupancy == self.grid.occupancy).all()
+        assert list(reference.empties) == list(self.grid.empties)
+        assert (reference.category_counts == self.grid.category_counts).all()
+        for (copy, _, _), (agent, _, _) in zip(reference.coord_iter(), self.grid.coord_iter()):
+            assert getattr(copy, "unique_id", None) == getattr(agent, "unique_id", None)
+
+    def test_journal(self):
+        """
+        Test that replaying the journal tracks the occupancy of the grid.
+        """
+        assert self.grid.journal is None
+        self.grid.enable_journal(capacity=2)
+        occupancy = self.grid.occupancy.copy()
+        agent = MockAgent(100, None)
+        a, b = self.agents[0], self.agents[1]
+        pos_a, pos_b = a.pos, b.pos
+
+        self.grid.place_agent(agent, (0, 0))
+        self.grid.swap_pos(a, b)
+        self.grid.move_agent(agent, (1, 0))
+        self.grid.remove_agent(agent)
+        journal = self.grid.journal
+        slot = self.grid.agent_table.index(a)
+        assert journal[:, 0].tolist() == [JournalEvent.PLACE, JournalEvent.MOVE, JournalEvent.MOVE, JournalEvent.MOVE, JournalEvent.REMOVE]
+        assert journal[1].tolist() == [JournalEvent.MOVE, slot, *pos_a, *pos_b]
+        assert journal[3].tolist()[2:] == [0, 0, 1, 0]
+        assert journal[4].tolist()[2:] == [1, 0, -1, -1]
+
+        # agent counts, the two moves of a swap cancel out
+        for event, _, x0, y0, x1, y1 in journal.tolist():
+            if event != JournalEvent.PLACE:
+                occupancy[x0, y0] -= 1
+            if event != JournalEvent.REMOVE:
+                occupancy[x1, y1] += 1
+        assert (occupancy == self.grid.occupancy).all()
+
+        self.grid.reset_journal()
+        assert len(self.grid.journal) == 0
+        self.grid.disable_journal()
+        self.grid.place_agent(agent, (1, 0))
+        assert self.grid.journal is None
+
+    def test_count_index(self):
+        """
+        Test the region counts and the tile-skipping neighborhoods of the
+        count index against a brute force scan.
+        """
+        self.grid.enable_count_index(block=2)
+        self.grid.move_to_empty(self.agents[0])
+        self.grid.swap_pos(self.agents[1], self.agents[2])
+        self.grid.remove_agent(self.agents[3])
+        check_count_index(self, self.grid)
+
+    def test_geometry_batch(self):
+        """
+        Test the array geometry against per position Python arithmetic.
+        """
+        width, height = self.grid.width, self.grid.height
+        rng = np.random.default_rng(4)
+        a = rng.integers(-2, 8, (40, 2))
+        b = rng.integers(0, 6, (40, 2)) % (width, height)
+
+        def heading(p, q):
+            d = [q[0] - p[0], q[1] - p[1]]
+            if self.grid.torus:
+                d = [(d[0] + width // 2) % width - width // 2, (d[1] + height // 2) % height - height // 2]
+            return d
+
+        assert self.grid.out_of_bounds_batch(a).tolist() == [self.grid.out_of_bounds(tuple(p)) for p in a.tolist()]
+        if self.grid.torus:
+            assert self.grid.torus_adj_batch(a).tolist() == [list(self.grid.torus_adj(tuple(p))) for p in a.tolist()]
+        else:
+            with self.assertRaises(Exception):
+                self.grid.torus_adj_batch(a)
+            assert self.grid.torus_adj_batch(b).tolist() == b.tolist()
+        headings = [heading(p, q) for p, q in zip(a.tolist(), b.tolist())]
+        assert self.grid.get_heading_batch(a, b).tolist() == headings
+        assert self.grid.get_heading_batch(a, (1, 2)).tolist() == [heading(p, (1, 2)) for p in a.tolist()]
+
+        d = np.abs(np.array(headings))
+        assert self.grid.get_distance_batch(a, b, "chebyshev").tolist() == d.max(axis=1).tolist()
+        assert self.grid.get_distance_batch(a, b, "manhattan").tolist() == d.sum(axis=1).tolist()
+        assert np.allclose(self.grid.get_distance_batch(a, b), np.hypot(d[:, 0], d[:, 1]))
+        matrix = self.grid.get_distance_matrix(a, b[:5], "manhattan", num_threads=2)
+        assert matrix.shape == (40, 5)
+        assert matrix.tolist() == [
+            [sum(map(abs, heading(p, q))) for q in b[:5].tolist()] for p in a.tolist()
+        ]
+        with self.assertRaises(ValueError):
+            self.grid.get_distance_batch(a, b[:3])
+        with self.assertRaises(ValueError):
+            self.grid.get_distance_matrix(a, b, "hamming")
+
+    def test_find_nearest(self):
+        """
+        Test the ring searches against a brute force scan of the grid.
+        """
+        width, height = self.grid.width, self.grid.height
+
+        def distance(a, b, moore):
+            dx, dy = abs(a[0] - b[0]), abs(a[1] - b[1])
+            if self.grid.torus:
+                dx, dy = min(dx, width - dx), min(dy, height - dy)
+            return max(dx, dy) if moore else dx + dy
+
+        cells = [(x, y) for x in range(width) for y in range(height)]
+        for moore in (True, False):
+            nearest = self.grid.find_nearest_batch(cells, moore=moore)
+            occupied = self.grid.find_nearest_batch(cells, empty=False, moore=moore, max_radius=1)
+            for i, pos in enumerate(cells):
+                found = self.grid.find_nearest_empty(pos, moore=moore)
+                assert tuple(nearest[i]) == found
+                assert self.grid.is_cell_empty(found) and found != pos
+                best = min(distance(pos, cell, moore) for cell in self.grid.empties if cell != pos)
+                assert distance(pos, found, moore) == best
+
+                agent = self.grid.find_nearest_agent(pos, moore=moore, max_radius=1)
+                if agent is None:
+                    assert tuple(occupied[i]) == (-1, -1)
+                    assert not self.grid.get_neighbors(pos, moore)
+                else:
+                    assert tuple(occupied[i]) == agent.pos
+                    assert agent in self.grid.get_neighbors(pos, moore)
+
+        # (0, 0) is empty and its own nearest empty cell with include_center
+        assert self.grid.find_nearest_empty((0, 0), include_center=True) == (0, 0)
+        target = self.agents[-1]
+        assert self.grid.find_nearest_agent((0, 0), predicate=lambda a: a is target) is target
+        assert self.grid.find_nearest_agent((0, 0), max_radius=0, include_center=True) is None
+
+        # on a thin torus the rings must not wrap back onto the query cell
+        for width, height, pos in ((1, 9, (0, 4)), (3, 20, (0, 16)), (4, 2, (1, 1))):
+            grid = self.grid_class(width, height, True, **self.grid_kwargs)
+            cells = [(x, y) for x in range(width) for y in range(height) if (x, y) != pos]
+            grid.place_agents([MockAgent(i, None) for i in range(len(cells))], cells)
+            for moore in (True, False):
+                assert grid.find_nearest_empty(pos, moore=moore) is None
+                assert grid.find_nearest_empty(pos, moore=moore, include_center=True) == pos
+                assert tuple(grid.find_nearest_batch([pos], moore=moore)[0]) == (-1, -1)
+
+    def test_save_load_state(self):
+        """
+        Test that a checkpoint restores the grid, in memory and memory mapped.
+        """
+        for agent in self.agents:
+            agent.type = agent.unique_id % 2
+        self.grid.enable_categories("type", 2)
+        self.grid.add_property_layer(PropertyLayer("food", self.grid.width, self.grid.height, 1.5))
+        self.grid.remove_agent(self.agents[0])
+        agents = {agent.unique_id: agent for agent in self.agents}
+
+        with tempfile.TemporaryDirectory() as path:
+            self.grid.save_state(path)
+            for mmap_mode in (None, "c"):
+                for agent in self.agents:
+                    agent.pos = None
+                grid = self.grid_class.load_state(path, agents, mmap_mode=mmap_mode)
+                assert grid.layout == self.grid.layout
+                assert list(grid.coord_iter()) == list(self.grid.coord_iter())
+                assert sorted(grid.empties) == sorted(self.grid.empties)
+                assert grid.get_neighbors((1, 1), True, radius=2) == self.grid.get_neighbors((1, 1), True, radius=2)
+                assert grid.count_neighbors_of_category((1, 1), 1, True) == self.grid.count_neighbors_of_category((1, 1), 1, True)
+                assert (grid.properties["food"].data == 1.5).all()
+                assert self.agents[0].pos is None
+
+                # the restored grid keeps working
+                grid.move_to_empty(self.agents[1])
+                assert grid.num_empties == self.grid.num_empties
+                grid.remove_agent(self.agents[1])
+                grid.place_agent(self.agents[0], (0, 0))
+                assert grid[0, 0] is self.agents[0]
+
+            remapped = {uid + 100: agent for uid, agent in agents.items()}
+            grid = self.grid_class.load_state(path, remapped, remap=lambda ids: ids + 100)
+            assert grid.agent_table == self.grid.agent_table
+            with self.assertRaises(ValueError):
+                MultiGrid.load_state(path, agents)
+
     def test_agent_move(self):
         # get the agent at [0, 1]
         agent = self.agents[0]
@@ -171,6 +634,9 @@ class TestSingleGrid(unittest.TestCase):
         assert agent.pos is None
         assert self.grid[x][y] is None
 
+    def test_place_out_of_bounds(self):
+        check_place_out_of_bounds(self, self.grid_class, self.grid_kwargs)
+
     def test_swap_pos(self):
 
         # Swap agents positions
@@ -249,13 +715,15 @@ class TestSingleGridEnforcement(unittest.TestCase):
     Test the enforcement in SingleGrid.
     """
 
+    grid_class = SingleGrid
+
     def setUp(self):
         """
         Create a test non-toroidal grid and populate it with Mock Agents
         """
         width = 3
         height = 5
-        self.grid = SingleGrid(width, height, True)
+        self.grid = self.grid_class(width, height, True)
         self.agents = []
         counter = 0
         for x in range(width):
@@ -299,11 +767,148 @@ class TestSingleGridEnforcement(unittest.TestCase):
         assert len(self.grid.empties) == 0
 
         a = MockAgent(110, None)
+        with self.assertRaises(Exception):
+            self.grid.move_to_empty(a)
         with self.assertRaises(Exception):
             self.grid.position_agent(a)
         with self.assertRaises(Exception):
             self.move_to_empty(self.agents[0], num_agents=self.num_agents)
 
+    def test_empties_view(self):
+        """
+        Test the empties view against the occupancy of the grid.
+        """
+        empties = self.grid.empties
+        assert len(empties) == self.grid.num_empties == 9
+        assert (0, 0) in empties
+        assert (0, 1) not in empties
+        assert (-1, 0) not in empties
+        assert set(empties) == {
+            (x, y)
+            for x in range(self.grid.width)
+            for y in range(self.grid.height)
+            if self.grid.is_cell_empty((x, y))
+        }
+        self.grid.remove_agent(self.agents[0])
+        assert (0, 1) in empties
+        assert len(empties) == 10
+
+    def test_empties_rank_select(self):
+        """
+        Test the bitset empties against a sorted list of the empty cells.
+        """
+        # 105 cells, the last word of the bitset is more than half full
+        grid = self.grid_class(7, 15, True)
+        rng = random.Random(3)
+        cells = [(x, y) for x in range(7) for y in range(15)]
+        agents = [MockAgent(i, None) for i in range(100)]
+        for agent, pos in zip(agents, rng.sample(cells, len(agents))):
+            grid.place_agent(agent, pos)
+        for agent in agents[::3]:
+            grid.remove_agent(agent)
+
+        expected = sorted(cell for cell in cells if grid.is_cell_empty(cell))
+        empties = grid.empties
+        assert list(empties) == expected
+        assert empties.to_array().tolist() == [list(cell) for cell in expected]
+        assert [empties[i] for i in range(len(expected))] == expected
+        assert empties[-1] == expected[-1]
+        assert [empties.index(cell) for cell in expected] == list(range(len(expected)))
+        with self.assertRaises(IndexError):
+            empties[len(expected)]
+        with self.assertRaises(ValueError):
+            empties.index(agents[1].pos)
+
+        # the same draw as mesa's choice among the sorted empty cells
+        agent = agents[1]
+        expected_random = random.Random(5)
+        agent.random = random.Random(5)
+        for _ in range(20):
+            choices = sorted(cell for cell in cells if grid.is_cell_empty(cell))
+            grid.move_to_empty(agent)
+            assert agent.pos == expected_random.choice(choices)
+
+    def test_move_to_empty_reproducible(self):
+        """
+        Test that a seeded agent always lands on the same cells.
+        """
+        trajectories = []
+        for _ in range(2):
+            grid = self.grid_class(3, 5, True)
+            for x, y in [(0, 1), (1, 2), (2, 3)]:
+                grid.place_agent(MockAgent(0, None), (x, y))
+            a = MockAgent(100, None)
+            trajectory = []
+            for i in range(10):
+                grid.move_to_empty(a)
+                trajectory.append(a.pos)
+            trajectories.append(trajectory)
+        assert trajectories[0] == trajectories[1]
+
+
+class TestIdSingleGrid(TestSingleGrid):
+    """
+    Testing a non-toroidal singlegrid with integer-id storage.
+    """
+
+    grid_class = IdSingleGrid
+
+    def test_slices(self):
+        agent = self.agents[0]
+        x, y = agent.pos
+        assert self.grid[x][y] is agent
+        assert self.grid[x, :][y] is agent
+        assert self.grid[:, y][x] is agent
+        assert self.grid[:, :][x * self.grid.height + y] is agent
+        assert self.grid[(x, y), (0, 0)] == [agent, None]
+
+
+class TestIdSingleGridTorus(TestSingleGridTorus):
+    """
+    Testing a toroidal singlegrid with integer-id storage.
+    """
+
+    grid_class = IdSingleGrid
+
+
+class TestSingleGridTiled(TestSingleGridTorus):
+    """
+    Testing a toroidal singlegrid stored in tiles.
+    """
+
+    grid_kwargs = {"layout": "tiled", "tile": 2}
+
+    def test_layout(self):
+        assert self.grid.layout == "tiled"
+        with self.assertRaises(ValueError):
+            self.grid_class(3, 5, True, layout="columns")
+
+
+class TestIdSingleGridMorton(TestIdSingleGrid):
+    """
+    Testing a non-toroidal singlegrid with integer-id storage in Morton order.
+    """
+
+    grid_kwargs = {"layout": "morton"}
+
+    def test_layout(self):
+        # the storage stays within a few times the cell count on thin grids
+        for width, height in ((2, 65536), (1000, 10), (8000, 100), (33, 33)):
+            grid = self.grid_class(width, height, False, layout="morton")
+            with tempfile.TemporaryDirectory() as path:
+                grid.save_state(path)
+                assert len(np.load(os.path.join(path, "occupancy.npy"))) < 4 * width * height
+        with self.assertRaises(ValueError):
+            self.grid_class(3, 5, False, layout="morton", tile=12)
+
+
+class TestIdSingleGridEnforcement(TestSingleGridEnforcement):
+    """
+    Test the enforcement in SingleGrid with integer-id storage.
+    """
+
+    grid_class = IdSingleGrid
+
 
 # Number of agents at each position for testing
 # Initial agent positions for testing
@@ -324,6 +929,8 @@ class TestMultiGrid(unittest.TestCase):
     """
 
     torus = True
+    grid_class = MultiGrid
+    grid_kwargs = {}
 
     def setUp(self):
         """
@@ -331,7 +938,7 @@ class TestMultiGrid(unittest.TestCase):
         """
         width = 3
         height = 5
-        self.grid = MultiGrid(width, height, self.torus)
+        self.grid = self.grid_class(width, height, self.torus, **self.grid_kwargs)
         self.agents = []
         counter = 0
         for x in range(width):
@@ -377,6 +984,674 @@ class TestMultiGrid(unittest.TestCase):
         neighbors = self.grid.get_neighbors((1, 3), moore=False, radius=2)
         assert len(neighbors) == 11
 
+    def test_bulk_placement(self):
+        """
+        Test place_agents, move_agents and remove_agents on the MultiGrid.
+        """
+        new_agents = [MockAgent(100 + i, None) for i in range(4)]
+        self.grid.place_agents(new_agents, [(0, 0), (0, 0), (1, 2), (4, -1)])
+        assert self.grid.counts[0, 0] == 2
+        assert self.grid.counts[1, 2] == 6
+        assert new_agents[3].pos == (1, 4)
+        twice = MockAgent(200, None)
+        with self.assertRaises(Exception):
+            self.grid.place_agents([twice, twice], [(0, 1), (0, 2)])
+        with self.assertRaises(Exception):
+            self.grid.place_agents([new_agents[0]], [(0, 1)])
+        assert twice.pos is None
+        assert self.grid.counts[0, 0] == 2
+
+        with self.assertRaises(Exception):
+            self.grid.move_agents(new_agents[:1] * 2, [(2, 4), (2, 3)])
+        assert new_agents[0].pos == (0, 0)
+
+        self.grid.move_agents(new_agents, [(2, 4)] * 4)
+        assert self.grid.counts[2, 4] == 4
+        assert self.grid.is_cell_empty((0, 0))
+
+        self.grid.remove_agents(new_agents)
+        assert self.grid.counts.tolist() == TEST_MULTIGRID
+
+    def test_category_counts(self):
+        """
+        Test the per-category layers on the MultiGrid.
+        """
+        for agent in self.agents:
+            agent.type = agent.unique_id % 3
+        self.grid.enable_categories("type", 3)
+        assert (self.grid.category_counts.sum(axis=2) == self.grid.counts).all()
+        counts = self.grid.count_neighbors_by_category_batch([(1, 1), (0, 3)], True, True)
+        for pos, row in zip([(1, 1), (0, 3)], counts):
+            neighbors = self.grid.get_neighbors(pos, True, True)
+            assert list(row) == [sum(n.type == t for n in neighbors) for t in range(3)]
+        for agent in self.grid.get_cell_list_contents((1, 2)):
+            self.grid.move_agent(agent, (2, 0))
+        assert list(self.grid.category_counts[1, 2]) == [0, 0, 0]
+        assert (self.grid.category_counts.sum(axis=2) == self.grid.counts).all()
+
+    def test_counts(self):
+        """
+        Test the per-cell agent counts view of the MultiGrid.
+        """
+        counts = self.grid.counts
+        assert counts.tolist() == TEST_MULTIGRID
+        assert (self.grid.occupancy == (counts > 0)).all()
+        agent = self.grid.get_cell_list_contents((1, 2))[0]
+        self.grid.move_agent(agent, (0, 0))
+        if self.grid.layout != "rows":
+            counts = self.grid.counts
+        assert counts[1, 2] == 4
+        assert counts[0, 0] == 1
+
+    def test_neighbors_batch(self):
+        """
+        Test the CSR batch query on the MultiGrid.
+        """
+        offsets, slots = self.grid.get_neighbors_batch([(1, 4), (1, 1)], True)
+        assert list(offsets) == [0, 5, 11]
+        table = self.grid.agent_table
+        assert [table[s] for s in slots[5:]] == self.grid.get_neighbors((1, 1), True)
+
+        # removed agents do not show up and leave the cell empty
+        for agent in self.grid.get_cell_list_contents((1, 2)):
+            self.grid.remove_agent(agent)
+        assert self.grid.is_cell_empty((1, 2))
+        offsets, slots = self.grid.get_neighbors_batch([(1, 1)], True)
+        assert offsets[1] == 1
+
+    def test_coord_arrays(self):
+        """
+        Test that coord_arrays lists every agent once with its cell.
+        """
+        xs, ys, ids = self.grid.coord_arrays()
+        table = self.grid.agent_table
+        assert len(ids) == len(self.agents)
+        assert sorted(zip(xs.tolist(), ys.tolist())) == list(zip(xs.tolist(), ys.tolist()))
+        for i, x, y in zip(ids, xs, ys):
+            assert table[i].pos == (x, y)
+        assert {id(table[i]) for i in ids} == {id(agent) for agent in self.agents}
+
+    def test_fused_moves(self):
+        """
+        Test that moves and swaps keep the counts and cell contents in step.
+        """
+        rng = random.Random(2)
+        for _ in range(50):
+            agent = rng.choice(self.agents)
+            if rng.random() < 0.5:
+                self.grid.swap_pos(agent, rng.choice(self.agents))
+            else:
+                self.grid.move_agent(agent, (rng.randrange(3), rng.randrange(5)))
+        counts = np.zeros((self.grid.width, self.grid.height), dtype=int)
+        for agent in self.agents:
+            counts[agent.pos] += 1
+            assert agent in self.grid.get_cell_list_contents([agent.pos])
+        assert (self.grid.counts == counts).all()
+        assert (self.grid.occupancy == (counts > 0)).all()
+        assert sorted(self.grid.empties) == [tuple(cell) for cell in np.argwhere(counts == 0).tolist()]
+
+    def test_journal(self):
+        """
+        Test that the journal follows agents sharing cells.
+        """
+        self.grid.enable_journal()
+        agent = self.agents[0]
+        slot = self.grid.agent_table.index(agent)
+        self.grid.move_agent(agent, (1, 2))
+        self.grid.move_agent(agent, (1, 2))
+        self.grid.remove_agent(agent)
+        assert self.grid.journal.tolist() == [
+            [JournalEvent.MOVE, slot, 0, 1, 1, 2],
+            [JournalEvent.REMOVE, slot, 1, 2, -1, -1],
+        ]
+
+    def test_count_index(self):
+        """
+        Test that the count index follows agents sharing cells.
+        """
+        self.grid.enable_count_index(block=2)
+        rng = random.Random(3)
+        for agent in self.agents[:10]:
+            self.grid.move_agent(agent, (rng.randrange(3), rng.randrange(5)))
+        self.grid.swap_pos(self.agents[0], self.agents[-1])
+        self.grid.remove_agent(self.agents[1])
+        check_count_index(self, self.grid)
+
+    def test_place_out_of_bounds(self):
+        check_place_out_of_bounds(self, self.grid_class, self.grid_kwargs)
+
+    def test_find_nearest_agent(self):
+        """
+        Test that the predicate sees every agent of a cell.
+        """
+        cell = self.grid.get_cell_list_contents([(1, 2)])
+        assert len(cell) > 1
+        target = cell[-1]
+        found = self.grid.find_nearest_agent((1, 1), predicate=lambda a: a is target)
+        assert found is target
+        assert self.grid.find_nearest_agent((1, 2), include_center=True) is cell[0]
+
+    def test_save_load_state(self):
+        """
+        Test that a checkpoint restores the agents of every cell in order.
+        """
+        agents = {agent.unique_id: agent for agent in self.agents}
+        with tempfile.TemporaryDirectory() as path:
+            self.grid.save_state(path)
+            grid = self.grid_class.load_state(path, agents, mmap_mode="c")
+        assert list(grid.coord_iter()) == list(self.grid.coord_iter())
+        assert grid.get_neighbors((1, 1), True) == self.grid.get_neighbors((1, 1), True)
+        grid.remove_agent(self.agents[0])
+        assert self.agents[0] not in grid.get_cell_list_contents([(0, 1)])
+        grid.place_agent(self.agents[0], (2, 2))
+        assert self.agents[0] in grid.get_cell_list_contents([(2, 2)])
+
+
+
+class TestNeighborhoodCache(unittest.TestCase):
+    """
+    Testing the bounded neighborhood cache.
+    """
+
+    def test_unbounded(self):
+        grid = SingleGrid(5, 5, True)
+        cache = grid.neighborhood_cache
+        first = grid.get_neighborhood((1, 1), moore=True)
+        assert grid.get_neighborhood((1, 1), moore=True) is first
+        assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 0)
+        assert cache.currsize == 1
+        assert cache.cells == 8
+
+    def test_lru_eviction(self):
+        grid = SingleGrid(5, 5, True, cache_size=2)
+        cache = grid.neighborhood_cache
+        grid.get_neighborhood((0, 0), moore=True)
+        grid.get_neighborhood((1, 1), moore=True)
+        # touch (0, 0) so that (1, 1) becomes the least recently used entry
+        grid.get_neighborhood((0, 0), moore=True)
+        grid.get_neighborhood((2, 2), moore=True)
+        assert cache.currsize == 2
+        assert cache.evictions == 1
+        hits = cache.hits
+        grid.get_neighborhood((0, 0), moore=True)
+        assert cache.hits == hits + 1
+        grid.get_neighborhood((1, 1), moore=True)
+        assert cache.hits == hits + 1
+
+    def test_cell_budget(self):
+        grid = MultiGrid(5, 5, True, cache_cells=10)
+        cache = grid.neighborhood_cache
+        grid.get_neighborhood((0, 0), moore=True)
+        grid.get_neighborhood((1, 1), moore=True)
+        assert cache.currsize == 1
+        assert cache.cells == 8
+        # larger than the whole budget: never cached
+        grid.get_neighborhood((1, 1), moore=True, radius=2)
+        assert cache.cells <= 10
+
+    def test_disabled(self):
+        grid = SingleGrid(5, 5, False, cache_size=0)
+        cache = grid.neighborhood_cache
+        assert not cache.enabled
+        first = grid.get_neighborhood((1, 1), moore=True)
+        second = grid.get_neighborhood((1, 1), moore=True)
+        assert first == second
+        assert first is not second
+        assert cache.currsize == 0
+        assert cache.hits == cache.misses == 0
+
+    def test_stencil_matches_cache(self):
+        for torus in (False, True):
+            cached = MultiGrid(4, 5, torus)
+            uncached = MultiGrid(4, 5, torus, cache_size=0)
+            for x in range(4):
+                for y in range(5):
+                    for moore in (False, True):
+                        for radius in (1, 2, 3):
+                            assert cached.get_neighborhood(
+                                (x, y), moore, True, radius
+                            ) == uncached.get_neighborhood((x, y), moore, True, radius)
+
+    def test_resize(self):
+        grid = SingleGrid(5, 5, True)
+        cache = grid.neighborhood_cache
+        for x in range(5):
+            grid.get_neighborhood((x, 0), moore=False)
+        cache.resize(maxsize=2)
+        assert cache.currsize == 2
+        assert cache.evictions == 3
+        assert cache.info()["maxsize"] == 2
+        cache.clear()
+        cache.reset_stats()
+        assert cache.currsize == cache.cells == cache.evictions == 0
+
+
+class TestCompactMultiGrid(TestMultiGrid):
+    """
+    Testing a toroidal MultiGrid with linked-list cell storage.
+    """
+
+    grid_class = CompactMultiGrid
+
+    def test_cell_order(self):
+        """
+        Agents are reported in placement order, also after removals.
+        """
+        cell = self.grid[1][2]
+        assert [a.unique_id for a in cell] == [5, 6, 7, 8, 9]
+        self.grid.remove_agent(cell[0])
+        self.grid.remove_agent(cell[2])
+        a = MockAgent(100, None)
+        self.grid.place_agent(a, (1, 2))
+        assert [a.unique_id for a in self.grid[1][2]] == [6, 8, 9, 100]
+        for agent in self.grid.get_cell_list_contents((1, 2)):
+            self.grid.remove_agent(agent)
+        assert self.grid[1][2] == []
+        assert self.grid.is_cell_empty((1, 2))
+
+    def test_place_again_moves(self):
+        agent = self.grid[1][2][0]
+        self.grid.place_agent(agent, (0, 0))
+        assert agent.pos == (0, 0)
+        assert agent not in self.grid[1][2]
+        assert self.grid[0][0] == [agent]
+
+
+class TestMultiGridMorton(TestMultiGrid):
+    """
+    Testing a toroidal MultiGrid stored in Morton order.
+    """
+
+    grid_kwargs = {"layout": "morton"}
+
+
+class TestCompactMultiGridTiled(TestCompactMultiGrid):
+    """
+    Testing a toroidal MultiGrid with linked-list cell storage in tiles.
+    """
+
+    grid_kwargs = {"layout": "tiled", "tile": 2}
+
+
+class TestPropertyLayer(unittest.TestCase):
+    """
+    Testing property layers and their grid kernels.
+    """
+
+    def setUp(self):
+        self.layer = PropertyLayer("sugar", 4, 5, 1.0)
+        self.grid = SingleGrid(4, 5, True, property_layers=self.layer)
+
+    def test_layer_operations(self):
+        layer = self.layer
+        layer.set_cell((0, 0), 5)
+        layer.modify_cell((0, 0), np.add, 1)
+        layer.modify_cells(np.multiply, 2, condition=lambda data: data < 2)
+        assert layer.data[0, 0] == 6
+        assert layer.data[1, 1] == 2
+        layer.set_cells(0, condition=lambda data: data > 5)
+        assert layer.aggregate_property(np.sum) == 2 * 19
+        assert layer.select_cells(lambda data: data == 0).tolist() == [[0, 0]]
+
+        with self.assertRaises(ValueError):
+            self.grid.add_property_layer(PropertyLayer("sugar", 4, 5, 0))
+        with self.assertRaises(ValueError):
+            self.grid.add_property_layer(PropertyLayer("spice", 5, 5, 0))
+
+    def test_grid_select_cells(self):
+        self.layer.set_cell((1, 2), 3)
+        self.layer.set_cell((2, 2), 3)
+        self.grid.place_agent(MockAgent(0, None), (1, 2))
+        cells = self.grid.select_cells({"sugar": lambda data: data > 2})
+        assert cells.tolist() == [[1, 2], [2, 2]]
+        cells = self.grid.select_cells({"sugar": lambda data: data > 2}, only_empty=True)
+        assert cells.tolist() == [[2, 2]]
+
+    def test_diffusion(self):
+        self.layer.set_cells(0)
+        self.layer.set_cell((0, 0), 8)
+        self.grid.diffuse_property("sugar", 0.5, moore=False)
+        data = self.layer.data
+        assert data[0, 0] == 4
+        assert data[3, 0] == data[1, 0] == data[0, 4] == data[0, 1] == 1
+        assert data.sum() == 8
+
+        # bounded grids split among the neighbors inside the grid
+        layer = PropertyLayer("pollution", 3, 3, 0.0)
+        grid = MultiGrid(3, 3, False, property_layers=[layer])
+        layer.set_cell((0, 0), 9)
+        grid.diffuse_property("pollution", 1.0, moore=True)
+        assert layer.data[0, 0] == 0
+        assert layer.data[1, 1] == layer.data[0, 1] == layer.data[1, 0] == 3
+        assert layer.data.sum() == 9
+
+    def test_aggregate_neighborhood(self):
+        self.layer.modify_cells(lambda data: data + np.arange(20).reshape(4, 5))
+        maxima = self.grid.aggregate_neighborhood("sugar", "max", True)
+        for x in range(4):
+            for y in range(5):
+                neighborhood = self.grid.get_neighborhood((x, y), True)
+                values = [self.layer.data[pos] for pos in neighborhood]
+                assert maxima[x, y] == max(values)
+        sums = self.grid.aggregate_neighborhood("sugar", "sum", False, True, 1, [(0, 0)])
+        assert sums[0] == 1 + 2 + 6 + 16 + 5
+        with self.assertRaises(ValueError):
+            self.grid.aggregate_neighborhood("sugar", "median", True)
+
+
+class TestContinuousSpace(unittest.TestCase):
+    """
+    Testing a toroidal continuous space against brute force distances.
+    """
+
+    torus = True
+
+    def setUp(self):
+        self.space = ContinuousSpace(70, 20, self.torus, -30, -30, cell_size=3)
+        self.agents = []
+        for i, pos in enumerate([(-20, -20), (-20, -20.05), (65, 18)]):
+            a = MockAgent(i, None)
+            self.agents.append(a)
+            self.space.place_agent(a, pos)
+
+    def brute_force(self, pos, radius):
+        return {
+            a.unique_id
+            for a in self.agents
+            if a.pos is not None and self.space.get_distance(a.pos, pos) <= radius
+        }
+
+    def test_neighborhood_retrieval(self):
+        assert len(self.space.get_neighbors((-20, -20), 1)) == 2
+        assert len(self.space.get_neighbors((-20, -20), 1, include_center=False)) == 1
+        assert len(self.space.get_neighbors((0, -10), 10)) == 0
+        assert len(self.space.get_neighbors((-30, -30), 10)) == (1 if self.torus else 0)
+
+    def test_distance_and_bounds(self):
+        if self.torus:
+            assert self.space.get_distance((-30, -30), (70, 20)) == 0
+            assert self.space.torus_adj((75, -35)) == (-25, 15)
+        else:
+            with self.assertRaises(Exception):
+                self.space.place_agent(MockAgent(9, None), (75, -35))
+        assert self.space.get_distance((-30, -30), (-30, -20)) == 10
+
+    def test_random_moves(self):
+        rng = random.Random(1)
+        for i in range(3, 200):
+            a = MockAgent(i, None)
+            self.agents.append(a)
+            self.space.place_agent(a, (rng.uniform(-30, 70), rng.uniform(-30, 20)))
+        for a in rng.sample(self.agents, 50):
+            self.space.remove_agent(a)
+        for a in self.agents:
+            if a.pos is not None:
+                self.space.move_agent(a, (rng.uniform(-30, 70), rng.uniform(-30, 20)))
+
+        for _ in range(50):
+            pos = (rng.uniform(-30, 70), rng.uniform(-30, 20))
+            radius = rng.uniform(0, 30)
+            found = [a.unique_id for a in self.space.get_neighbors(pos, radius)]
+            assert len(found) == len(set(found))
+            assert set(found) == self.brute_force(pos, radius)
+
+        table = self.space.agent_table
+        pairs = {
+            tuple(sorted((table[i].unique_id, table[j].unique_id)))
+            for i, j in self.space.get_neighbor_pairs(5)
+        }
+        expected = {
+            (a.unique_id, b.unique_id)
+            for a in self.agents
+            for b in self.agents
+            if a.pos is not None
+            and b.pos is not None
+            and a.unique_id < b.unique_id
+            and self.space.get_distance(a.pos, b.pos) <= 5
+        }
+        assert pairs == expected
+        assert self.space.bucket_counts.sum() == 150
+
+
+class TestContinuousSpaceBounded(TestContinuousSpace):
+    """
+    Testing a non-toroidal continuous space.
+    """
+
+    torus = False
+
+
+class TestNetworkGrid(unittest.TestCase):
+    """
+    Testing the CSR network grid against networkx.
+    """
+
+    def setUp(self):
+        self.G = nx.connected_watts_strogatz_graph(30, 4, 0.3, seed=0)
+        nx.relabel_nodes(self.G, {n: 100 - n for n in self.G}, copy=False)
+        self.space = NetworkGrid(self.G)
+        self.agents = []
+        for i, node in enumerate(list(self.G)[::2] * 2):
+            a = MockAgent(i, None)
+            self.agents.append(a)
+            self.space.place_agent(a, node)
+
+    def test_csr(self):
+        nodes = list(self.G)
+        for i, node in enumerate(nodes):
+            start, end = self.space.indptr[i], self.space.indptr[i + 1]
+            assert [nodes[k] for k in self.space.indices[start:end]] == list(self.G.neighbors(node))
+
+    def test_neighborhood(self):
+        for node in self.G:
+            assert self.space.get_neighborhood(node) == list(self.G.neighbors(node))
+            assert self.space.get_neighborhood(node, True)[-1] == node
+            for radius in (2, 3):
+                expected = nx.single_source_shortest_path_length(self.G, node, radius)
+                assert self.space.get_neighborhood(node, True, radius) == sorted(expected)
+                del expected[node]
+                assert self.space.get_neighborhood(node, False, radius) == sorted(expected)
+        assert self.space.neighborhood_cache.info()["currsize"] == 4 * len(self.G)
+
+    def test_agents(self):
+        node = list(self.G)[0]
+        a, b = self.agents[0], self.agents[15]
+        assert self.space.get_cell_list_contents([node]) == [a, b]
+        assert not self.space.is_cell_empty(node)
+        assert self.space.is_cell_empty(list(self.G)[1])
+
+        self.space.move_agent(a, list(self.G)[1])
+        assert self.space.get_cell_list_contents([node]) == [b]
+        self.space.place_agent(a, node)
+        assert self.space.get_cell_list_contents([node]) == [b, a]
+        self.space.remove_agent(b)
+        assert b.pos is None
+        assert len(self.space.get_all_cell_contents()) == len(self.agents) - 1
+
+        for node in self.G:
+            for radius in (1, 2):
+                neighborhood = self.space.get_neighborhood(node, True, radius)
+                expected = self.space.get_cell_list_contents(neighborhood)
+                assert self.space.get_neighbors(node, True, radius) == expected
+
+
+class TestSparseSingleGrid(unittest.TestCase):
+    """
+    Testing a sparse grid against its dense counterpart.
+    """
+
+    grid_class = SparseSingleGrid
+    dense_class = SingleGrid
+
+    def test_huge_grid(self):
+        grid = self.grid_class(10**6, 10**6, True)
+        a, b = MockAgent(0, None), MockAgent(1, None)
+        grid.place_agent(a, (0, 0))
+        grid.place_agent(b, (10**6 - 1, 10**6 - 1))
+        assert grid.get_neighbors((0, 0), True) == [b]
+        assert grid.get_neighbors((0, 0), True, radius=10**5) == [b]
+        assert grid.get_neighbors((0, 0), True, True, radius=10**5) == [b, a]
+        assert grid.num_occupied == 2
+        assert grid.capacity == 16
+        grid.move_to_empty(a)
+        assert grid.num_occupied == 2
+        assert not grid.is_cell_empty(a.pos)
+
+    def test_matches_dense(self):
+        rng = random.Random(0)
+        for torus in (True, False):
+            grid = self.grid_class(13, 10, torus)
+            dense = self.dense_class(13, 10, torus)
+            agents = [MockAgent(i, None) for i in range(60)]
+            for step in range(600):
+                a = rng.choice(agents)
+                pos = (rng.randrange(13), rng.randrange(10))
+                if a.pos is not None and rng.random() < 0.3:
+                    grid.remove_agent(a)
+                    a.pos = pos_before = None
+                    dense.remove_agent(dense_agents[a.unique_id])
+                    dense_agents[a.unique_id].pos = None
+                    continue
+                if step == 0:
+                    dense_agents = [MockAgent(i, None) for i in range(60)]
+                if not grid.is_cell_empty(pos) and self.grid_class is SparseSingleGrid:
+                    continue
+                if a.pos is None:
+                    grid.place_agent(a, pos)
+                    dense.place_agent(dense_agents[a.unique_id], pos)
+                else:
+                    grid.move_agent(a, pos)
+                    dense.move_agent(dense_agents[a.unique_id], pos)
+
+            assert grid.num_occupied == grid.num_cells - dense.num_empties
+            assert sorted(map(tuple, grid.occupied_cells())) == sorted(
+                (x, y) for x in range(13) for y in range(10) if not dense.is_cell_empty((x, y))
+            )
+            for _ in range(100):
+                pos = (rng.randrange(13), rng.randrange(10))
+                args = (rng.random() < 0.5, rng.random() < 0.5, rng.randint(1, 8))
+                found = [a.unique_id for a in grid.get_neighbors(pos, *args)]
+                assert found == [a.unique_id for a in dense.get_neighbors(pos, *args)]
+                assert grid.get_neighborhood(pos, *args) == dense.get_neighborhood(pos, *args)
+                assert [a.unique_id for a in grid.get_cell_list_contents([pos])] == [
+                    a.unique_id for a in dense.get_cell_list_contents([pos])
+                ]
+
+
+    def test_place_out_of_bounds(self):
+        # off-grid positions must not alias other cells nor the empty keys
+        for torus in (False, True):
+            grid = self.grid_class(10, 10, torus)
+            for pos in ((0, 13), (-1, 3), (3, -1), (10, 0)):
+                agent = MockAgent(0, None)
+                if not torus:
+                    with self.assertRaises(Exception):
+                        grid.place_agent(agent, pos)
+                    assert agent.pos is None
+                else:
+                    grid.place_agent(agent, pos)
+                    cell = (pos[0] % 10, pos[1] % 10)
+                    assert agent.pos == cell
+                    assert grid.get_cell_list_contents([cell]) == [agent]
+                    assert [tuple(c) for c in grid.occupied_cells()] == [cell]
+                    grid.remove_agent(agent)
+                assert grid.num_occupied == 0
+                assert grid.is_cell_empty((1, 3)) and grid.is_cell_empty((9, 3))
+
+
+class TestSparseMultiGrid(TestSparseSingleGrid):
+    """
+    Testing a sparse multigrid against CompactMultiGrid.
+    """
+
+    grid_class = SparseMultiGrid
+    dense_class = CompactMultiGrid
+
+
+def hex_neighborhood(pos, width, height, torus, include_center, radius):
+    """
+    Breadth first hexagonal neighborhood as computed by mesa's _HexGrid.
+    """
+    coordinates = set()
+    frontier = [pos]
+    for _ in range(radius):
+        found = []
+        for x, y in frontier:
+            # mesa: even columns reach a row up diagonally, odd ones a row down
+            dy = 1 if x % 2 == 0 else -1
+            for cx, cy in [(x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y), (x - 1, y + dy), (x + 1, y + dy)]:
+                if torus:
+                    cx, cy = cx % width, cy % height
+                elif not (0 <= cx < width and 0 <= cy < height):
+                    continue
+                if (cx, cy) not in coordinates:
+                    coordinates.add((cx, cy))
+                    found.append((cx, cy))
+        frontier = found
+    if include_center:
+        coordinates.add(pos)
+    else:
+        coordinates.discard(pos)
+    return sorted(coordinates)
+
+
+class TestHexSingleGrid(unittest.TestCase):
+    """
+    Testing hexagonal neighborhoods.
+    """
+
+    grid_class = HexSingleGrid
+
+    def test_neighborhood(self):
+        grid = self.grid_class(5, 5, False)
+        # mesa.space.HexSingleGrid(5, 5, False).get_neighborhood
+        assert grid.get_neighborhood((2, 2)) == [(1, 2), (1, 3), (2, 1), (2, 3), (3, 2), (3, 3)]
+        assert grid.get_neighborhood((1, 2)) == [(0, 1), (0, 2), (1, 1), (1, 3), (2, 1), (2, 2)]
+        assert grid.get_neighborhood((0, 0)) == [(0, 1), (1, 0), (1, 1)]
+        assert grid.get_neighborhood((1, 0), radius=2) == [
+            (0, 0), (0, 1), (1, 1), (1, 2), (2, 0), (2, 1), (3, 0), (3, 1)
+        ]
+        # mesa's positional (pos, include_center, radius)
+        assert grid.get_neighborhood((2, 2), True) == [(1, 2), (1, 3), (2, 1), (2, 2), (2, 3), (3, 2), (3, 3)]
+        assert grid.get_neighborhood((1, 0), False, 2) == grid.get_neighborhood((1, 0), radius=2)
+
+        rng = random.Random(0)
+        for _ in range(500):
+            width, height = rng.randint(1, 9), rng.randint(1, 9)
+            torus = rng.random() < 0.5
+            include_center = rng.random() < 0.5
+            radius = rng.randint(0, 5)
+            pos = (rng.randrange(width), rng.randrange(height))
+            grid = self.grid_class(width, height, torus)
+            expected = hex_neighborhood(pos, width, height, torus, include_center, radius)
+            assert grid.get_neighborhood(pos, include_center=include_center, radius=radius) == expected
+            assert list(grid.iter_neighborhood(pos, include_center, radius)) == expected
+            assert grid.hex_neighborhood(pos, include_center, radius) == expected
+
+    def test_neighbors(self):
+        grid = self.grid_class(6, 7, True)
+        agents = {}
+        for x in range(6):
+            for y in range(0, 7, 2):
+                agents[x, y] = MockAgent(len(agents), None)
+                grid.place_agent(agents[x, y], (x, y))
+        for pos in [(0, 0), (3, 3), (5, 6)]:
+            for radius in (1, 2):
+                expected = [agents[cell] for cell in hex_neighborhood(pos, 6, 7, True, False, radius) if cell in agents]
+                found = grid.get_neighbors(pos, radius=radius)
+                assert sorted(a.unique_id for a in found) == sorted(a.unique_id for a in expected)
+                assert list(grid.iter_neighbors(pos, False, radius)) == found
+                assert grid.get_neighbors(pos, True, radius) == grid.hex_neighbors(pos, True, radius)
+                assert len(grid.get_neighbors(pos, True, radius)) == len(found) + (pos in agents)
+        assert list(grid.neighbor_iter((3, 3))) == grid.get_neighbors((3, 3))
+
+
+class TestHexMultiGrid(TestHexSingleGrid):
+    """
+    Testing hexagonal neighborhoods on a MultiGrid.
+    """
+
+    grid_class = HexMultiGrid
 
 
 class TestIndexing:
@@ -1,7 +1,38 @@
+import os
+import tempfile
+
 from setuptools import setup
+from setuptools.command.build_ext import build_ext
 from Cython.Build import cythonize
 
+
+class OpenMPBuildExt(build_ext):
+    # the batch kernels run in parallel when the compiler supports OpenMP,
+    # otherwise prange compiles to a serial loop
+    def build_extensions(self):
+        flag = "/openmp" if self.compiler.compiler_type == "msvc" else "-fopenmp"
+        if self.has_openmp(flag):
+            for ext in self.extensions:
+                ext.extra_compile_args.append(flag)
+                if self.compiler.compiler_type != "msvc":
+                    ext.extra_link_args.append(flag)
+        super().build_extensions()
+
+    def has_openmp(self, flag):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "omp.c")
+            with open(source, "w") as f:
+                f.write("#include <omp.h>\nint main(void) { return omp_get_max_threads() < 1; }\n")
+            try:
+                objects = self.compiler.compile([source], output_dir=tmp, extra_postargs=[flag])
+                self.compiler.link_executable(objects, os.path.join(tmp, "omp"), extra_postargs=[flag])
+            except Exception:
+                return False
+        return True
+
+
 setup(
     name="Mesa-Perf",
     ext_modules=cythonize("mesa_perf/*.pyx"),
+    cmdclass={"build_ext": OpenMPBuildExt},
 )